@@ -0,0 +1,131 @@
+#!/usr/bin/python
+"""
+Asynchronous capture of the tracker's intermediate images.
+
+The subtraction tracker used to write six PNGs on every frame, which tied
+the tracking rate to PNG encoding and disk speed. A DebugImageSink is off
+unless given a rate. When on, it samples at most rate frames a second and
+queues copies of their images for a background writer thread. If the writer
+falls behind, whole frames are dropped instead of stalling tracking.
+"""
+
+import os
+from collections import namedtuple
+from queue import Queue, Full
+from threading import Thread, Lock
+from time import time
+
+import cv2
+
+MAX_PENDING = 4  # sampled frames waiting to be written before new ones are dropped
+
+FrameCost = namedtuple('FrameCost', ['frames', 'detect', 'debug'])
+
+
+class CostCounter(object):
+    """Running total of the time spent on something, per frame."""
+
+    def __init__(self):
+        super(CostCounter, self).__init__()
+        self.frames = 0
+        self.total = 0.
+        self.__lock = Lock()
+
+    def add(self, seconds, frames=1):
+        with self.__lock:
+            self.frames += frames
+            self.total += seconds
+
+    @property
+    def mean(self):
+        return self.total / self.frames if self.frames else 0.
+
+    def reset(self):
+        with self.__lock:
+            self.frames = 0
+            self.total = 0.
+
+
+class DebugImageSink(object):
+    """
+    Writes sampled debug images from a background thread.
+
+    Images are written under their given names in directory, so each name
+    always holds the latest sampled frame, as the old per-frame writes did.
+    With numbered set, every sampled frame gets its own files instead.
+    write_cost counts the writer thread's time per written frame.
+    """
+
+    def __init__(self, rate=0., directory='.', max_pending=MAX_PENDING, numbered=False):
+        super(DebugImageSink, self).__init__()
+        self.rate = rate
+        self.directory = directory
+        self.numbered = numbered
+        self.sampled = 0
+        self.written = 0
+        self.dropped = 0
+        self.write_cost = CostCounter()
+        self.__queue = Queue(maxsize=max_pending)
+        self.__last_sample = None
+        self.__writer = None
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def sample(self):
+        """
+        Decide whether the current frame is captured. Call once per frame.
+
+        :return: A frame number to submit images under, or None to skip the frame
+        """
+        if not self.enabled:
+            return None
+        now = time()
+        if self.__last_sample is not None and now - self.__last_sample < 1. / self.rate:
+            return None
+        self.__last_sample = now
+        self.sampled += 1
+        return self.sampled
+
+    def submit(self, frame_num, images):
+        """
+        Queue copies of a sampled frame's images for writing.
+
+        :param frame_num: The number sample() returned for this frame
+        :param images: A dict of file name -> image
+        :return: False if the writer was behind and the frame was dropped
+        """
+        if frame_num is None:
+            return False
+        self.__start_writer()
+        try:
+            self.__queue.put_nowait((frame_num, [(name, img.copy()) for name, img in images.items()]))
+        except Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def __start_writer(self):
+        if self.__writer is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.__writer = Thread(target=self.__write, args=())
+            self.__writer.daemon = True
+            self.__writer.start()
+
+    def __write(self):
+        """
+        Write queued images to disk.
+
+        Meant to run as a separate thread.
+        """
+        while True:
+            frame_num, images = self.__queue.get()
+            t0 = time()
+            for name, img in images:
+                if self.numbered:
+                    name = "{:06d}_{}".format(frame_num, name)
+                cv2.imwrite(os.path.join(self.directory, name), img)
+            self.written += 1
+            self.write_cost.add(time() - t0)
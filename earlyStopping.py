@@ -0,0 +1,124 @@
+#!/usr/bin/python
+"""
+Early termination of trials that cannot compete.
+
+A TrialMonitor watches the tracker while a trial runs and asks its policy
+whether the trial is still worth finishing. When the policy gives up, the
+monitor stops every motor and marks the trial as censored, keeping the
+policy's estimate of where the trial would have ended up so the learner can
+still hand the optimizer a value for it.
+"""
+
+from math import sqrt
+from threading import Thread, Event
+from time import time
+
+NOMINAL_DURATION = 10.0  # seconds a trial is assumed to run until one has been timed
+MONITOR_POLL = 0.25  # seconds between position checks
+
+
+class EarlyStopPolicy(object):
+    """
+    Decides whether a running trial should be cut short.
+
+    The base policy never stops a trial. Subclasses override should_stop and
+    project.
+    """
+
+    def __init__(self, duration=NOMINAL_DURATION):
+        super(EarlyStopPolicy, self).__init__()
+        self.duration = duration
+
+    def observe(self, duration):
+        """Note how long a complete trial took."""
+        self.duration = duration
+
+    def project(self, elapsed, displacement):
+        """Estimate the displacement at the end of the trial."""
+        return displacement
+
+    def should_stop(self, elapsed, displacement, best):
+        return False
+
+
+class DisplacementProjection(EarlyStopPolicy):
+    """
+    Extrapolates the displacement so far linearly to the end of the trial.
+
+    After grace seconds, a trial is stopped once its projected displacement
+    falls below fraction of the best displacement seen so far. The grace
+    period keeps the first wobbles of a gait from deciding its fate.
+    """
+
+    def __init__(self, fraction=0.5, grace=3.0, duration=NOMINAL_DURATION):
+        super(DisplacementProjection, self).__init__(duration)
+        self.fraction = fraction
+        self.grace = grace
+
+    def project(self, elapsed, displacement):
+        if elapsed <= 0:
+            return displacement
+        return displacement * max(self.duration / elapsed, 1.)
+
+    def should_stop(self, elapsed, displacement, best):
+        if best <= 0 or elapsed < self.grace or elapsed >= self.duration:
+            return False
+        return self.project(elapsed, displacement) < self.fraction * best
+
+
+class TrialMonitor(object):
+    """
+    Watches one trial and stops it if the policy gives up on it.
+
+    Start it right before the trial starts and call finish() once the trial
+    returns. censored and projected tell whether the trial was cut short and
+    the policy's estimate of its final displacement.
+    """
+
+    def __init__(self, tens, tracker, policy, best, poll_interval=MONITOR_POLL):
+        super(TrialMonitor, self).__init__()
+        self.tens = tens
+        self.tracker = tracker
+        self.policy = policy
+        self.best = best
+        self.poll_interval = poll_interval
+        self.censored = False
+        self.projected = None
+        self.stopped_after = None
+        self.duration = None
+        self.__done = Event()
+        self.__thread = None
+        self.__t0 = None
+
+    def start(self, start_pos):
+        self.__t0 = time()
+        self.__thread = Thread(target=self.__watch, args=(start_pos, self.__t0))
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def finish(self):
+        self.__done.set()
+        if self.__thread is not None:
+            self.__thread.join()
+            self.duration = time() - self.__t0
+
+    def __watch(self, start_pos, t0):
+        """
+        Check the trial's progress until it finishes or is stopped.
+
+        Meant to run as a separate thread.
+        """
+        while not self.__done.wait(self.poll_interval):
+            # In the units of start_pos and best, cm for a metric tracker
+            pos = self.tracker.tens_position
+            if pos.x < 0 or pos.y < 0:
+                continue
+            elapsed = time() - t0
+            displacement = sqrt((pos.x - start_pos.x) ** 2 + (pos.y - start_pos.y) ** 2)
+            if self.policy.should_stop(elapsed, displacement, self.best):
+                self.censored = True
+                self.projected = self.policy.project(elapsed, displacement)
+                self.stopped_after = elapsed
+                self.tens.emergency_stop(reason="early stop, projected {:.0f} of best {:.0f}".format(
+                    self.projected, self.best))
+                return
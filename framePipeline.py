@@ -0,0 +1,208 @@
+#!/usr/bin/python
+"""
+Hand-off of camera frames between the tracker's threads.
+
+A FrameChannel holds the newest frame together with a sequence number and
+the time it was captured. Producers publish frames and consumers block in
+wait_next until a frame newer than the last one they handled arrives, so no
+thread spins and no frame is handled twice. A consumer slower than the
+camera skips straight to the newest frame rather than falling behind, and
+the frames it skipped are counted.
+
+A FrameRing is a FrameChannel over a fixed pool of preallocated buffers.
+The camera decodes straight into a free buffer and consumers get read-only
+views of it, so frames cost no allocation or copying at camera rate.
+"""
+
+from collections import namedtuple
+from threading import Condition
+from time import time
+
+import numpy as np
+
+RING_SIZE = 4  # buffers per ring, enough for the producer, the newest frame and two leases
+
+Frame = namedtuple('Frame', ['seq', 'time', 'image'])
+
+
+class FrameChannel(object):
+    """The newest frame from one producer, for any number of consumers."""
+
+    def __init__(self):
+        super(FrameChannel, self).__init__()
+        self.seq = 0
+        self.__frame = None
+        self._cond = Condition()  # reentrant, subclasses lock it around publish
+        self._closed = False
+
+    @property
+    def latest(self):
+        """The newest Frame, or None before the first one. Never blocks."""
+        return self.__frame
+
+    def publish(self, image, stamp=None, seq=None):
+        """
+        Make image the newest frame and wake every waiting consumer.
+
+        :param stamp: Capture time (now by default)
+        :param seq: Sequence number to publish under, for frames derived from
+                    another channel's frame (the next number by default)
+        :return: The frame's sequence number
+        """
+        with self._cond:
+            self.seq = self.seq + 1 if seq is None else seq
+            self.__frame = Frame(self.seq, time() if stamp is None else stamp, image)
+            self._cond.notify_all()
+            return self.seq
+
+    def wait_next(self, after=0, timeout=None):
+        """
+        Block until there is a frame with a sequence number above after.
+
+        :return: The newest Frame, or None on timeout or once the channel is closed
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._closed or (self.__frame is not None and
+                                                                  self.__frame.seq > after), timeout):
+                return None
+            return None if self._closed else self.__frame
+
+    def close(self):
+        """Wake every consumer for good."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class FrameLease(object):
+    """
+    A consumer's hold on one FrameRing buffer.
+
+    The buffer is not reused until the lease is released. Use it as a
+    context manager or call release().
+    """
+
+    def __init__(self, ring, index, frame):
+        super(FrameLease, self).__init__()
+        self.ring = ring
+        self.index = index
+        self.frame = frame
+        self.__released = False
+
+    @property
+    def seq(self):
+        return self.frame.seq
+
+    @property
+    def time(self):
+        return self.frame.time
+
+    @property
+    def image(self):
+        return self.frame.image
+
+    def release(self):
+        if not self.__released:
+            self.__released = True
+            self.ring.release(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FrameRing(FrameChannel):
+    """
+    The newest frame from one producer, kept in a pool of preallocated buffers.
+
+    The producer claims a free buffer, fills it in place and publishes it,
+    or a view of part of it. Published images are read-only views into the
+    pool, valid until the producer has gone round the ring. A consumer that
+    needs an image for longer leases it instead, and leased buffers are
+    skipped by claim until they are released, so leases should be short.
+    The shape and dtype of the buffers are known without touching a frame.
+    """
+
+    def __init__(self, shape, dtype=np.uint8, size=RING_SIZE):
+        super(FrameRing, self).__init__()
+        assert size >= 2, "A ring needs at least 2 buffers"
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.claim_waits = 0
+        self.__buffers = [np.empty(self.shape, self.dtype) for _ in range(size)]
+        self.__leases = [0] * size
+        self.__latest = None
+        self.__next = 0
+
+    def claim(self, timeout=None):
+        """
+        Hand the producer a buffer that is neither leased nor the newest frame.
+
+        Blocks while every other buffer is leased. Claiming again without
+        publishing returns the same buffer.
+        :return: (index, writable buffer), or None on timeout or once the ring is closed
+        """
+        with self._cond:
+            free = self.__free()
+            if free is None:
+                self.claim_waits += 1
+                self._cond.wait_for(lambda: self._closed or self.__free() is not None, timeout)
+                free = self.__free()
+            if self._closed or free is None:
+                return None
+            self.__next = free
+            return free, self.__buffers[free]
+
+    def publish_slot(self, index, image=None, stamp=None, seq=None):
+        """
+        Publish a claimed buffer as the newest frame.
+
+        :param image: A view into the buffer to publish (the whole buffer by default)
+        :return: The frame's sequence number
+        """
+        buf = self.__buffers[index]
+        image = buf.view() if image is None else image.view()
+        assert np.may_share_memory(image, buf), "Published image is not in the claimed buffer"
+        image.flags.writeable = False
+        with self._cond:
+            self.__latest = index
+            self.__next = (index + 1) % len(self.__buffers)
+            return self.publish(image, stamp, seq)
+
+    def lease(self, after=0, timeout=None):
+        """
+        Block like wait_next, then hold the frame's buffer until released.
+
+        :return: A FrameLease, or None on timeout or once the ring is closed
+        """
+        with self._cond:
+            frame = self.wait_next(after, timeout)
+            if frame is None:
+                return None
+            self.__leases[self.__latest] += 1
+            return FrameLease(self, self.__latest, frame)
+
+    def lease_latest(self):
+        """Lease the newest frame without blocking, or return None before the first one."""
+        with self._cond:
+            frame = self.latest
+            if frame is None or self._closed:
+                return None
+            self.__leases[self.__latest] += 1
+            return FrameLease(self, self.__latest, frame)
+
+    def release(self, index):
+        with self._cond:
+            self.__leases[index] -= 1
+            self._cond.notify_all()
+
+    def __free(self):
+        """The first buffer from the producer's position on that can be written, or None."""
+        size = len(self.__buffers)
+        for i in range(size):
+            index = (self.__next + i) % size
+            if index != self.__latest and not self.__leases[index]:
+                return index
+        return None
@@ -0,0 +1,333 @@
+#!/usr/bin/python
+"""
+Where a tracker's frames come from.
+
+TensTracker reads frames through the cv2.VideoCapture interface: read()
+returning (ret, img), optionally into a given buffer, plus get, set,
+isOpened and release. The sources here offer that interface for a live
+camera, a video file and a directory of images, so tracking can run
+offline on recordings, for profiling and regression tests, without asking
+the user anything.
+
+A camera paces itself, and its driver queues frames the tracker hasn't
+read yet, so a CameraSource asks for the smallest queue the driver allows
+and grabs its way past whatever can have queued since the last read, so
+only the newest frame is decoded.
+Recordings play as fast as they decode unless given an fps, and once one
+runs out read() fails, as a camera that stopped would.
+
+Every source sets grab_time to when it got the frame read() returned, before
+decoding it, for measuring how stale positions are.
+"""
+
+import os
+import re
+from collections import namedtuple
+from glob import glob
+from time import sleep, time
+
+import cv2
+import numpy as np
+
+CAPTURE_WIDTH = 640
+CAPTURE_HEIGHT = 480
+CAPTURE_FOURCC = 'MJPG'  # compressed on the camera, so USB bandwidth doesn't limit the frame rate
+CAPTURE_FPS = 30
+CAPTURE_BUFFER = 1  # frames the driver may queue
+QUEUED_GRAB = 0.004  # seconds under which a grab counts as taking a frame that was already queued
+MAX_DRAIN = 8  # queued frames dropped at most per read
+
+# What the camera agreed to, which needn't be what was asked for
+CaptureFormat = namedtuple('CaptureFormat', ['width', 'height', 'fourcc', 'fps', 'buffer_size'])
+
+
+def open_source(source, fps=None, loop=False):
+    """
+    Open a frame source.
+
+    :param source: A camera number, a video file, a directory of images, or
+                   anything with a read() already, which is returned as is
+    :param fps: Frames a second to play a recording at, None for as fast as it decodes
+    :param loop: Start a recording over once it runs out
+    """
+    if hasattr(source, 'read'):
+        return source
+    if isinstance(source, int) or (isinstance(source, str) and source.isdigit()):
+        return CameraSource(int(source))
+    assert os.path.exists(source), "No frame source at {}".format(source)
+    if os.path.isdir(source):
+        return ImageSequence(source, fps=fps, loop=loop)
+    return VideoSource(source, fps=fps, loop=loop)
+
+
+class CameraSource(object):
+    """
+    A live camera, giving the newest frame on every read.
+
+    Asks the camera for the given format, and format says what it agreed
+    to. Frames the driver queued while the tracker was busy are grabbed and
+    dropped without being decoded, dropped counts them. How many are queued
+    follows from the camera's frame rate, so the newest one queued is kept
+    rather than dropped to wait for the next.
+    """
+    live = True
+
+    def __init__(self, cam_num, width=CAPTURE_WIDTH, height=CAPTURE_HEIGHT, fourcc=CAPTURE_FOURCC, fps=CAPTURE_FPS,
+                 buffer_size=CAPTURE_BUFFER, drain=True):
+        super(CameraSource, self).__init__()
+        self.cam_num = cam_num
+        self.drain = drain
+        self.dropped = 0
+        self.grab_time = None
+        self.__empty_at = None  # when a grab last found the driver's queue empty
+        self.__taken = 0  # frames since, grabbed or dropped by the driver
+        self.capture = cv2.VideoCapture(cam_num)
+        self.format = self.negotiate(width, height, fourcc, fps, buffer_size)
+
+    def negotiate(self, width=None, height=None, fourcc=None, fps=None, buffer_size=None):
+        """
+        Ask the camera for a format, leaving out whatever is None.
+
+        The pixel format goes first, some drivers only offer the larger
+        sizes compressed.
+        :return: The CaptureFormat the camera agreed to
+        """
+        if fourcc is not None:
+            self.capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        for prop, value in [(cv2.CAP_PROP_FRAME_WIDTH, width), (cv2.CAP_PROP_FRAME_HEIGHT, height),
+                            (cv2.CAP_PROP_FPS, fps), (cv2.CAP_PROP_BUFFERSIZE, buffer_size)]:
+            if value is not None:
+                self.capture.set(prop, value)
+        code = int(self.capture.get(cv2.CAP_PROP_FOURCC))
+        self.format = CaptureFormat(int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                    int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                    ''.join([chr((code >> (8 * i)) & 0xFF) for i in range(4)]),
+                                    self.capture.get(cv2.CAP_PROP_FPS),
+                                    int(self.capture.get(cv2.CAP_PROP_BUFFERSIZE)))
+        return self.format
+
+    def read(self, image=None):
+        """
+        The newest frame, decoded into image if given.
+
+        A grab that has to wait for the camera found the driver's queue
+        empty. The frames the camera made since then, less those taken, are
+        queued, and that many are grabbed. Until a grab has waited, grabbing
+        goes on until one does.
+        :return: (ret, frame) like VideoCapture.read
+        """
+        if not self.drain:
+            queued = 1
+        elif self.__empty_at is None:
+            queued = MAX_DRAIN + 1
+        else:
+            queued = max(self.__queued(), 1)
+        for drained in range(queued):
+            t0 = time()
+            if not self.capture.grab():
+                return False, None
+            self.grab_time = time()
+            # Grabbing a frame drops the one grabbed before it
+            self.dropped += 1 if drained else 0
+            if self.grab_time - t0 > QUEUED_GRAB:
+                self.__empty_at, self.__taken = self.grab_time, 0
+                break
+            self.__taken += 1
+        return self.capture.retrieve(image=image)
+
+    def __queued(self):
+        """Frames the driver holds, going by the frame rate, at most buffer_size (or MAX_DRAIN)."""
+        made = int((time() - self.__empty_at) * (self.format.fps or CAPTURE_FPS))
+        room = min(self.format.buffer_size or MAX_DRAIN, MAX_DRAIN)
+        # Frames beyond the queue's room were dropped by the driver
+        self.__taken = max(self.__taken, made - room)
+        return made - self.__taken
+
+    def get(self, prop):
+        return self.capture.get(prop)
+
+    def set(self, prop, value):
+        return self.capture.set(prop, value)
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def release(self):
+        self.capture.release()
+
+
+class FrameSource(object):
+    """
+    A recording, played back frame by frame.
+
+    Subclasses provide the frames through _next and _rewind, and set shape
+    to the (height, width) of the frames if they know it. index counts the
+    frames read so far and keeps counting when the recording loops.
+    """
+    live = False
+    shape = None
+
+    def __init__(self, fps=None, loop=False):
+        super(FrameSource, self).__init__()
+        self.fps = fps
+        self.loop = loop
+        self.index = 0
+        self.grab_time = None
+        self.__due = None
+
+    @property
+    def frame_count(self):
+        """Frames in the recording, or 0 if unknown."""
+        return 0
+
+    def read(self, image=None):
+        """
+        The next frame, decoded into image if it is given and the right shape.
+
+        :return: (True, frame), or (False, None) once the recording has run out
+        """
+        self.__pace()
+        self.grab_time = time()
+        img = self._next(image)
+        if img is None and self.loop and self.index:
+            self._rewind()
+            img = self._next(image)
+        if img is None:
+            return False, None
+        if image is not None and img is not image and image.shape == img.shape:
+            np.copyto(image, img)
+            img = image
+        self.index += 1
+        return True, img
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FPS:
+            return float(self.fps or 0)
+        if prop == cv2.CAP_PROP_FRAME_COUNT:
+            return float(self.frame_count)
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return float(self.index)
+        if prop == cv2.CAP_PROP_FRAME_WIDTH and self.shape is not None:
+            return float(self.shape[1])
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT and self.shape is not None:
+            return float(self.shape[0])
+        return 0.
+
+    def set(self, prop, value):
+        """A recording's format is what it is."""
+        return False
+
+    def isOpened(self):
+        return True
+
+    def release(self):
+        pass
+
+    def _next(self, image):
+        """The next frame, or None at the end of the recording."""
+        raise NotImplementedError
+
+    def _rewind(self):
+        raise NotImplementedError
+
+    def __pace(self):
+        """Hold each frame back until it is due, when playing at a set fps."""
+        if not self.fps:
+            return
+        now = time()
+        if self.__due is not None and now < self.__due:
+            sleep(self.__due - now)
+        self.__due = max(now, self.__due or now) + 1. / self.fps
+
+
+class VideoSource(FrameSource):
+    """A video file."""
+
+    def __init__(self, path, fps=None, loop=False):
+        super(VideoSource, self).__init__(fps, loop)
+        self.path = path
+        self.__capture = None
+        self.shape = (int(self.capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                      int(self.capture.get(cv2.CAP_PROP_FRAME_WIDTH)))
+
+    def __getstate__(self):
+        # Reopened on the other side, a VideoCapture doesn't pickle
+        state = self.__dict__.copy()
+        state['_VideoSource__capture'] = None
+        return state
+
+    @property
+    def capture(self):
+        if self.__capture is None:
+            self.__capture = cv2.VideoCapture(self.path)
+            assert self.__capture.isOpened(), "Can't open video {}".format(self.path)
+        return self.__capture
+
+    @property
+    def frame_count(self):
+        return int(self.capture.get(cv2.CAP_PROP_FRAME_COUNT))
+
+    @property
+    def native_fps(self):
+        """The frame rate the video was recorded at."""
+        return self.capture.get(cv2.CAP_PROP_FPS)
+
+    def release(self):
+        if self.__capture is not None:
+            self.__capture.release()
+            self.__capture = None
+
+    def _next(self, image):
+        ret, img = self.capture.read(image=image)
+        return img if ret else None
+
+    def _rewind(self):
+        self.capture.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+
+class ImageSequence(FrameSource):
+    """
+    A directory of images, played in natural order (frame2 before frame10).
+
+    Gray images come out as BGR, like camera frames. Images of a different
+    size than the first are skipped, and counted in skipped.
+    """
+
+    def __init__(self, directory, pattern='*.png', fps=None, loop=False):
+        super(ImageSequence, self).__init__(fps, loop)
+        self.directory = directory
+        self.files = sorted(glob(os.path.join(directory, pattern)), key=self.__natural_key)
+        assert self.files, "No {} images in {}".format(pattern, directory)
+        self.skipped = 0
+        self.__shape = None
+        self.__pos = 0
+        first = cv2.imread(self.files[0], cv2.IMREAD_COLOR)
+        if first is not None:
+            self.__shape = first.shape
+            self.shape = first.shape[:2]
+
+    @property
+    def frame_count(self):
+        return len(self.files)
+
+    def _next(self, image):
+        while self.__pos < len(self.files):
+            img = cv2.imread(self.files[self.__pos], cv2.IMREAD_COLOR)
+            self.__pos += 1
+            if img is None:
+                self.skipped += 1
+                continue
+            if self.__shape is None:
+                self.__shape = img.shape
+            if img.shape != self.__shape:
+                self.skipped += 1
+                continue
+            return img
+        return None
+
+    def _rewind(self):
+        self.__pos = 0
+
+    @staticmethod
+    def __natural_key(path):
+        return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', os.path.basename(path))]
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+"""
+Smoothed position and velocity of the tensegrity.
+
+A PositionFilter is a constant velocity Kalman filter over the positions a
+tracker measures. Every frame either corrects the state with the measured
+position or, when detection failed, only predicts it, so a lost robot shows
+up as a growing covariance instead of a stale position that looks fresh.
+
+Each state is kept with the time of its frame, so the position at any time
+in the recent past can be looked up, for instance exactly when a trial
+started and when it ended, rather than whenever the learner got around to
+asking. States are kept for the last history seconds, not a number of
+frames, so how far back that reaches doesn't depend on the frame rate.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+from threading import Lock
+
+import numpy as np
+
+MEASUREMENT_NOISE = 2.0  # standard deviation of a detected position, in pixels
+ACCEL_NOISE = 50.0  # standard deviation of the unmodelled acceleration, in pixels/s^2
+INITIAL_SPEED = 100.0  # standard deviation of the velocity before it has been measured, in pixels/s
+RESET_GATE = 50.0  # squared Mahalanobis distance of a measurement at which the robot counts as moved by hand
+HISTORY = 180.0  # seconds of states kept for position_at, longer than a trial (30 s running, 120 s to finish)
+
+# position and velocity are tuples (or whatever point type the filter was
+# given), covariance is the 2n x 2n covariance of [position, velocity]
+KalmanState = namedtuple('KalmanState', ['time', 'position', 'velocity', 'covariance', 'measured'])
+
+
+class PositionFilter(object):
+    """
+    Constant velocity Kalman filter over n-dimensional positions.
+
+    Feed it with update() for every frame the tracker found the robot in and
+    miss() for every frame it didn't. It is safe to query from other threads
+    while the tracker feeds it. Positions come out as tuples, or as point
+    (a namedtuple class such as Point) if given.
+
+    A measurement too far from the prediction to be explained by the model
+    (the robot was picked up and put back, say) restarts the filter at the
+    measured position rather than dragging the estimate over.
+    """
+
+    def __init__(self, measurement_noise=MEASUREMENT_NOISE, accel_noise=ACCEL_NOISE,
+                 initial_speed=INITIAL_SPEED, reset_gate=RESET_GATE, history=HISTORY, point=None):
+        super(PositionFilter, self).__init__()
+        self.measurement_noise = measurement_noise
+        self.accel_noise = accel_noise
+        self.initial_speed = initial_speed
+        self.reset_gate = reset_gate
+        self.resets = 0
+        self.history = history
+        self.point = point
+        self.__lock = Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget the state and its history."""
+        with self.__lock:
+            self.__x = None
+            self.__P = None
+            self.__t = None
+            self.__states = []
+            self.__times = []
+
+    @property
+    def state(self):
+        """The newest KalmanState, or None before the first measurement."""
+        with self.__lock:
+            return self.__states[-1] if self.__states else None
+
+    def update(self, t, measured):
+        """
+        Correct the state with a position measured at time t.
+
+        :return: The new KalmanState
+        """
+        z = np.asarray(measured, dtype=float)
+        n = len(z)
+        with self.__lock:
+            if self.__x is None:
+                self.__start(t, z)
+                return self.__record(True)
+            self.__predict(t)
+            H = np.hstack([np.eye(n), np.zeros((n, n))])
+            R = np.eye(n) * self.measurement_noise ** 2
+            S = H.dot(self.__P).dot(H.T) + R
+            S_inv = np.linalg.inv(S)
+            innovation = z - H.dot(self.__x)
+            if innovation.dot(S_inv).dot(innovation) > self.reset_gate:
+                self.resets += 1
+                self.__start(t, z)
+                return self.__record(True)
+            K = self.__P.dot(H.T).dot(S_inv)
+            self.__x = self.__x + K.dot(innovation)
+            self.__P = (np.eye(2 * n) - K.dot(H)).dot(self.__P)
+            return self.__record(True)
+
+    def miss(self, t):
+        """
+        Advance the state to time t without a measurement.
+
+        :return: The predicted KalmanState, or None before the first measurement
+        """
+        with self.__lock:
+            if self.__x is None:
+                return None
+            self.__predict(t)
+            return self.__record(False)
+
+    def predict(self, t):
+        """The state extrapolated to time t, leaving the filter as it is."""
+        with self.__lock:
+            if self.__x is None:
+                return None
+            x, P = self.__extrapolate(self.__x, self.__P, t - self.__t)
+            return self.__state(t, x, P, False)
+
+    def position_at(self, t):
+        """
+        The filtered position at time t.
+
+        Between two states the position is interpolated, after the newest one
+        it is extrapolated with the newest velocity.
+        :return: A position, or None before the first measurement and for
+                 times older than the history kept
+        """
+        with self.__lock:
+            if not self.__states:
+                return None
+            i = bisect_right(self.__times, t)
+            if i == 0:
+                # Before the oldest state kept
+                return None
+            if i == len(self.__states):
+                x, _ = self.__extrapolate(self.__x, self.__P, t - self.__t)
+                return self.__point(x[:len(x) // 2])
+            before, after = self.__states[i - 1], self.__states[i]
+            span = after.time - before.time
+            w = (t - before.time) / span if span > 0 else 1.
+            return self.__point([b + w * (a - b) for b, a in zip(before.position, after.position)])
+
+    def __start(self, t, z):
+        """Start over at measured position z, not knowing the velocity."""
+        n = len(z)
+        self.__x = np.concatenate([z, np.zeros(n)])
+        self.__P = np.diag([self.measurement_noise ** 2] * n + [self.initial_speed ** 2] * n)
+        self.__t = max(t, self.__t) if self.__t is not None else t
+
+    def __predict(self, t):
+        """Move the state forward to time t."""
+        self.__x, self.__P = self.__extrapolate(self.__x, self.__P, t - self.__t)
+        self.__t = max(t, self.__t)
+
+    def __extrapolate(self, x, P, dt):
+        dt = max(dt, 0.)
+        n = len(x) // 2
+        I = np.eye(n)
+        F = np.block([[I, dt * I], [np.zeros((n, n)), I]])
+        Q = self.accel_noise ** 2 * np.block([[dt ** 4 / 4 * I, dt ** 3 / 2 * I],
+                                              [dt ** 3 / 2 * I, dt ** 2 * I]])
+        return F.dot(x), F.dot(P).dot(F.T) + Q
+
+    def __state(self, t, x, P, measured):
+        n = len(x) // 2
+        return KalmanState(t, self.__point(x[:n]), self.__point(x[n:]), P.copy(), measured)
+
+    def __point(self, values):
+        values = [float(v) for v in values]
+        return tuple(values) if self.point is None else self.point(*values)
+
+    def __record(self, measured):
+        """Add the current state to the history and return it."""
+        state = self.__state(self.__t, self.__x, self.__P, measured)
+        self.__states.append(state)
+        self.__times.append(self.__t)
+        old = bisect_right(self.__times, self.__t - self.history)
+        if old:
+            del self.__states[:old]
+            del self.__times[:old]
+        return state
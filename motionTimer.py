@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""
+Trial timing driven by what the robot is actually doing.
+
+Trials used to be timed with fixed sleeps long enough for the slowest case.
+A MotionTimer watches the tracker's position instead and ends a wait once the
+robot has stayed within still_radius pixels for still_window seconds (and,
+if given, once the struts report they are finished), never waiting longer
+than the nominal duration.
+"""
+
+from collections import namedtuple
+from math import sqrt
+from time import sleep, time
+
+STILL_WINDOW = 1.0  # seconds the robot has to stay put to count as at rest
+STILL_RADIUS = 4.0  # pixels of tracker jitter tolerated while at rest
+MOTION_POLL = 0.1  # seconds between position samples
+
+MotionWait = namedtuple('MotionWait', ['elapsed', 'reason'])
+
+STILL = 'still'
+CAPPED = 'capped'
+
+
+class MotionTimer(object):
+    """
+    Waits for the robot to come to rest, up to a nominal duration.
+
+    Positions the tracker cannot find (negative coordinates) are skipped, so
+    a lost track never counts as stillness. Positions are the tracker's
+    pixel_position, so still_radius is in pixels even for a metric tracker.
+    """
+
+    def __init__(self, tracker, still_window=STILL_WINDOW, still_radius=STILL_RADIUS, poll_interval=MOTION_POLL):
+        super(MotionTimer, self).__init__()
+        self.tracker = tracker
+        self.still_window = still_window
+        self.still_radius = still_radius
+        self.poll_interval = poll_interval
+        self.last_wait = None
+
+    def wait(self, max_time, finished=None, min_time=0.):
+        """
+        Block until the robot is at rest or max_time seconds have passed.
+
+        :param finished: Optional callable, the wait can only end early once it returns True
+        :param min_time: Seconds to wait before rest is looked for at all
+        :return: A MotionWait with the time waited and why it ended
+        """
+        start = time()
+        anchor = None
+        anchor_time = start
+        while True:
+            now = time()
+            if now - start >= max_time:
+                self.last_wait = MotionWait(now - start, CAPPED)
+                return self.last_wait
+            pos = self.tracker.pixel_position
+            if pos.x >= 0 and pos.y >= 0:
+                if anchor is None or sqrt((pos.x - anchor.x) ** 2 + (pos.y - anchor.y) ** 2) > self.still_radius:
+                    anchor, anchor_time = pos, now
+                elif (now - anchor_time >= self.still_window and now - start >= min_time and
+                      (finished is None or finished())):
+                    self.last_wait = MotionWait(now - start, STILL)
+                    return self.last_wait
+            sleep(min(self.poll_interval, max(max_time - (now - start), 0)))
@@ -1,30 +1,175 @@
 #!/usr/bin/python
 # Written by James Boggs
 
+import asyncio
+import signal
 import sys
-from subprocess import Popen, PIPE, call, check_output, CalledProcessError
-from threading import Thread
-from time import sleep
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Thread, Condition, Event, Lock
+from time import sleep, time
 
 import cv2
 
+from motionTimer import MotionTimer
+from tensTelemetry import TensTelemetry
 from tensTracking import TensTracker, Point
+from tensTransport import DEFAULT_POOL, StrutTransportError
+from strutWatchdog import StrutWatchdog
 
 ERROR_CODES = {0: 'Success', 1: 'Failure'}
 EXP_FIN_SIG = [255, 255]  # signal that the experiment finished
 EXP_FIN_SIG_BIG = [255, 255, 0, 0]
 RESTART_SIGNALS = [[1, 1, 0], [0, 0, 0], [1, 0, 0], [1, 1, 1]]
 
+STRUT_TIMEOUT = 15.0  # seconds a strut gets to confirm a start/stop/startup
+FINISH_TIMEOUT = 120.0  # seconds a strut gets to report its experiment is over
+NOTIFY_POLL_INTERVAL = 5.0  # safety read while waiting on notifications
+LINK_WAIT = 5.0  # seconds a failed request waits for the watchdog to reconnect
+STOP_TIMEOUT = 2.0  # seconds every strut gets to confirm an emergency stop
+STOP_RETRY = 0.05  # seconds between stop writes to a strut whose link fails
+
+StrutStatus = namedtuple('StrutStatus', ['motorNum', 'btAddr', 'ok', 'sd_shield', 'file_open', 'accelerometer',
+                                         'rssi', 'latency', 'error'])
+
+
+class StrutStartupError(StrutTransportError):
+    """Raised when struts fail their startup check. Carries the whole status table."""
+
+    def __init__(self, message, statuses):
+        super(StrutStartupError, self).__init__(message)
+        self.statuses = statuses
+
+
+def experiment_over(report):
+    """True if a report is the finish signal or a strut restart code."""
+    return report[:2] == EXP_FIN_SIG or report in RESTART_SIGNALS
+
+
+def startup_reported(report):
+    """True if a report is a startup triple (or the finish signal)."""
+    return len(report) == 3 or report == EXP_FIN_SIG_BIG
+
 
 class TensegrityMotorController(object):
     """A class to control a single motor on the tensegrity."""
     WRITE_HANDLE = '0x14'
     READ_HANDLE = '0x11'
 
-    def __init__(self, btAddr):
+    def __init__(self, btAddr, pool=None):
         super(TensegrityMotorController, self).__init__()
         self.btAddr = btAddr
         self.runSpeed = 0
+        self.pool = pool if pool is not None else DEFAULT_POOL
+        self.notifying = False
+        self.last_report = None
+        self.last_report_time = None
+        self.report_seq = 0  # counts reports, so a wait can tell those after it started
+        self.watchdog = None
+        self.__report_cond = Condition()
+
+    @property
+    def session(self):
+        """The pooled connection shared by everything talking to this strut."""
+        return self.pool.get(self.btAddr)
+
+    def start_watchdog(self, interval=2.0):
+        """
+        Supervise this strut's link in the background.
+
+        Once the watchdog runs, a dropped link is reconnected as soon as it
+        is noticed rather than when the next request needs it.
+        :return: The StrutWatchdog
+        """
+        if self.watchdog is None:
+            self.watchdog = StrutWatchdog(self, interval)
+        self.watchdog.start()
+        return self.watchdog
+
+    def ensure_link(self, timeout=LINK_WAIT):
+        """
+        Make sure the link is up before a trial needs it.
+
+        With a watchdog running this only waits for its reconnect, otherwise it
+        connects here.
+        :return: True if the link is up
+        """
+        if self.watchdog is not None:
+            return self.watchdog.wait_until_up(timeout)
+        try:
+            self.session.connect(timeout)
+        except StrutTransportError as e:
+            print(e)
+            return False
+        return True
+
+    def enable_notifications(self):
+        """
+        Subscribe to the read handle so the strut pushes its reports.
+
+        The session turns the subscription back on after a reconnect, so
+        once it is set up there is nothing left to do.
+        :return: True if the subscription was set up, False if we have to poll
+        """
+        if self.notifying:
+            return True
+        try:
+            self.session.subscribe(TensegrityMotorController.READ_HANDLE, self.__on_report)
+        except StrutTransportError as e:
+            print(e)
+            return False
+        self.notifying = True
+        return True
+
+    def wake_waiters(self):
+        """Wake every wait_for_report, so those whose cancel Event is set return."""
+        with self.__report_cond:
+            self.__report_cond.notify_all()
+
+    def __on_report(self, report):
+        if self.watchdog is not None:
+            self.watchdog.record_ok()
+        with self.__report_cond:
+            self.last_report = report
+            self.last_report_time = time()
+            self.report_seq += 1
+            self.__report_cond.notify_all()
+
+    def wait_for_report(self, predicate, timeout=None, poll_interval=1.0, cancel=None):
+        """
+        Block until the strut reports a value for which predicate is true.
+
+        With notifications enabled the wait is woken by each pushed report, and
+        the strut is only read every NOTIFY_POLL_INTERVAL seconds in case one
+        is lost. Without them the strut is read every poll_interval seconds.
+        Only reports that arrive after the wait started count, and several
+        waits on one strut can run at once.
+
+        :param cancel: An Event that ends the wait once set, see wake_waiters
+        :return: The matching report, or None if timeout seconds pass (or the
+                 wait is cancelled) first
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self.__report_cond:
+            since = self.report_seq
+        while True:
+            try:
+                self.__on_report(self.read_data())
+            except StrutTransportError as e:
+                print(e)
+            next_read = time() + (NOTIFY_POLL_INTERVAL if self.notifying else poll_interval)
+            with self.__report_cond:
+                while True:
+                    if self.report_seq > since and predicate(self.last_report):
+                        return self.last_report
+                    now = time()
+                    if (deadline is not None and now >= deadline) or (cancel is not None and cancel.is_set()):
+                        return None
+                    if now >= next_read:
+                        break
+                    wake = next_read if deadline is None else min(next_read, deadline)
+                    self.__report_cond.wait(wake - now)
 
     def start_experiment(self, value=30, verbose=True):
         """
@@ -44,60 +189,94 @@ class TensegrityMotorController(object):
         if verbose:
             print(report)
 
-    def check_experiment_over(self):
+    def probe(self, timeout=STRUT_TIMEOUT, motorNum=None):
+        """
+        Check the strut answers and collect its startup diagnostics.
+
+        Connects, subscribes to the strut's reports, times one read and waits
+        (until timeout) for the startup triple if the strut has not sent it
+        yet. A strut that has already finished an experiment counts as healthy
+        but has no startup codes.
+
+        :return: A StrutStatus
+        """
+        deadline = time() + timeout
+
+        def status(ok, report=(None, None, None), latency=None, error=None):
+            rssi = self.session.rssi() if ok else None
+            return StrutStatus(motorNum, self.btAddr, ok, report[0], report[1], report[2], rssi, latency, error)
+
+        try:
+            self.session.connect(timeout)
+        except StrutTransportError as e:
+            return status(False, error=str(e))
+        self.enable_notifications()
+        t0 = time()
+        try:
+            report = self.read_data()
+        except StrutTransportError as e:
+            return status(False, error=str(e))
+        latency = time() - t0
+        if not startup_reported(report):
+            report = self.wait_for_report(startup_reported, max(deadline - time(), 0))
+            if report is None:
+                return status(False, latency=latency, error="no startup report")
+        if report == EXP_FIN_SIG_BIG:
+            return status(True, latency=latency)
+        return status(True, report, latency)
+
+    def check_experiment_over(self, timeout=None, cancel=None):
         """
         Make sure the current experiment has ended.
 
         The strut will signal 0xffff when its experiment is over. Note that this
         is a BLOCKING function. It will not return until the strut signals the
-        experiment is really over.
+        experiment is really over, until timeout seconds have passed or until
+        cancel is set.
+
+        :return: The finishing report, or None on timeout
         """
-        response = self.read_data()
-        resp_data = response[:2]
-        while resp_data != EXP_FIN_SIG and response not in RESTART_SIGNALS:
-            # print("Watiting for experiment over on {}: {}/{}".format(self.btAddr, resp_data, response))
-            sleep(1)
-            response = self.read_data()
-            resp_data = response[:2]
-
-    def write_data(self, data):
-        """Send data to the RFDuino using gatttool."""
-        data = hex_pad(data)
-        # print("Writing data {}".format(data))
-        gatttoolArgs = ['gatttool',
-                        '--device={}'.format(self.btAddr),
-                        '--char-write-req',
-                        '--handle={}'.format(TensegrityMotorController.WRITE_HANDLE),
-                        '--value={}'.format(data),
-                        '--addr-type=random',
-                        '>>',
-                        'dump.txt'
-                        ]
-        try:
-            result = call(gatttoolArgs)
-        except CalledProcessError as e:
-            print(e)
-            return "ERROR"
-        return result
+        return self.wait_for_report(experiment_over, timeout, cancel=cancel)
+
+    def write_data(self, data, deadline=None):
+        """
+        Send data to the RFDuino over the strut's transport.
+
+        :param deadline: A time() by which the write gives up, waits for the link included
+        :raises StrutTransportError: if the strut cannot be reached (see read_data)
+        """
+        self.__request(self.session.write, TensegrityMotorController.WRITE_HANDLE, encode_value(data),
+                       deadline=deadline)
+        return 0
 
     def read_data(self):
-        """Read data sent from the RFDuino using gatttool."""
-        gatttoolArgs = ['gatttool',
-                        '--device={}'.format(self.btAddr),
-                        '--char-read',
-                        '-a',
-                        str(TensegrityMotorController.READ_HANDLE),
-                        '--addr-type=random'
-                        ]
-        try:
-            output = check_output(gatttoolArgs).strip()
-        except CalledProcessError as e:
-            print(e)
-            return "ERROR"
-        output = output[33:]  # 33 is the number of characters prior to the response
-        output = output.split(' ')
-        output = [int(o, 16) for o in output if o != '']
-        return output
+        """
+        Read data sent from the RFDuino over the strut's transport.
+
+        If the request fails while a watchdog is running, the read waits up to
+        LINK_WAIT seconds for the watchdog's reconnect and is tried once more.
+        :return: The report as a list of ints
+        :raises StrutTransportError: if the strut still cannot be read
+        """
+        return self.__request(self.session.read, TensegrityMotorController.READ_HANDLE)
+
+    def __request(self, request, *args, **kwargs):
+        deadline = kwargs.get('deadline')
+        for attempt in range(2):
+            t0 = time()
+            try:
+                res = request(*args, **kwargs)
+            except StrutTransportError as e:
+                if self.watchdog is None:
+                    raise
+                self.watchdog.record_failure(e)
+                link_wait = LINK_WAIT if deadline is None else min(LINK_WAIT, deadline - time())
+                if attempt == 1 or link_wait <= 0 or not self.watchdog.wait_until_up(link_wait):
+                    raise StrutTransportError("{} unreachable: {}".format(self.btAddr, e))
+                continue
+            if self.watchdog is not None:
+                self.watchdog.record_ok(time() - t0)
+            return res
 
     def run_motor(self, speed):
         """Run the motor at the given speed."""
@@ -112,19 +291,277 @@ class TensegrityMotorController(object):
             sleep(1)
 
 
+class AsyncTensegrityMotorController(object):
+    """
+    An asyncio view of a single TensegrityMotorController.
+
+    Reads and writes still go through the blocking controller, but they run on
+    an executor so that the operations for different struts overlap.
+    """
+
+    def __init__(self, motor, executor=None):
+        super(AsyncTensegrityMotorController, self).__init__()
+        self.motor = motor
+        self.executor = executor
+
+    @property
+    def btAddr(self):
+        return self.motor.btAddr
+
+    async def write_data(self, data):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(self.motor.write_data, data))
+
+    async def read_data(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.motor.read_data)
+
+    async def start_experiment(self, value=30, verbose=True):
+        """Send the start value and wait until the strut echoes it back."""
+        await self.write_data(value)
+        report = await self.read_data()
+        while len(report) >= 1 and report[0] != value:
+            if verbose:
+                print("Waiting on start confirm. {}".format(report))
+            await asyncio.sleep(0.5)
+            await self.write_data(value)
+            report = await self.read_data()
+        if verbose:
+            print(report)
+        return report
+
+    async def wait_for_report(self, predicate, timeout, cancel=None):
+        """Wait on the strut's pushed (or polled) reports without blocking the loop."""
+        loop = asyncio.get_event_loop()
+        report = await loop.run_in_executor(self.executor,
+                                            partial(self.motor.wait_for_report, predicate, timeout, cancel=cancel))
+        if report is None:
+            raise asyncio.TimeoutError()
+        return report
+
+    async def check_experiment_over(self, timeout=FINISH_TIMEOUT, cancel=None):
+        """Wait until the strut signals 0xffff or reports it restarted."""
+        return await self.wait_for_report(experiment_over, timeout, cancel)
+
+    async def probe(self, timeout=STRUT_TIMEOUT, motorNum=None):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(self.motor.probe, timeout, motorNum))
+
+    async def enable_notifications(self):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.motor.enable_notifications)
+
+
+class AsyncTensegrity(object):
+    """
+    Issues start, poll and stop operations to every strut at once.
+
+    Each strut's operation runs under its own timeout. If any strut fails or
+    times out, a StrutTransportError naming the failed struts is raised once
+    all of them have finished or timed out.
+    """
+
+    def __init__(self, motors, timeout=STRUT_TIMEOUT):
+        super(AsyncTensegrity, self).__init__()
+        self.motors = motors  # shared with the owning Tensegrity
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max(4, 2 * len(motors)))
+
+    def __len__(self):
+        return len(self.motors)
+
+    def controllers(self):
+        return [AsyncTensegrityMotorController(motor, self.executor) for motor in self.motors]
+
+    async def gather(self, coros, timeout=None):
+        """Run one coroutine per strut concurrently, each under a timeout."""
+        timeout = self.timeout if timeout is None else timeout
+        results = await asyncio.gather(*[asyncio.wait_for(c, timeout) for c in coros],
+                                       return_exceptions=True)
+        failed = ["{} ({})".format(motor.btAddr, "timed out" if isinstance(res, asyncio.TimeoutError) else res)
+                  for motor, res in zip(self.motors, results) if isinstance(res, Exception)]
+        if failed:
+            raise StrutTransportError("Struts failed: {}".format(", ".join(failed)))
+        return results
+
+    async def start_experiment(self, value_set, verbose=False, timeout=None):
+        assert len(value_set) == len(self.motors), "# of values should equal # of motors"
+        return await self.gather([ctrl.start_experiment(value, verbose)
+                                  for ctrl, value in zip(self.controllers(), value_set)], timeout)
+
+    async def check_experiment_over(self, timeout=FINISH_TIMEOUT, cancel=None):
+        # The blocking wait gets a slightly shorter timeout so it returns
+        # (freeing its executor thread) before wait_for gives up on it.
+        return await self.gather([ctrl.check_experiment_over(timeout * 0.95, cancel)
+                                  for ctrl in self.controllers()], timeout)
+
+    async def probe(self, deadline=None):
+        """
+        Probe every strut at once under a single deadline.
+
+        Never raises: a strut that fails or does not finish in time gets a
+        StrutStatus with ok False and the reason in error.
+        """
+        deadline = self.timeout if deadline is None else deadline
+        coros = [asyncio.wait_for(ctrl.probe(deadline * 0.9, motorNum), deadline)
+                 for motorNum, ctrl in enumerate(self.controllers())]
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        statuses = []
+        for motorNum, (motor, res) in enumerate(zip(self.motors, results)):
+            if isinstance(res, Exception):
+                reason = "timed out" if isinstance(res, asyncio.TimeoutError) else str(res)
+                res = StrutStatus(motorNum, motor.btAddr, False, None, None, None, None, None, reason)
+            statuses.append(res)
+        return statuses
+
+    async def enable_notifications(self):
+        """Subscribe to every strut's reports. Returns a success flag per strut."""
+        return await self.gather([ctrl.enable_notifications() for ctrl in self.controllers()])
+
+
+StrutStart = namedtuple('StrutStart', ['btAddr', 'value', 'sent', 'acked', 'confirmed', 'ack_latency'])
+StartReport = namedtuple('StartReport', ['fire_time', 'struts', 'skew', 'ok'])
+StrutStop = namedtuple('StrutStop', ['btAddr', 'sent', 'confirmed', 'latency'])
+StopReport = namedtuple('StopReport', ['trigger_time', 'elapsed', 'struts', 'ok', 'reason'])
+
+
+class BroadcastStart(object):
+    """
+    Starts every strut in one tight burst.
+
+    prepare() does everything that can be done ahead of time: it checks the
+    values, makes sure each strut's link is up and parks one thread per strut on a
+    shared event. fire() sets the event, so all the start writes leave together.
+    Each strut then gets a single confirmation pass (no rewrite loop), and the
+    timing of every write is collected into a StartReport.
+
+    A strut's start time is estimated as the midpoint of its write request and
+    the write response. The start skew is the spread of those estimates.
+
+    Every prepare() gets its own event and results list, so a worker that is
+    still waiting on its ack after fire() gave up on it can't write into a
+    later start. cancel() (or the next prepare()) releases workers that were
+    never fired without writing anything.
+    """
+
+    def __init__(self, motors, ack_timeout=STRUT_TIMEOUT):
+        super(BroadcastStart, self).__init__()
+        self.motors = motors
+        self.ack_timeout = ack_timeout
+        self.__go = None
+        self.__cancelled = None
+        self.__workers = []
+        self.__results = []
+
+    def prepare(self, value_set):
+        """Stage each strut's start value and get the workers ready to fire."""
+        assert len(value_set) == len(self.motors), "# of values should equal # of motors"
+        assert all([0 <= val <= 255 for val in value_set]), "All values should be in [0,255]"
+        self.cancel()
+        for motor in self.motors:
+            if not motor.ensure_link():
+                print("{} link is down, its start will need a cold connect".format(motor.btAddr))
+        self.__go = Event()
+        self.__cancelled = Event()
+        self.__results = [None] * len(self.motors)
+        self.__workers = []
+        for i, (motor, value) in enumerate(zip(self.motors, value_set)):
+            worker = Thread(target=self.__start_strut,
+                            args=(i, motor, value, self.__go, self.__cancelled, self.__results))
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def cancel(self):
+        """Release the workers of a prepare() that won't be fired, without starting any strut."""
+        if self.__go is None:
+            return
+        self.__cancelled.set()
+        self.__go.set()
+        self.__go = None
+
+    def fire(self):
+        """Release every staged start at once and wait for the confirmations."""
+        assert self.__go is not None, "prepare() must be called before fire()"
+        fire_time = time()
+        self.__go.set()
+        self.__go = None
+        for worker in self.__workers:
+            worker.join(self.ack_timeout + 1.0)
+        struts = [StrutStart(motor.btAddr, None, None, None, False, None) if res is None else
+                  res._replace(ack_latency=None if res.acked is None else res.acked - fire_time)
+                  for motor, res in zip(self.motors, list(self.__results))]
+        starts = [(s.sent + s.acked) / 2. for s in struts if s.acked is not None]
+        skew = max(starts) - min(starts) if starts else None
+        return StartReport(fire_time, struts, skew, all([s.confirmed for s in struts]))
+
+    def __start_strut(self, i, motor, value, go, cancelled, results):
+        go.wait()
+        if cancelled.is_set():
+            return
+        sent = time()
+        try:
+            motor.write_data(value)
+        except StrutTransportError as e:
+            print(e)
+            results[i] = StrutStart(motor.btAddr, value, sent, None, False, None)
+            return
+        acked = time()
+        report = motor.wait_for_report(lambda r: len(r) >= 1 and r[0] == value, self.ack_timeout)
+        if report is not None:
+            motor.runSpeed = value
+        results[i] = StrutStart(motor.btAddr, value, sent, acked, report is not None, None)
+
+
+def stopped(report):
+    """True if a report shows the motor is not running (zero echoed, finished or restarted)."""
+    return (len(report) >= 1 and report[0] == 0) or experiment_over(report)
+
+
+def run_sync(coro):
+    """
+    Run a coroutine to completion on a private event loop.
+
+    A fresh loop per call means the blocking wrappers can be used from any
+    thread, including several threads at once.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
 class Tensegrity(object):
     """A class to control an entire tensegrity."""
 
-    def __init__(self, btAddrList=[], method=None, tracking_preset=False, camera=1):
+    def __init__(self, btAddrList=[], method=None, tracking_preset=False, camera=1, pool=None, tracker=None,
+                 watchdog=True, arena_stop=True):
         assert type(btAddrList) == list, "Bluetooth address list must be type list"
         super(Tensegrity, self).__init__()
-        self.motors = [TensegrityMotorController(btAddr) for btAddr in btAddrList]
+        self.motors = [TensegrityMotorController(btAddr, pool=pool) for btAddr in btAddrList]
         self.motorNum = len(self.motors)
-        if method:
+        self.async_tens = AsyncTensegrity(self.motors)
+        self.broadcast = BroadcastStart(self.motors)
+        self.last_start = None
+        self.last_stop = None
+        self.telemetry = None
+        self.__stop_lock = Lock()
+        self.__stop_thread = None
+        self.__previous_handlers = {}
+        if tracker is not None:
+            self.tracker = tracker
+        elif method:
             self.tracker = TensTracker(camNum=camera, method=method, preset=tracking_preset)
         else:
             self.tracker = TensTracker(camNum=camera)
+        self.motion_timer = MotionTimer(self.tracker)
         self.startup()
+        if watchdog:
+            for motor in self.motors:
+                motor.start_watchdog()
+        if arena_stop and hasattr(self.tracker, 'on_arena_exit'):
+            self.tracker.on_arena_exit(lambda pos: self.trigger_stop("left the arena at {}".format(pos)))
 
     def __len__(self):
         return self.motorNum
@@ -143,37 +580,129 @@ class Tensegrity(object):
         self.motors.append(motor)
         self.motorNum += 1
 
-    def startup(self):
-        """Check the startup codes when the Tens is stated."""
-        for motorNum in range(self.motorNum):
-            motor = self.motors[motorNum]
-            report = motor.read_data()
-            if report == [255, 255, 0, 0]:
-                return
-            while len(report) != 3:
-                print(report)
-                report = motor.read_data()
-                sleep(1)
-            print("Motor {} Start...".format(motorNum))
-            print("SD Card Shield: {}".format(ERROR_CODES[report[0]]))
-            print("Data File Open: {}".format(ERROR_CODES[report[1]]))
-            print("Accelerometer Start: {}".format(ERROR_CODES[report[2]]))
+    def link_metrics(self):
+        """The watchdog's LinkMetrics for every supervised strut."""
+        return [motor.watchdog.metrics for motor in self.motors if motor.watchdog is not None]
+
+    def start_telemetry(self, capacity=60000):
+        """
+        Start streaming accelerometer data from every strut.
+
+        :param capacity: The number of samples kept per strut
+        :return: The TensTelemetry holding each strut's ring buffer
+        """
+        if self.telemetry is None:
+            self.telemetry = TensTelemetry(self.motors, capacity)
+        try:
+            self.telemetry.start()
+        except StrutTransportError as e:
+            print("Telemetry unavailable: {}".format(e))
+        return self.telemetry
+
+    def startup(self, deadline=STRUT_TIMEOUT):
+        """
+        Check every strut when the Tens is started.
+
+        All struts are probed in parallel under one deadline and the status
+        table is printed. SD shield, data file or accelerometer failures are
+        only reported, but a strut that cannot be reached or never sends its
+        startup report stops the start with a StrutStartupError naming it.
+
+        :return: A list of StrutStatus, one per motor
+        """
+        statuses = run_sync(self.async_tens.probe(deadline))
+        print(format_status_table(statuses))
+        bad = [st for st in statuses if not st.ok]
+        if bad:
+            raise StrutStartupError("Struts failed startup: {}".format(
+                ", ".join(["motor {} {} ({})".format(st.motorNum, st.btAddr, st.error) for st in bad])), statuses)
+        for motor in self.motors:
+            if not motor.notifying:
+                print("{} notifications unavailable, polling instead".format(motor.btAddr))
+        return statuses
+
+    def start_all(self, value_set, verbose=False):
+        """
+        Start every strut together with a prepare-then-fire broadcast.
+
+        :return: A StartReport with each strut's ack latency and the start skew
+        """
+        self.broadcast.prepare(value_set)
+        report = self.broadcast.fire()
+        self.last_start = report
+        if verbose:
+            for strut in report.struts:
+                print("{}: value {} confirmed {} ack {}".format(strut.btAddr, strut.value,
+                                                                 strut.confirmed, strut.ack_latency))
+        if report.skew is not None:
+            print("Start skew: {:.1f} ms".format(report.skew * 1000))
+        if not report.ok:
+            print("WARNING: not every strut confirmed its start: {}".format(
+                [s.btAddr for s in report.struts if not s.confirmed]))
+        return report
 
     def run_experiment(self, value_set=[30], verbose=False, exp_time=10):
-        """Start a single experiment."""
-        for motorNum in range(self.motorNum):
-            self.motors[motorNum].start_experiment(value_set[motorNum], verbose)
-        sleep(exp_time)
+        """
+        Start a single experiment on all struts at once.
+
+        Returns once the struts have finished and the robot is at rest, or
+        after exp_time seconds, whichever comes first.
+        :return: The StartReport of the synchronized start
+        """
+        report = self.start_all(value_set, verbose)
+        self.wait_for_rest(exp_time)
+        return report
 
-    def check_experiment_over(self):
+    def wait_for_rest(self, max_time):
+        """
+        Wait until every strut reports its experiment over and the robot has
+        stopped moving, but no longer than max_time seconds.
+
+        The struts are watched on a thread of their own, which is cancelled
+        and joined before returning, so its waits don't hold on to the shared
+        executor's workers into later trials.
+        :return: The MotionWait from the motion timer
+        """
+        done = Event()
+        cancel = Event()
+        since = time()
+
+        def watch_struts():
+            try:
+                self.check_experiment_over(cancel)
+            except StrutTransportError as e:
+                if not cancel.is_set():
+                    print(e)
+            done.set()
+
+        watcher = Thread(target=watch_struts, args=())
+        watcher.daemon = True
+        watcher.start()
+        try:
+            return self.motion_timer.wait(max_time, finished=lambda: done.is_set() or self.stopped_since(since))
+        finally:
+            cancel.set()
+            for motor in self.motors:
+                motor.wake_waiters()
+            watcher.join()
+
+    def stopped_since(self, t):
+        """True if every motor was confirmed stopped by an all stop triggered after time t."""
+        return self.last_stop is not None and self.last_stop.ok and self.last_stop.trigger_time >= t
+
+    def check_experiment_over(self, cancel=None):
         """
         Make sure the current experiment has ended.
 
         Each strut will signal 0xffff when its experiment is over. We want to
         ensure each strut is sending this signal to ensure the experiment is over.
+        All struts are polled concurrently. If the experiment was cut short by
+        an all stop, there is nothing left to wait for.
+        :param cancel: An Event that gives up the wait once set (and the motors' waiters are woken)
         """
-        for motorNum in range(self.motorNum):
-            self.motors[motorNum].check_experiment_over()
+        if self.last_start is not None and self.stopped_since(self.last_start.fire_time):
+            return
+        run_sync(self.async_tens.check_experiment_over(cancel=cancel))
 
     def run_freq_set(self, freq_list):
         """
@@ -188,13 +717,116 @@ class Tensegrity(object):
         assert len(freq_list) == self.motorNum, "# of frequencies should equal # of motors"
         assert all([type(val) == int for val in freq_list]), "All frequency values should be ints"
         assert all([0 <= val <= 255 for val in freq_list]), "All frequency values should be in [0,255]"
-        for motor in range(self.motorNum):
-            self.motors[motor].start_experiment(value=freq_list[motor], verbose=False)
-        sleep(30)
+        self.start_all(freq_list)
+        self.wait_for_rest(30)
 
     def stop(self):
         """Stop all motion."""
-        self.run_freq_set([0, ] * self.motorNum)
+        return self.emergency_stop(reason="stop")
+
+    def emergency_stop(self, deadline=STOP_TIMEOUT, reason=None):
+        """
+        Stop every motor at once.
+
+        Each strut gets its own thread (not the shared executor, which may be
+        busy waiting on an experiment) that writes speed 0 and waits for the
+        strut to report it stopped. The call returns as soon as every strut
+        has confirmed, or after deadline seconds.
+
+        :return: A StopReport with the time from the call to the last confirmation
+        """
+        trigger = time()
+        results = [None] * self.motorNum
+        workers = []
+        for i, motor in enumerate(self.motors):
+            worker = Thread(target=self.__stop_strut, args=(i, motor, trigger, trigger + deadline, results))
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join(max(trigger + deadline - time(), 0))
+        struts = [res if res is not None else StrutStop(motor.btAddr, None, False, None)
+                  for motor, res in zip(self.motors, results)]
+        ok = all([s.confirmed for s in struts])
+        elapsed = max([s.latency for s in struts]) if ok and struts else time() - trigger
+        report = StopReport(trigger, elapsed, struts, ok, reason)
+        self.last_stop = report
+        if ok:
+            print("All stop{}: every strut stopped in {:.0f} ms".format(
+                "" if reason is None else " ({})".format(reason), elapsed * 1000))
+        else:
+            print("WARNING: all stop{} not confirmed by {}".format(
+                "" if reason is None else " ({})".format(reason), [s.btAddr for s in struts if not s.confirmed]))
+        return report
+
+    def __stop_strut(self, i, motor, trigger, deadline, results):
+        sent = None
+        while time() < deadline:
+            sent = time()
+            try:
+                motor.write_data(0, deadline=deadline)
+            except StrutTransportError as e:
+                print(e)
+                sleep(min(STOP_RETRY, max(deadline - time(), 0)))
+                continue
+            if time() >= deadline:
+                # emergency_stop has reported this strut as unconfirmed
+                break
+            motor.runSpeed = 0
+            if motor.wait_for_report(stopped, max(deadline - time(), 0)) is not None:
+                results[i] = StrutStop(motor.btAddr, sent, True, time() - trigger)
+                return
+        results[i] = StrutStop(motor.btAddr, sent, False, None)
+
+    def trigger_stop(self, reason=None):
+        """
+        Start an emergency stop without waiting for it.
+
+        Safe to call from callbacks that must not block, like the tracker's
+        arena exit. A trigger while a stop is already running is ignored.
+        :return: The thread running the stop
+        """
+        with self.__stop_lock:
+            if self.__stop_thread is None or not self.__stop_thread.is_alive():
+                self.__stop_thread = Thread(target=self.emergency_stop, kwargs={'reason': reason})
+                self.__stop_thread.daemon = True
+                self.__stop_thread.start()
+            return self.__stop_thread
+
+    def install_stop_handlers(self, signums=(signal.SIGINT, signal.SIGTERM)):
+        """
+        Stop every motor when the process gets one of the given signals.
+
+        The previous handler runs after the stop, so Ctrl-C still raises
+        KeyboardInterrupt. Must be called from the main thread.
+        """
+        for signum in signums:
+            self.__previous_handlers[signum] = signal.signal(signum, self.__on_signal)
+
+    def __on_signal(self, signum, frame):
+        self.emergency_stop(reason=signal.Signals(signum).name)
+        previous = self.__previous_handlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+        else:
+            raise SystemExit(128 + signum)
+
+
+def format_status_table(statuses):
+    """Lay out a list of StrutStatus as a table for the console."""
+    def code(c):
+        return '-' if c is None else ERROR_CODES.get(c, c)
+
+    rows = ["{:<6}{:<19}{:<8}{:<11}{:<11}{:<11}{:<6}{}".format(
+        'Motor', 'Address', 'Status', 'SD Card', 'Data File', 'Accel', 'RSSI', 'Latency')]
+    for st in statuses:
+        rows.append("{:<6}{:<19}{:<8}{:<11}{:<11}{:<11}{:<6}{}".format(
+            st.motorNum, st.btAddr, 'OK' if st.ok else 'BAD', code(st.sd_shield), code(st.file_open),
+            code(st.accelerometer), '-' if st.rssi is None else st.rssi,
+            '-' if st.latency is None else "{:.0f} ms".format(st.latency * 1000)))
+        if st.error:
+            rows[-1] += "  ({})".format(st.error)
+    return "\n".join(rows)
 
 
 def hex_pad(data):
@@ -203,6 +835,17 @@ def hex_pad(data):
     return data
 
 
+def encode_value(value):
+    """
+    The bytes a start/speed value is written as.
+
+    Values used to be written with gatttool --value=0x.. (see hex_pad), which
+    gatttool sends as two bytes, 0x00 and then the value. The firmware was
+    written against that, so every transport is handed the same two bytes.
+    """
+    return [0, value]
+
+
 def create_tens(nums, method=None):
     struts = []
     if 0 in nums:
@@ -229,18 +872,18 @@ def create_tens(nums, method=None):
 
 if __name__ == '__main__':
     v = create_tens([5, 6, 9], 2)
+    v.install_stop_handlers()
 
     finished=False
     while not finished:
         freqs = []
         for i in range(len(v)):
-            freqs.append(input("Frequency for motor {} >> ".format(i)))
+            freqs.append(int(input("Frequency for motor {} >> ".format(i))))
 
         startPos = v.tracker.tens_position
         print("Starting at {}".format(startPos))
 
         v.run_experiment(value_set=freqs, verbose=True)
-        sleep(15)
 
         endPos = v.tracker.tens_position
         print("Ending at {}".format(endPos))
@@ -0,0 +1,457 @@
+#!/usr/bin/python
+"""
+Local stand-ins for the RFDuino struts.
+
+An EmulatedRig holds a set of EmulatedStruts that behave like the strut
+firmware, a SessionPool of EmulatedSessions (tensTransport.StrutTransport
+implementations with configurable latency, jitter and loss) and an
+EmulatedTracker that moves the "robot" while the struts run. Handing the rig's
+pool and tracker to Tensegrity (or a LearningMethod) runs the whole control
+stack at full speed without radios or a camera.
+"""
+
+import struct
+import sys
+from collections import namedtuple
+from math import cos, sin, pi
+from random import Random
+from threading import Lock, Thread, Timer
+from time import sleep, time
+from queue import Queue
+
+from kalmanTracker import PositionFilter
+from tensTracking import Point, ARENA_MARGIN
+from tensTransport import StrutTransport, SessionPool, StrutTransportError
+
+READ_HANDLE = 0x11
+WRITE_HANDLE = 0x14
+TELEMETRY_HANDLE = 0x17
+
+FINISH_REPORT = [255, 255, 0, 0]
+RESTART_REPORT = [1, 1, 0]  # SD shield and data file failed, accelerometer fine
+
+BenchmarkResult = namedtuple('BenchmarkResult', ['trials_per_sec', 'start_time', 'finish_overhead', 'skew'])
+
+
+class EmulatedStrut(object):
+    """
+    The strut side of the link, following the RFDuino firmware.
+
+    - Until it is given a start value the strut reports its startup triple
+      (SD shield, data file, accelerometer; 0 is success).
+    - Writing a value echoes it back as [value, 0, 0, 0] and runs the motor
+      at that speed for run_time seconds, after which it reports
+      [255, 255, 0, 0]. A new value replaces the running one, so writing 0
+      stops the motor straight away.
+    - restart() emulates a brown-out: the motor stops, the link drops and the
+      strut reports a startup triple again.
+    - drop_link(outage) emulates the strut going out of range: the link drops
+      and nothing can reach the strut for outage seconds, but the motor keeps
+      running.
+    - With telemetry_rate set, the strut streams telemetry packets (see
+      tensTelemetry) that many times a second while its motor runs, two
+      accelerometer samples per packet, vibrating at a rate set by the speed.
+
+    Every change of report is pushed to the listeners of the current link.
+    """
+
+    def __init__(self, btAddr, startup_report=(0, 0, 0), run_time=1.0, restart_rate=0.0, rng=None,
+                 before_change=None, telemetry_rate=0.0, rssi=-60):
+        super(EmulatedStrut, self).__init__()
+        self.btAddr = btAddr
+        self.startup_report = list(startup_report)
+        self.report = list(startup_report)
+        self.run_time = run_time
+        self.restart_rate = restart_rate  # chance that a run ends in a restart
+        self.rng = rng if rng is not None else Random()
+        self.before_change = before_change
+        self.speed = 0
+        self.epoch = 0  # bumped whenever the strut drops its links
+        self.restarts = 0
+        self.telemetry_rate = telemetry_rate
+        self.rssi = rssi
+        self.listeners = []
+        self.link_drops = 0
+        self.unreachable_until = 0.
+        self.__lock = Lock()
+        self.__run_timer = None
+        self.__runs = 0
+        self.__boot = time()
+
+    @property
+    def running(self):
+        return self.speed != 0
+
+    @property
+    def reachable(self):
+        return time() >= self.unreachable_until
+
+    def on_write(self, handle, data):
+        if handle != WRITE_HANDLE:
+            raise StrutTransportError("Invalid handle {}".format(hex(handle)))
+        value = data[-1]
+        with self.__lock:
+            self.__cancel_run()
+            self.__change(value, [value, 0, 0, 0])
+            if self.rng.random() < self.restart_rate:
+                self.__run_timer = Timer(self.rng.uniform(0, self.run_time), self.restart)
+            else:
+                self.__run_timer = Timer(self.run_time, self.finish)
+            self.__run_timer.daemon = True
+            self.__run_timer.start()
+            self.__runs += 1
+            if self.telemetry_rate > 0:
+                streamer = Thread(target=self.__stream_telemetry, args=(self.__runs,))
+                streamer.daemon = True
+                streamer.start()
+
+    def on_read(self, handle):
+        if handle != READ_HANDLE:
+            raise StrutTransportError("Invalid handle {}".format(hex(handle)))
+        return list(self.report)
+
+    def finish(self):
+        with self.__lock:
+            self.__change(0, FINISH_REPORT)
+
+    def restart(self, report=RESTART_REPORT):
+        with self.__lock:
+            self.__cancel_run()
+            self.restarts += 1
+            self.epoch += 1
+            self.listeners = []
+            self.__change(0, report)
+
+    def drop_link(self, outage=0.0):
+        """Drop every link to the strut and refuse new ones for outage seconds."""
+        with self.__lock:
+            self.link_drops += 1
+            self.epoch += 1
+            self.listeners = []
+            self.unreachable_until = time() + outage
+
+    def __stream_telemetry(self, run):
+        """
+        Push telemetry packets until this run ends.
+
+        Meant to run as a separate thread.
+        """
+        interval = 1. / self.telemetry_rate
+        dt = interval / 2.
+        while self.running and self.__runs == run:
+            t = time() - self.__boot
+            freq = 5. + 45. * self.speed / 255.
+            amp = 8000. * self.speed / 255.
+            samples = []
+            for k in range(2):
+                phase = 2 * pi * freq * (t + k * dt)
+                samples += [int(amp * sin(phase)), int(amp * cos(phase)), 16384]
+            packet = struct.pack('<IH6h', int(t * 1000) & 0xffffffff, int(dt * 1e6), *samples)
+            for listener in list(self.listeners):
+                listener(TELEMETRY_HANDLE, list(bytearray(packet)))
+            sleep(interval)
+
+    def __cancel_run(self):
+        if self.__run_timer is not None:
+            self.__run_timer.cancel()
+            self.__run_timer = None
+
+    def __change(self, speed, report):
+        if self.before_change is not None:
+            self.before_change()
+        self.speed = speed
+        self.report = list(report)
+        for listener in list(self.listeners):
+            listener(READ_HANDLE, list(report))
+
+
+class EmulatedSession(StrutTransport):
+    """
+    A transport to an EmulatedStrut.
+
+    Each request takes latency plus up to jitter seconds. With probability
+    loss a request goes unanswered: it fails after loss_delay seconds (the
+    request timeout by default, as with gatttool) and the link is dropped.
+    While the strut is unreachable (see EmulatedStrut.drop_link) every request
+    and connect attempt fails the same way. Pushed reports are delayed the same way, kept in order, and lost with the
+    same probability.
+    """
+
+    def __init__(self, strut, latency=0.0, jitter=0.0, loss=0.0, loss_delay=None, rng=None):
+        super(EmulatedSession, self).__init__(strut.btAddr)
+        self.strut = strut
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.loss_delay = loss_delay
+        self.rng = rng if rng is not None else Random()
+        self.attempts = 0  # connects tried, whether or not they succeeded
+        self.__epoch = None
+        self.__enabled = set()
+        self.__pushes = Queue()
+        self.__last_due = 0.
+        self.__pusher = Thread(target=self.__deliver_pushes, args=())
+        self.__pusher.daemon = True
+        self.__pusher.start()
+
+    @property
+    def is_connected(self):
+        return self.__epoch is not None and self.__epoch == self.strut.epoch
+
+    def close(self):
+        self._drop()
+
+    def _open(self, timeout):
+        self.attempts += 1
+        self.__delay(timeout)
+        self.__epoch = self.strut.epoch
+        self.__enabled = set()
+
+    def _drop(self):
+        self.__epoch = None
+
+    def rssi(self):
+        return self.strut.rssi + self.rng.randint(-3, 3)
+
+    def _write_once(self, handle, data, timeout):
+        self.__delay(timeout)
+        self.strut.on_write(int(handle, 16), data)
+
+    def _read_once(self, handle, timeout):
+        self.__delay(timeout)
+        return self.strut.on_read(int(handle, 16))
+
+    def _enable(self, handle, indicate):
+        self.__delay(1.0)
+        if self.__on_push not in self.strut.listeners:
+            self.strut.listeners.append(self.__on_push)
+        self.__enabled.add(handle)
+
+    def __delay(self, timeout):
+        if not self.strut.reachable or (self.loss and self.rng.random() < self.loss):
+            sleep(timeout if self.loss_delay is None else min(timeout, self.loss_delay))
+            raise StrutTransportError("No response from {}".format(self.btAddr))
+        sleep(self.latency + self.rng.uniform(0, self.jitter))
+
+    def __on_push(self, handle, value):
+        if handle not in self.__enabled or (self.loss and self.rng.random() < self.loss):
+            return
+        due = max(time() + self.latency + self.rng.uniform(0, self.jitter), self.__last_due)
+        self.__last_due = due
+        self.__pushes.put((due, handle, value))
+
+    def __deliver_pushes(self):
+        """
+        Deliver pushed reports in order once they are due.
+
+        Meant to run as a separate thread.
+        """
+        while True:
+            due, handle, value = self.__pushes.get()
+            wait = due - time()
+            if wait > 0:
+                sleep(wait)
+            self._dispatch(handle, value)
+
+
+class EmulatedTracker(object):
+    """
+    A stand-in for TensTracker driven by the emulated struts.
+
+    Each strut pushes along its own direction (spaced evenly around the
+    circle) in proportion to its speed, so different frequency sets give
+    different, repeatable displacements. Once every strut has been idle for
+    recenter_time seconds the robot is put back in the middle of the arena,
+    as the person running the experiment would. Like TensTracker, it calls
+    the on_arena_exit callbacks when the robot reaches the edge of the frame
+    and keeps a filtered history for position_at, fed whenever it moves.
+    """
+
+    def __init__(self, rig, size=(640, 480), px_per_sec=40.0, recenter_time=5.0):
+        super(EmulatedTracker, self).__init__()
+        self.rig = rig
+        self.size = size
+        self.px_per_sec = px_per_sec
+        self.recenter_time = recenter_time
+        self.arena_margin = ARENA_MARGIN
+        self.__exit_callbacks = []
+        self.__in_arena = True
+        self.__x, self.__y = self.frame_center
+        self.__last_update = time()
+        self.__idle_since = time()
+        self.__lock = Lock()
+        self.kalman = PositionFilter(point=Point)
+
+    @property
+    def frame_center(self):
+        return int(self.size[0] / 2), int(self.size[1] / 2)
+
+    @property
+    def tens_position(self):
+        self.advance()
+        return Point(int(self.__x), int(self.__y))
+
+    @property
+    def pixel_position(self):
+        return self.tens_position
+
+    @property
+    def tens_state(self):
+        self.advance()
+        return self.kalman.state
+
+    def position_at(self, t):
+        pos = self.kalman.position_at(t)
+        if pos is None and self.kalman.state is None:
+            return self.tens_position
+        if pos is None:
+            return None
+        return Point(round(pos.x, 1), round(pos.y, 1))
+
+    def on_arena_exit(self, callback):
+        self.__exit_callbacks.append(callback)
+
+    def advance(self):
+        """Move the robot according to what the struts have been doing."""
+        with self.__lock:
+            now = time()
+            struts = list(self.rig.struts.values())
+            if any([strut.running for strut in struts]):
+                dt = now - self.__last_update
+                for i, strut in enumerate(struts):
+                    angle = 2 * pi * i / len(struts)
+                    step = self.px_per_sec * dt * strut.speed / 255.
+                    self.__x += step * cos(angle)
+                    self.__y += step * sin(angle)
+                self.__idle_since = now
+            elif now - self.__idle_since >= self.recenter_time:
+                self.__x, self.__y = self.frame_center
+            self.__last_update = now
+            m = self.arena_margin
+            inside = m <= self.__x < self.size[0] - m and m <= self.__y < self.size[1] - m
+            exited = self.__in_arena and not inside
+            self.__in_arena = inside
+            pos = Point(int(self.__x), int(self.__y))
+            self.kalman.update(now, (self.__x, self.__y))
+        if exited:
+            for callback in list(self.__exit_callbacks):
+                callback(pos)
+
+
+class EmulatedRig(object):
+    """A bench of emulated struts plus the pool and tracker that go with them."""
+
+    def __init__(self, run_time=1.0, latency=0.0, jitter=0.0, loss=0.0, loss_delay=None,
+                 startup_report=(0, 0, 0), restart_rate=0.0, telemetry_rate=0.0, seed=None, **tracker_kwargs):
+        super(EmulatedRig, self).__init__()
+        self.run_time = run_time
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.loss_delay = loss_delay
+        self.startup_report = startup_report
+        self.restart_rate = restart_rate
+        self.telemetry_rate = telemetry_rate
+        self.rng = Random(seed)
+        self.struts = {}
+        self.pool = SessionPool(self.session)
+        self.tracker = EmulatedTracker(self, **tracker_kwargs)
+
+    def strut(self, btAddr):
+        """The emulated strut at an address, powered up on first use."""
+        if btAddr not in self.struts:
+            self.struts[btAddr] = EmulatedStrut(btAddr, self.startup_report, self.run_time, self.restart_rate,
+                                                self.rng, before_change=self.tracker.advance,
+                                                telemetry_rate=self.telemetry_rate)
+        return self.struts[btAddr]
+
+    def drop_link(self, btAddr, outage=0.0):
+        """Take one strut off the air for outage seconds."""
+        self.strut(btAddr).drop_link(outage)
+
+    def session(self, btAddr):
+        return EmulatedSession(self.strut(btAddr), self.latency, self.jitter, self.loss, self.loss_delay, self.rng)
+
+
+def emulated_pool(latency=0.0, **rig_kwargs):
+    """Create a SessionPool whose sessions talk to fresh EmulatedStruts."""
+    return EmulatedRig(latency=latency, **rig_kwargs).pool
+
+
+def benchmark_transport(motors, requests=100):
+    """
+    Time write/read round trips over the given motor controllers.
+
+    :return: (round trips per second, mean latency in s, worst latency in s)
+    """
+    latencies = []
+    start = time()
+    for i in range(requests):
+        motor = motors[i % len(motors)]
+        t0 = time()
+        motor.write_data(i % 256)
+        motor.read_data()
+        latencies.append(time() - t0)
+    elapsed = time() - start
+    return requests / elapsed, sum(latencies) / len(latencies), max(latencies)
+
+
+def check_reconnect_backoff(outage=4.0):
+    """
+    Count a watchdog's reconnect attempts to a strut out of range for outage seconds.
+
+    Connects to an unreachable emulated strut fail at once, so without the
+    backoff the watchdog would try again and again.
+    :return: (connect attempts during the outage, the most the backoff allows)
+    """
+    from runTens import TensegrityMotorController
+
+    rig = EmulatedRig(loss_delay=0.0)
+    motor = TensegrityMotorController('EM:00', pool=rig.pool)
+    watchdog = motor.start_watchdog()
+    watchdog.wait_until_up(1.0)
+    attempts = motor.session.attempts
+    rig.drop_link('EM:00', outage)
+    watchdog.record_failure(StrutTransportError("link dropped"))
+    sleep(outage)
+    attempts = motor.session.attempts - attempts
+    watchdog.stop()
+    allowed, backoff, waited = 1, watchdog.min_backoff, 0.
+    while waited + backoff < outage:
+        waited += backoff
+        backoff = min(backoff * 2, watchdog.max_backoff)
+        allowed += 1
+    return attempts, allowed
+
+
+def benchmark_control_path(strut_count=3, trials=20, **rig_kwargs):
+    """
+    Run complete trials (start, run, finish) on an emulated tensegrity.
+
+    :return: A BenchmarkResult with trials per second and the mean start time,
+             finish overhead (finish wait beyond the strut run time) and start
+             skew, all in seconds
+    """
+    from runTens import Tensegrity
+
+    rig = EmulatedRig(**rig_kwargs)
+    tens = Tensegrity(['EM:{:02d}'.format(i) for i in range(strut_count)], pool=rig.pool, tracker=rig.tracker)
+    starts, overheads, skews = [], [], []
+    begin = time()
+    for trial in range(trials):
+        freqs = tuple([rig.rng.randint(1, 255) for i in range(strut_count)])
+        t0 = time()
+        report = tens.run_experiment(freqs, exp_time=0)
+        starts.append(time() - t0)
+        tens.check_experiment_over()
+        overheads.append(time() - report.fire_time - rig.run_time)
+        skews.append(report.skew)
+    elapsed = time() - begin
+    return BenchmarkResult(trials / elapsed, sum(starts) / trials, sum(overheads) / trials, sum(skews) / trials)
+
+
+if __name__ == '__main__':
+    latency = float(sys.argv[1]) if len(sys.argv) > 1 else 0.01
+    res = benchmark_control_path(run_time=0.2, latency=latency, jitter=latency / 2.)
+    print("{:.2f} trials/s, start {:.1f} ms, finish overhead {:.1f} ms, skew {:.2f} ms".format(
+        res.trials_per_sec, res.start_time * 1000, res.finish_overhead * 1000, res.skew * 1000))
@@ -0,0 +1,138 @@
+#!/usr/bin/python
+"""
+Link supervision for the struts.
+
+A StrutWatchdog runs beside a TensegrityMotorController and keeps its link
+warm. It tracks when the strut was last heard from, checks an idle link
+with a light read, and reconnects in the background as soon as the link is
+seen to drop. The next trial then finds the link already up instead of
+paying for a cold reconnect.
+"""
+
+from collections import namedtuple
+from threading import Thread, Event, Lock
+from time import time
+
+from tensTransport import StrutTransportError
+
+LinkMetrics = namedtuple('LinkMetrics', ['btAddr', 'up', 'up_for', 'idle_for', 'latency', 'reconnects',
+                                         'failures', 'last_error'])
+
+LATENCY_SMOOTHING = 0.2  # weight of the newest sample in the latency average
+
+
+class StrutWatchdog(object):
+    """
+    Keeps one strut's link alive in the background.
+
+    The controller reports every request to record_ok or record_failure, so
+    the watchdog only sends its own liveness read when the link has been idle
+    for a whole interval. A failed request wakes the watchdog at once. It
+    then reconnects, backing off from min_backoff up to max_backoff seconds
+    while the strut stays unreachable. Callers that need the link wait on
+    wait_until_up.
+    """
+
+    def __init__(self, motor, interval=2.0, min_backoff=0.25, max_backoff=8.0):
+        super(StrutWatchdog, self).__init__()
+        self.motor = motor
+        self.interval = interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.link_up = Event()
+        self.reconnects = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_seen = None
+        self.latency = None
+        self.up_since = None
+        self.__lock = Lock()
+        self.__wake = Event()
+        self.__stopped = False
+        self.__thread = None
+
+    def start(self):
+        if self.__thread is None:
+            self.__stopped = False
+            self.__thread = Thread(target=self.__supervise, args=())
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def stop(self):
+        self.__stopped = True
+        self.__wake.set()
+        self.__thread = None
+
+    def record_ok(self, latency=None):
+        """Note a successful exchange with the strut."""
+        with self.__lock:
+            self.last_seen = time()
+            if latency is not None:
+                self.latency = latency if self.latency is None else \
+                    (1 - LATENCY_SMOOTHING) * self.latency + LATENCY_SMOOTHING * latency
+            if not self.link_up.is_set():
+                self.up_since = self.last_seen
+                self.link_up.set()
+
+    def record_failure(self, error):
+        """Note a failed exchange and wake the watchdog to repair the link."""
+        self.__note_failure(error)
+        self.__wake.set()
+
+    def wait_until_up(self, timeout):
+        """
+        Block until the link is up (or timeout seconds pass).
+
+        :return: True if the link is up
+        """
+        if not self.link_up.is_set():
+            self.__wake.set()
+        return self.link_up.wait(timeout)
+
+    @property
+    def metrics(self):
+        now = time()
+        return LinkMetrics(self.motor.btAddr, self.link_up.is_set(),
+                           None if self.up_since is None else now - self.up_since,
+                           None if self.last_seen is None else now - self.last_seen,
+                           self.latency, self.reconnects, self.failures, self.last_error)
+
+    def __note_failure(self, error):
+        """Note a failed exchange, without waking the watchdog, whose own failures back off."""
+        with self.__lock:
+            self.failures += 1
+            self.last_error = str(error)
+            self.link_up.clear()
+            self.up_since = None
+
+    def __supervise(self):
+        """
+        Check and repair the link until stopped.
+
+        Meant to run as a separate thread.
+        """
+        backoff = self.min_backoff
+        while not self.__stopped:
+            self.__wake.wait(self.interval if self.link_up.is_set() else backoff)
+            self.__wake.clear()
+            if self.__stopped:
+                break
+            session = self.motor.session
+            if not session.is_connected:
+                try:
+                    session.connect()
+                except StrutTransportError as e:
+                    self.__note_failure(e)
+                    backoff = min(backoff * 2, self.max_backoff)
+                    continue
+                self.reconnects += 1
+                backoff = self.min_backoff
+                self.record_ok()
+            elif self.last_seen is None or time() - self.last_seen >= self.interval:
+                t0 = time()
+                try:
+                    session.read(self.motor.READ_HANDLE)
+                except StrutTransportError as e:
+                    self.__note_failure(e)
+                    continue
+                self.record_ok(time() - t0)
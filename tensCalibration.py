@@ -0,0 +1,260 @@
+#!/usr/bin/python
+"""
+The tracker's calibration, kept on disk between runs.
+
+Setting up a TensTracker by hand means confirming the camera, picking the
+colors of both boundary puffballs (and of the tracked puffs) with sliders,
+and waiting for a base image of the empty arena. A CalibrationStore keeps
+what that produced: the camera, the test area corners, the HSV ranges and
+the base image, as calibration.json and base_img.png in a directory.
+
+A stored calibration is only used once check_calibration has matched it
+against a live frame. The boundary puffs have to be where the test area's
+corners were, which also confirms the camera is the same one, pointing the
+same way. The base image has to look like the arena still does. Whatever
+doesn't match is set up by hand again.
+
+Positions can also be reported on the floor, in cm, rather than in pixels.
+A FloorMap undoes the lens distortion (from a calibrate_lens model) and
+projects onto the floor (through a homography from floor points whose
+places in cm are known). The lens model and floor points aren't part of
+the setup by hand, add them to a store with update(). Without them the
+floor is taken to be a plain scale of the frame.
+"""
+
+import json
+import math
+import os
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+from tensDetection import PuffClassifier, blur_gray
+
+CALIBRATION_DIR = 'calibration'
+CALIBRATION_VERSION = 1
+CORNER_TOLERANCE = 10  # pixels a boundary puff may have moved from its corner
+BASE_TOLERANCE = 12  # median gray level difference between the arena and the base image
+CHESSBOARD = (9, 6)  # inner corners of the chessboard calibrate_lens looks for
+
+# frame_shape is the (height, width, channels) of the camera's frames,
+# test_area the ((x0, y0), (x1, y1)) corners, boundary_puffs and puffs are
+# (low, high) HSV ranges and base is the blurred gray base image of the
+# whole frame. lens is the (camera_matrix, dist_coeffs) of calibrate_lens and
+# floor_points are ((x, y) pixel, (x, y) cm) pairs of floor_homography. Any
+# but the first two may be None.
+Calibration = namedtuple('Calibration', ['cam_num', 'frame_shape', 'test_area', 'boundary_puffs', 'puffs', 'base',
+                                         'lens', 'floor_points'])
+
+# Whether the camera and test area, and the base image still hold
+CalibrationCheck = namedtuple('CalibrationCheck', ['test_area', 'base'])
+
+
+class CalibrationStore(object):
+    """A calibration saved in directory."""
+
+    def __init__(self, directory=CALIBRATION_DIR):
+        super(CalibrationStore, self).__init__()
+        self.directory = directory
+        self.path = os.path.join(directory, 'calibration.json')
+        self.base_path = os.path.join(directory, 'base_img.png')
+
+    def load(self):
+        """
+        The saved calibration.
+
+        :return: A Calibration, or None if there is none or it is from an older version
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as cal_file:
+            saved = json.load(cal_file)
+        if saved.get('version') != CALIBRATION_VERSION:
+            print("Ignoring calibration from version {}".format(saved.get('version')))
+            return None
+        base = None
+        if saved['base'] and os.path.exists(self.base_path):
+            base = cv2.imread(self.base_path, cv2.IMREAD_GRAYSCALE)
+        area = saved['test_area']
+        lens = saved.get('lens')
+        if lens is not None:
+            lens = (np.array(lens['camera_matrix'], dtype=np.float64),
+                    np.array(lens['dist_coeffs'], dtype=np.float64))
+        points = saved.get('floor_points')
+        if points is not None:
+            points = [(tuple(pixel), tuple(floor)) for pixel, floor in points]
+        return Calibration(saved['cam_num'], tuple(saved['frame_shape']),
+                           None if area is None else (tuple(area[0]), tuple(area[1])),
+                           self.__ranges(saved['boundary_puffs']), self.__ranges(saved['puffs']), base, lens, points)
+
+    def save(self, calibration):
+        """Save calibration, replacing the saved one in one step so a crash can't leave half of it."""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if calibration.base is not None:
+            cv2.imwrite(self.base_path, calibration.base)
+        saved = {'version': CALIBRATION_VERSION,
+                 'cam_num': calibration.cam_num,
+                 'frame_shape': list(calibration.frame_shape),
+                 'test_area': None if calibration.test_area is None else [list(c) for c in calibration.test_area],
+                 'boundary_puffs': self.__lists(calibration.boundary_puffs),
+                 'puffs': self.__lists(calibration.puffs),
+                 'base': calibration.base is not None,
+                 'lens': None if calibration.lens is None else
+                 {'camera_matrix': calibration.lens[0].tolist(), 'dist_coeffs': calibration.lens[1].tolist()},
+                 'floor_points': None if calibration.floor_points is None else
+                 [[list(pixel), list(floor)] for pixel, floor in calibration.floor_points]}
+        with open(self.path + '.tmp', 'w') as cal_file:
+            json.dump(saved, cal_file, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+    def update(self, **fields):
+        """Change some fields of the saved calibration, e.g. update(lens=calibrate_lens(frames)[:2])."""
+        calibration = self.load()
+        assert calibration is not None, "No calibration in {} to update".format(self.directory)
+        self.save(calibration._replace(**fields))
+
+    def clear(self):
+        """Forget the saved calibration, so the next tracker is set up by hand."""
+        for path in [self.path, self.base_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    @staticmethod
+    def __ranges(ranges):
+        if ranges is None:
+            return None
+        return [(np.array(low, dtype=np.uint8), np.array(high, dtype=np.uint8)) for low, high in ranges]
+
+    @staticmethod
+    def __lists(ranges):
+        if ranges is None:
+            return None
+        return [[[int(v) for v in low], [int(v) for v in high]] for low, high in ranges]
+
+
+def check_calibration(calibration, frame):
+    """
+    Match a calibration against a whole frame from its camera.
+
+    The base image is compared by the median difference over the test area,
+    so a tensegrity already in the arena doesn't fail it, but a change in
+    the lighting does.
+    :return: A CalibrationCheck
+    """
+    if frame is None or frame.shape != calibration.frame_shape or calibration.test_area is None \
+            or calibration.boundary_puffs is None:
+        return CalibrationCheck(False, False)
+    _, found = PuffClassifier(calibration.boundary_puffs).find(frame)
+    if None in found:
+        return CalibrationCheck(False, False)
+    for (center, _), corner in zip(found, calibration.test_area):
+        if math.hypot(center.x - corner[0], center.y - corner[1]) > CORNER_TOLERANCE:
+            return CalibrationCheck(False, False)
+    if calibration.base is None or calibration.base.shape != frame.shape[:2]:
+        return CalibrationCheck(True, False)
+    (x0, y0), (x1, y1) = calibration.test_area
+    diff = cv2.absdiff(blur_gray(frame[y0:y1, x0:x1]), calibration.base[y0:y1, x0:x1])
+    return CalibrationCheck(True, bool(np.median(diff) <= BASE_TOLERANCE))
+
+
+class FloorMap(object):
+    """
+    Where on the floor, in cm, each pixel of the camera's frames is.
+
+    Every pixel is undistorted and projected onto the floor once, up front,
+    so mapping a position is an interpolation between four table entries
+    and frames are never remapped.
+    """
+
+    def __init__(self, frame_size, homography, camera_matrix=None, dist_coeffs=None):
+        """
+        :param frame_size: (width, height) of the whole frame
+        :param homography: From undistorted pixels to cm on the floor
+        """
+        super(FloorMap, self).__init__()
+        wid, hgt = frame_size
+        xs, ys = np.meshgrid(np.arange(wid, dtype=np.float32), np.arange(hgt, dtype=np.float32))
+        pixels = np.stack([xs.ravel(), ys.ravel()], axis=1).reshape(-1, 1, 2)
+        if camera_matrix is not None:
+            pixels = cv2.undistortPoints(pixels, camera_matrix, dist_coeffs, P=camera_matrix)
+        floor = cv2.perspectiveTransform(pixels.astype(np.float64), np.asarray(homography, dtype=np.float64))
+        self.table = floor.reshape(hgt, wid, 2).astype(np.float32)
+
+    def to_floor(self, x, y):
+        """The (x, y) floor position in cm of pixel (x, y) of the whole frame, which needn't be whole."""
+        hgt, wid = self.table.shape[:2]
+        x = min(max(float(x), 0.), wid - 1.)
+        y = min(max(float(y), 0.), hgt - 1.)
+        x0, y0 = int(x), int(y)
+        x1, y1 = min(x0 + 1, wid - 1), min(y0 + 1, hgt - 1)
+        fx, fy = x - x0, y - y0
+        top = self.table[y0, x0] * (1 - fx) + self.table[y0, x1] * fx
+        bottom = self.table[y1, x0] * (1 - fx) + self.table[y1, x1] * fx
+        floor = top * (1 - fy) + bottom * fy
+        return float(floor[0]), float(floor[1])
+
+
+def calibrate_lens(frames, board=CHESSBOARD):
+    """
+    Model the camera's lens from frames of a chessboard held at different places and angles.
+
+    :param board: (columns, rows) of the board's inner corners
+    :return: (camera_matrix, dist_coeffs, rms reprojection error in pixels)
+    """
+    grid = np.zeros((board[0] * board[1], 3), np.float32)
+    grid[:, :2] = np.mgrid[0:board[0], 0:board[1]].T.reshape(-1, 2)
+    object_points, image_points = [], []
+    size = None
+    for frame in frames:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        size = gray.shape[::-1]
+        ret, corners = cv2.findChessboardCorners(gray, board)
+        if not ret:
+            continue
+        criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+        object_points.append(grid)
+        image_points.append(cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria))
+    assert len(image_points) >= 3, "Found the chessboard in only {} frames".format(len(image_points))
+    rms, camera_matrix, dist_coeffs, _, _ = cv2.calibrateCamera(object_points, image_points, size, None, None)
+    return camera_matrix, dist_coeffs, rms
+
+
+def floor_homography(floor_points, lens=None):
+    """
+    The homography from undistorted pixels to the floor.
+
+    :param floor_points: At least four ((x, y) pixel, (x, y) cm) pairs, not three on a line
+    :param lens: (camera_matrix, dist_coeffs) the pixels are undistorted with, if any
+    """
+    assert len(floor_points) >= 4, "A floor homography needs at least 4 points"
+    pixels = np.array([pixel for pixel, _ in floor_points], dtype=np.float32).reshape(-1, 1, 2)
+    floor = np.array([cm for _, cm in floor_points], dtype=np.float32).reshape(-1, 1, 2)
+    if lens is not None:
+        pixels = cv2.undistortPoints(pixels, lens[0], lens[1], P=lens[0])
+    homography, _ = cv2.findHomography(pixels, floor)
+    return homography
+
+
+def scale_homography(origin, pix_per_cm):
+    """The homography of a camera straight above the floor, pix_per_cm pixels to the cm from pixel origin."""
+    return np.array([[1. / pix_per_cm, 0., -origin[0] / float(pix_per_cm)],
+                     [0., 1. / pix_per_cm, -origin[1] / float(pix_per_cm)],
+                     [0., 0., 1.]])
+
+
+def floor_map(frame_size, origin, pix_per_cm, calibration=None):
+    """
+    The FloorMap of a calibration's lens and floor points.
+
+    Without floor points the floor is a scale of pix_per_cm from pixel origin.
+    """
+    lens = calibration.lens if calibration is not None else None
+    if calibration is not None and calibration.floor_points:
+        homography = floor_homography(calibration.floor_points, lens)
+    else:
+        homography = scale_homography(origin, pix_per_cm)
+    if lens is None:
+        return FloorMap(frame_size, homography)
+    return FloorMap(frame_size, homography, lens[0], lens[1])
@@ -0,0 +1,382 @@
+#!/usr/bin/python
+"""
+Finding the tensegrity in a camera frame.
+
+The detectors take an image (and, for background subtraction, the matching
+part of the base image) and return a Detection, or None when there is no
+tensegrity to be found. They don't draw or keep any state, so they can run
+on a window of the frame as well as on the whole of it. offset is the
+position of the image's corner in the frame, and every coordinate in a
+Detection is in frame coordinates.
+
+The robot only moves a few pixels between frames, so a WindowedSearch runs
+a detector on a window around the last position and only scans the whole
+frame when the window loses the robot.
+
+Background subtraction compares frames with a BackgroundModel, which follows
+slow lighting changes in the arena instead of holding on to the image taken
+at startup.
+
+The pyramid detectors find the tensegrity on a shrunk copy of the image
+first, and then run the full resolution detector on only a patch around it.
+The patch is wide enough for the detector's blurs, so for the blob the
+coarse search picked the result is the full resolution one. With several
+dark blobs of about the same size, shrinking can make the coarse search
+pick a different blob than a full resolution search of the whole image
+would.
+"""
+
+from collections import namedtuple
+
+import cv2
+import numpy as np
+
+Point = namedtuple('Point', ['x', 'y'])
+
+# center: the tensegrity's centroid
+# contours: the contours found, best: index of the tensegrity's among them
+# bounds: (x, y, w, h) box around everything the detection was based on
+# points: the puff centers for the puff detector, otherwise empty
+Detection = namedtuple('Detection', ['center', 'contours', 'best', 'bounds', 'points'])
+
+RoiStats = namedtuple('RoiStats', ['frames', 'windowed', 'fallbacks', 'lost'])
+
+BLUR_SIZE = 7
+WHITE_BLUR_SIZE = 64
+
+BACKGROUND_RATE = 0.05  # weight of each refresh of a background pixel
+BACKGROUND_BANDS = 8  # horizontal bands of the background, one is refreshed per frame
+BACKGROUND_MARGIN = 20  # pixels around the robot left out of background refreshes
+
+PYRAMID_LEVELS = 2  # halvings of the image the pyramid detectors' coarse search runs on
+
+ROI_RADIUS = 80  # half the side of the search window in pixels
+ROI_EDGE = 2  # pixels from the window edge at which a detection may be cut off
+
+
+def contour_center(contour):
+    """The centroid of a contour, or None if it has no area."""
+    mmnts = cv2.moments(contour)
+    if mmnts['m00'] == 0:
+        return None
+    return Point(int(mmnts['m10'] / mmnts['m00']), int(mmnts['m01'] / mmnts['m00']))
+
+
+def blur_gray(img, size=BLUR_SIZE):
+    """The smoothed gray image background subtraction works on."""
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    preBlur = cv2.blur(gray, (size, size))
+    return cv2.medianBlur(preBlur, size)
+
+
+def shrink(img, levels):
+    """
+    img averaged down to 1 / 2**levels of its width and height.
+
+    Halved a level at a time, OpenCV averages 2x2 blocks several times
+    faster than larger ones.
+    """
+    for _ in range(levels):
+        img = cv2.resize(img, (max(img.shape[1] // 2, 1), max(img.shape[0] // 2, 1)), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def clear_of_edges(window, bounds, shape, edge=ROI_EDGE):
+    """Whether bounds stays edge pixels clear of every side of window that cuts through an image of shape."""
+    x0, y0, x1, y1 = window
+    bx, by, bw, bh = bounds
+    hgt, wid = shape[:2]
+    return ((x0 == 0 or bx - x0 >= edge) and (y0 == 0 or by - y0 >= edge) and
+            (x1 == wid or x1 - (bx + bw) >= edge) and (y1 == hgt or y1 - (by + bh) >= edge))
+
+
+def refine(detect, coarse, images, offset, levels, margin):
+    """
+    Run a full resolution detector on a patch around a coarse detection.
+
+    :param coarse: The Detection on images shrunk by levels, at offset (0, 0)
+    :param images: The image, and any images aligned with it that detect needs
+    :param margin: Pixels detect needs around the tensegrity to see what it would on the whole image
+    :return: detect's Detection, from the whole of images if the patch cut the tensegrity off
+    """
+    scale = 2 ** levels
+    hgt, wid = images[0].shape[:2]
+    bx, by, bw, bh = coarse.bounds
+    pad = margin + 2 * scale
+    x0, y0 = max(bx * scale - pad, 0), max(by * scale - pad, 0)
+    x1, y1 = min((bx + bw) * scale + pad, wid), min((by + bh) * scale + pad, hgt)
+    found = detect(*[img[y0:y1, x0:x1] for img in images], offset=(offset[0] + x0, offset[1] + y0))
+    if found is not None:
+        fx, fy, fw, fh = found.bounds
+        if clear_of_edges((x0, y0, x1, y1), (fx - offset[0], fy - offset[1], fw, fh), images[0].shape, margin):
+            return found
+    return detect(*images, offset=offset)
+
+
+def detect_white(img, offset=(0, 0), blur_size=WHITE_BLUR_SIZE):
+    """Find a dark tensegrity on a light floor."""
+    gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+    blur = cv2.blur(gray, (blur_size, blur_size))
+    _, thresh = cv2.threshold(blur, 100, 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if not contours:
+        return None
+    best = max(range(len(contours)), key=lambda i: contours[i].size)
+    center = contour_center(contours[best])
+    if center is None:
+        return None
+    return Detection(center, contours, best, cv2.boundingRect(contours[best]), [])
+
+
+def detect_white_pyramid(img, offset=(0, 0), levels=PYRAMID_LEVELS):
+    """detect_white, coarse to fine."""
+    coarse = detect_white(shrink(img, levels), blur_size=max(WHITE_BLUR_SIZE >> levels, 1))
+    if coarse is None:
+        return None
+    return refine(detect_white, coarse, [img], offset, levels, WHITE_BLUR_SIZE // 2)
+
+
+def detect_subtraction(img, base, offset=(0, 0), keep=None, blur_size=BLUR_SIZE):
+    """
+    Find the tensegrity by subtracting the empty arena from the frame.
+
+    The tensegrity is whatever is darker than the arena. The subtraction
+    saturates, so parts of the frame lighter than the arena are 0 rather
+    than wrapping around to large differences.
+    :param base: The blurred gray image of the empty arena, the same size as img
+    :param keep: A dict to fill with the intermediate images, for debugging
+    """
+    blur = blur_gray(img, blur_size)
+    subImg = cv2.subtract(base, blur)
+    _, subThresh = cv2.threshold(subImg, 25, 255, cv2.THRESH_BINARY)
+
+    if keep is not None:
+        # The names the tracker always wrote. The subtraction saturates, so
+        # sub_threshA (the difference with wrapped around values cut) is sub_raw
+        keep.update({'base_img.png': base,
+                     'gray_raw.png': cv2.cvtColor(img, cv2.COLOR_RGB2GRAY),
+                     'sub_raw.png': subImg,
+                     'sub_threshA.png': subImg,
+                     'sub_thresh.png': subThresh})
+
+    contours, _ = cv2.findContours(subThresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if not contours:
+        return None
+    best = max(range(len(contours)), key=lambda i: contours[i].size)
+    center = contour_center(contours[best])
+    if center is None:
+        return None
+    return Detection(center, contours, best, cv2.boundingRect(contours[best]), [])
+
+
+def detect_subtraction_pyramid(img, base, offset=(0, 0), keep=None, levels=PYRAMID_LEVELS):
+    """
+    detect_subtraction, coarse to fine.
+
+    The shrinking already smooths the coarse image, so it is blurred with
+    the smallest kernels only.
+    """
+    coarse = detect_subtraction(shrink(img, levels), shrink(base, levels), blur_size=3)
+    if coarse is None:
+        return None
+
+    def detect(patch, base_patch, offset):
+        return detect_subtraction(patch, base_patch, offset, keep)
+
+    return refine(detect, coarse, [img, base], offset, levels, BLUR_SIZE)
+
+
+def pack_bgr(img):
+    """Each pixel's color as one 24 bit number, for indexing a table over all colors."""
+    return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA).view('<u4')[..., 0] & 0xffffff
+
+
+class PuffClassifier(object):
+    """
+    Labels every pixel with the puff whose HSV range its color falls in.
+
+    The ranges are turned into a table over all 2^24 BGR colors once, so a
+    frame is classified with one lookup per pixel. Each puff's blobs are
+    then found by a connected components pass over only the box its color
+    is in, so blobs of different puffs that touch aren't taken for one.
+    Where ranges overlap the earlier puff wins.
+    """
+
+    def __init__(self, puffs):
+        super(PuffClassifier, self).__init__()
+        self.puffs = [(np.asarray(low, np.uint8), np.asarray(high, np.uint8)) for low, high in puffs]
+        assert len(self.puffs) < 255, "Too many puffs for an 8 bit label"
+        self.lut = self.__build_table()
+
+    def classify(self, img):
+        """The label image of img: 0 where there is no puff, i + 1 where the color is in puff i's range."""
+        return np.take(self.lut, pack_bgr(img))
+
+    def find(self, img, offset=(0, 0)):
+        """
+        Find the biggest blob of each puff's color.
+
+        :return: The label image, and per puff its center and (x, y, w, h)
+                 bounds in frame coordinates, or None if it isn't in img
+        """
+        labels = self.classify(cv2.medianBlur(img, 3))
+        found = []
+        for i in range(len(self.puffs)):
+            # Per puff, so touching puffs of different colors stay apart
+            mask = (labels == i + 1).view(np.uint8)
+            x0, y0, w, h = cv2.boundingRect(mask)
+            if not w:
+                found.append(None)
+                continue
+            _, _, stats, centroids = cv2.connectedComponentsWithStats(mask[y0:y0 + h, x0:x0 + w], connectivity=8)
+            c = 1 + int(np.argmax(stats[1:, cv2.CC_STAT_AREA]))
+            x, y, w, h = stats[c, :4]
+            center = Point(int(centroids[c][0]) + x0 + offset[0], int(centroids[c][1]) + y0 + offset[1])
+            found.append((center, (int(x) + x0 + offset[0], int(y) + y0 + offset[1], int(w), int(h))))
+        return labels, found
+
+    def __build_table(self, chunk=1 << 20):
+        lut = np.zeros(1 << 24, np.uint8)
+        for start in range(0, 1 << 24, chunk):
+            # the colors whose pack_bgr is start .. start + chunk - 1
+            colors = np.arange(start, start + chunk, dtype='<u4').view(np.uint8).reshape(-1, 1, 4)
+            hsv = cv2.cvtColor(np.ascontiguousarray(colors[..., :3]), cv2.COLOR_BGR2HSV)
+            table = lut[start:start + chunk]
+            for i, (low, high) in enumerate(self.puffs):
+                mask = cv2.inRange(hsv, low, high).ravel()
+                table[(mask > 0) & (table == 0)] = i + 1
+        return lut
+
+
+def detect_puffs(img, classifier, offset=(0, 0), keep=None):
+    """
+    Find the tensegrity from the colored puff balls on its ends.
+
+    :param classifier: A PuffClassifier for the puffs' colors
+    :param keep: A dict to fill with the label image, for debugging
+    :return: A Detection centered between the puffs, with the puff centers as its points
+    """
+    labels, found = classifier.find(img, offset)
+    if keep is not None:
+        keep['puff_labels.png'] = labels * (255 // len(classifier.puffs))
+    if not found or None in found:
+        return None
+    puff_centers = [center for center, _ in found]
+    cx = sum(center.x for center in puff_centers) // len(puff_centers)
+    cy = sum(center.y for center in puff_centers) // len(puff_centers)
+    x0 = min(x for _, (x, y, w, h) in found)
+    y0 = min(y for _, (x, y, w, h) in found)
+    x1 = max(x + w for _, (x, y, w, h) in found)
+    y1 = max(y + h for _, (x, y, w, h) in found)
+    return Detection(Point(cx, cy), [], -1, (x0, y0, x1 - x0, y1 - y0), puff_centers)
+
+
+class BackgroundModel(object):
+    """
+    A running average of the empty arena, for background subtraction.
+
+    It starts from a base image and follows slow changes in lighting. Each
+    update refreshes one of bands horizontal bands from a frame, with weight
+    rate, so a frame costs a fixed fraction of blurring a whole frame. The
+    robot's bounds, grown by margin, are left out so the robot never fades
+    into the background. image is the background detectors subtract, and it
+    is updated in place.
+    """
+
+    def __init__(self, base, rate=BACKGROUND_RATE, bands=BACKGROUND_BANDS, margin=BACKGROUND_MARGIN):
+        super(BackgroundModel, self).__init__()
+        self.rate = rate
+        self.bands = bands
+        self.margin = margin
+        self.image = np.array(base, dtype=np.uint8)
+        self.average = self.image.astype(np.float32)
+        self.updates = 0
+        self.__band = 0
+
+    def update(self, frame, exclude):
+        """
+        Refresh the next band of the background from frame.
+
+        :param frame: A BGR frame the same size as the background
+        :param exclude: (x, y, w, h) bounds of the robot in the frame
+        """
+        hgt, wid = self.image.shape
+        y0 = hgt * self.__band // self.bands
+        y1 = hgt * (self.__band + 1) // self.bands
+        self.__band = (self.__band + 1) % self.bands
+        # blur with the rows around the band, so its edges blur as in a whole frame
+        top, bottom = max(y0 - BLUR_SIZE, 0), min(y1 + BLUR_SIZE, hgt)
+        blur = blur_gray(frame[top:bottom])[y0 - top:y1 - top]
+        mask = np.full(blur.shape, 255, np.uint8)
+        x, y, w, h = exclude
+        m = self.margin
+        mask[max(y - m - y0, 0):max(y + h + m - y0, 0), max(x - m, 0):max(x + w + m, 0)] = 0
+        cv2.accumulateWeighted(blur, self.average[y0:y1], self.rate, mask)
+        self.image[y0:y1] = cv2.convertScaleAbs(self.average[y0:y1])
+        self.updates += 1
+
+
+class WindowedSearch(object):
+    """
+    Looks for the tensegrity near where it was last seen.
+
+    search() runs a detector on a square window of radius pixels around the
+    last position. If the window doesn't contain the whole detection (it is
+    missing, or touches an edge of the window that isn't an edge of the
+    frame) the whole frame is scanned instead, and that counts as a
+    fallback. Without a last position, or with radius None, every frame is
+    scanned whole.
+    """
+
+    def __init__(self, radius=ROI_RADIUS, edge=ROI_EDGE):
+        super(WindowedSearch, self).__init__()
+        self.radius = radius
+        self.edge = edge
+        self.last = None
+        self.reset_stats()
+
+    @property
+    def stats(self):
+        """Frames searched, found within the window, rescanned whole and not found at all."""
+        return RoiStats(self.frames, self.windowed, self.fallbacks, self.lost)
+
+    def reset_stats(self):
+        self.frames = 0
+        self.windowed = 0
+        self.fallbacks = 0
+        self.lost = 0
+
+    def window(self, shape):
+        """The (x0, y0, x1, y1) window to search next in a frame of shape, or None for the whole frame."""
+        if self.radius is None or self.last is None:
+            return None
+        hgt, wid = shape[:2]
+        x0, y0 = max(self.last.x - self.radius, 0), max(self.last.y - self.radius, 0)
+        x1, y1 = min(self.last.x + self.radius, wid), min(self.last.y + self.radius, hgt)
+        if x1 - x0 < 2 or y1 - y0 < 2 or (x1 - x0 >= wid and y1 - y0 >= hgt):
+            return None
+        return x0, y0, x1, y1
+
+    def search(self, detect, *images):
+        """
+        Find the tensegrity with detect(*images, offset=...).
+
+        :param images: The frame, followed by any images aligned with it that
+                       detect needs cropped to the same window
+        :return: The Detection, or None if the whole frame has no tensegrity
+        """
+        self.frames += 1
+        window = self.window(images[0].shape)
+        if window is not None:
+            x0, y0, x1, y1 = window
+            found = detect(*[img[y0:y1, x0:x1] for img in images], offset=(x0, y0))
+            if found is not None and clear_of_edges(window, found.bounds, images[0].shape, self.edge):
+                self.windowed += 1
+                self.last = found.center
+                return found
+            self.fallbacks += 1
+        found = detect(*images, offset=(0, 0))
+        if found is None:
+            self.lost += 1
+        self.last = None if found is None else found.center
+        return found
@@ -3,7 +3,7 @@ mcvickec 10/21 - Fails looking for USB camera
 """
 from random import randint
 from datetime import datetime
-from time import sleep
+from time import time
 from collections import namedtuple
 from math import sqrt
 import csv
@@ -23,6 +23,8 @@ import matplotlib.pyplot as plt
 from mpl_toolkits import mplot3d
 
 from runTens import Tensegrity
+from trialPipeline import TrialPipeline
+from earlyStopping import TrialMonitor
 from tensTracking import WHITE, SUB, PUFFS
 
 VALTR0 = 'CA:A3:11:A7:81:FD'
@@ -49,6 +51,9 @@ TENS_VERS = 5
 CODE_VERS = 6
 MIN_VAL = 7  # indicates minimum speed test considered, see MIN_SPEED
 MAX_VAL = 8  # indicates minimum speed test considered, see MIN_SPEED
+START_SKEW = 9  # spread in seconds between the struts' start times
+CENSORED = 10  # True if the trial was stopped early, DIST is then the projected distance
+VIBRATION = 11  # per-strut RMS vibration during the trial in g, from the struts' telemetry
 # There may be extra data points, depending on the learning strategy
 
 VVVALTR_DIR = "/".join(os.path.realpath(__file__).split('/')[0:-1])
@@ -60,9 +65,11 @@ class LearningMethod(object):
     def __init__(self, btAddrList,
                  testNum=5, testTime=30,
                  tracking_method=SUB, tracking_preset = False,
-                 tens_vers=1.0, code_vers=1.0):
+                 tens_vers=1.0, code_vers=1.0,
+                 pool=None, tracker=None, early_stop=None):
         assert len(btAddrList) > 0, "At least one Bluetooth address is needed"
-        self.tens = Tensegrity(btAddrList, method=tracking_method, tracking_preset=tracking_preset)
+        self.tens = Tensegrity(btAddrList, method=tracking_method, tracking_preset=tracking_preset,
+                               pool=pool, tracker=tracker)
         self.tracker = self.tens.tracker
         self.testNum = testNum
         self.results = []
@@ -72,6 +79,9 @@ class LearningMethod(object):
         self.dataFileName = VVVALTR_DIR + "/data/test-{}".format(datetime.now())
         self.tens_vers = tens_vers
         self.code_vers = code_vers
+        self.pipeline = TrialPipeline(self.tracker, timer=self.tens.motion_timer)
+        self.early_stop = early_stop  # an earlyStopping.EarlyStopPolicy, None runs every trial in full
+        self.telemetry = self.tens.start_telemetry()
         # self.start_results(['Freqs', 'Disp', 'Start', 'End', 'Tens', 'Code'])
 
     def start_results(self, field_names):
@@ -100,12 +110,56 @@ class LearningMethod(object):
             dataWriter = csv.writer(dataFile)
             dataWriter.writerow(result)
 
+    def run_trial(self, testFreqs, startPos, best):
+        """
+        Run one experiment, letting the early stop policy cut it short.
+
+        :param best: The best distance so far, which the policy compares the trial against
+        :return: The StartReport, the TrialMonitor (None without a policy) and
+                 the time the trial ended
+        """
+        monitor = None
+        if self.early_stop is not None:
+            monitor = TrialMonitor(self.tens, self.tracker, self.early_stop, best)
+            monitor.start(startPos)
+        start = self.tens.run_experiment(testFreqs, verbose=False)
+        self.tens.check_experiment_over()
+        end = time()
+        if monitor is not None:
+            monitor.finish()
+            if not monitor.censored:
+                self.early_stop.observe(monitor.duration)
+        return start, monitor, end
+
+    def trial_positions(self, start, end, before):
+        """
+        The filtered positions at the moment the struts started and the trial ended.
+
+        :param before: The position read just before the trial, used for its start
+                       if that is older than the tracker's history
+        :return: (start position, end position)
+        """
+        startPos = self.tracker.position_at(start.fire_time)
+        if startPos is None:
+            print("Trial started {:.0f} s ago, past the tracker's history, using the position before it".format(
+                time() - start.fire_time))
+            startPos = before
+        return startPos, self.tracker.position_at(end)
+
+    def trial_vibration(self, start, end):
+        """
+        How much each strut shook between the moment the struts started and the trial ended.
+
+        :return: A tuple of RMS accelerations about the mean in g, 0 for struts that sent no telemetry
+        """
+        return tuple(round(v, 4) for v in self.telemetry.vibration(start.fire_time, end))
+
 
 class RandomHillClimber(LearningMethod):
     """A class which uses a stochastic hill climber to generate gaits."""
 
-    def __init__(self, btAddrList, testNum=5):
-        LearningMethod.__init__(self, btAddrList, testNum)
+    def __init__(self, btAddrList, testNum=5, *args, **kwargs):
+        LearningMethod.__init__(self, btAddrList, testNum, *args, **kwargs)
         self.currBest = 0.
         self.dataFileName = VVVALTR_DIR + "/data/RHC-test-{}.csv".format(datetime.now().strftime("%d-%m-%Y_%H:%M:%S"))
         print("Data file is {}".format(self.dataFileName))
@@ -126,37 +180,32 @@ class RandomHillClimber(LearningMethod):
         self.iter_num += 1
         testFreqs = self.__generate_freqs()
         print("{}: {}".format(self.iter_num, testFreqs))
+        self.pipeline.wait_until_ready()
         startPos = self.tracker.tens_position
 
-        self.tens.run_experiment(testFreqs, verbose=False)
-        self.tens.check_experiment_over()
-        # self.tens.run_freq_set(testFreqs)
+        start, monitor, end = self.run_trial(testFreqs, startPos, self.currBest)
 
-        endPos = self.tracker.tens_position
+        startPos, endPos = self.trial_positions(start, end, startPos)
+        vibration = self.trial_vibration(start, end)
         dist = sqrt((endPos.x - startPos.x) ** 2 + (endPos.y - startPos.y) ** 2)
+        censored = monitor is not None and monitor.censored
+        if censored:
+            dist = monitor.projected
         print("{}: {} -> {}".format(self.iter_num, testFreqs, dist))
         self.currBest = dist if dist > self.currBest else self.currBest
         result = [self.iter_num, testFreqs, dist, startPos, endPos, self.tens_vers, self.code_vers, MIN_SPEED,
-                  MAX_SPEED, 'Rand', 'Rand', self.currBest]
+                  MAX_SPEED, start.skew, censored, vibration, 'Rand', 'Rand', self.currBest]
         self.results.append(result)
         self.tested.append(testFreqs)
 
-        f_center_x, f_center_y = self.tracker.frame_center
-        dist_to_frame_center = sqrt((endPos.x - f_center_x) ** 2 + (endPos.y - f_center_y) ** 2)
-        while dist_to_frame_center > 120:
-            print("Center tensegrity, dist to center is ", dist_to_frame_center)
-            sleep(2)
-            cur_pos = self.tracker.tens_position
-            dist_to_frame_center = sqrt((cur_pos.x - f_center_x) ** 2 + (cur_pos.y - f_center_y) ** 2)
-        sleep(2)  # let tensegrity rest
-
-        self.save_single_result(result)
+        self.pipeline.finish_trial(self.iter_num, self.save_single_result, result)
         return dist
 
     def hill_climb(self, iterations=100):
         """Run a hill climber for n iterations."""
         for i in range(iterations):
             self.run_experiment()
+        self.pipeline.drain()
         print("Best result: {}".format(self.currBest))
 
 
@@ -167,6 +216,7 @@ class BayesianOptimizer(LearningMethod):
         self.mode_short = 'ucb05'
         self.iter_num = 0
         self.gpgo = optimizer
+        self.pipeline.recenter_radius = 115
 
         self.currBest = 0
 
@@ -178,34 +228,30 @@ class BayesianOptimizer(LearningMethod):
         self.iter_num += 1
         testFreqs = tuple(testFreqs)
         # print("Testing frequencies: {}".format(testFreqs))
+        self.pipeline.wait_until_ready()
         startPos = self.tracker.tens_position
 
-        self.tens.run_experiment(testFreqs, verbose=False)
-        self.tens.check_experiment_over()
-        # self.tens.run_freq_set(testFreqs)
+        start, monitor, end = self.run_trial(testFreqs, startPos, self.currBest)
 
-        endPos = self.tracker.tens_position
+        startPos, endPos = self.trial_positions(start, end, startPos)
+        vibration = self.trial_vibration(start, end)
         dist = sqrt((endPos.x - startPos.x) ** 2 + (endPos.y - startPos.y) ** 2)
+        censored = monitor is not None and monitor.censored
+        if censored:
+            dist = monitor.projected
         self.currBest = dist if dist > self.currBest else self.currBest
-        result = [self.iter_num, testFreqs, dist, startPos, endPos, self.tens_vers, self.code_vers, MIN_SPEED, MAX_SPEED]
+        result = [self.iter_num, testFreqs, dist, startPos, endPos, self.tens_vers, self.code_vers, MIN_SPEED, MAX_SPEED,
+                  start.skew, censored, vibration]
         self.results.append(result)
         self.tested.append(testFreqs)
 
-        f_center_x, f_center_y = self.tracker.frame_center
-        dist_to_frame_center = sqrt((endPos.x - f_center_x) ** 2 + (endPos.y - f_center_y) ** 2)
-        while dist_to_frame_center > 115:
-            print("Center tensegrity, dist to center is ", dist_to_frame_center)
-            sleep(2)
-            cur_pos = self.tracker.tens_position
-            dist_to_frame_center = sqrt((cur_pos.x - f_center_x) ** 2 + (cur_pos.y - f_center_y) ** 2)
-        sleep(2)  # let tensegrity rest
-
-        self.save_single_result(result)
+        self.pipeline.finish_trial(self.iter_num, self.save_single_result, result)
         return dist
 
     def run_optimizer(self, iterations=40):
         if self.gpgo is not None:
             self.gpgo.run(max_iter=iterations)
+            self.pipeline.drain()
             return
         cov = matern32()
         gp = GaussianProcess(cov)
@@ -221,6 +267,7 @@ class BayesianOptimizer(LearningMethod):
 
         self.gpgo = GPGO(gp, acq, meta, param)
         self.gpgo.run(max_iter=iterations)
+        self.pipeline.drain()
 
     def fit_priors(self, gp):
         """
@@ -254,6 +301,7 @@ def main(optimizer=None):
     # RHC.save_results()
 
     BO = BayesianOptimizer([VALTR5, VALTR6, VALTR9])
+    BO.tens.install_stop_handlers()
     BO.run_optimizer(iterations=60)
     # # BO.save_results()
 
@@ -100,8 +100,6 @@ class RandomHillClimber(LearningMethod):
         self.tens.run_freq_set(testFreqs)
 	endPos = self.tracker.tens_position
 
-	sleep(10)  # offset to ensure motor is done moving
-
         dist = sqrt((endPos.x - startPos.x)**2 + (endPos.y - startPos.y)**2)
 
         result = [testFreqs, dist, startPos, endPos]
@@ -151,8 +149,6 @@ class BayesianOptimizer(LearningMethod):
         
         endPos = self.tracker.tens_position
 
-	sleep(10)
-
         dist = sqrt((endPos.x - startPos.x)**2. + (endPos.y - startPos.y)**2.)\
 
         result = [testFreqs, dist, startPos, endPos]
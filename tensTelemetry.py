@@ -0,0 +1,203 @@
+#!/usr/bin/python
+"""
+Live accelerometer telemetry from the struts.
+
+Each strut notifies binary packets of accelerometer samples on its telemetry
+handle while it runs. A TelemetryStream collects the raw packets as they
+arrive, decodes them in batches with NumPy and keeps the samples in a
+fixed-size RingBuffer, so the data can be queried during a trial instead of
+being copied off the strut's microSD card afterwards.
+
+Packet layout (little endian, at most 20 bytes per notification):
+    uint32  strut clock of the first sample, in ms
+    uint16  time between samples, in us
+    int16   x, y, z acceleration per sample, in raw MPU6050 counts
+"""
+
+from collections import namedtuple
+from threading import Lock
+from time import time
+
+import numpy as np
+
+TELEMETRY_HANDLE = '0x17'
+
+HEADER = np.dtype([('t_ms', '<u4'), ('dt_us', '<u2')])
+SAMPLE = np.dtype(('<i2', (3,)))
+COUNTS_PER_G = 16384.  # MPU6050 at its default +-2 g range
+
+Samples = namedtuple('Samples', ['times', 'accel'])
+
+
+class RingBuffer(object):
+    """
+    A fixed-size, preallocated buffer of timestamped rows.
+
+    Writes overwrite the oldest rows once the buffer is full. Reads return
+    copies in time order, so they stay valid while writing carries on.
+    """
+
+    def __init__(self, capacity, width, dtype=np.float32):
+        super(RingBuffer, self).__init__()
+        self.capacity = capacity
+        self.times = np.zeros(capacity, dtype=np.float64)
+        self.rows = np.zeros((capacity, width), dtype=dtype)
+        self.written = 0  # total rows ever written
+        self.__lock = Lock()
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def extend(self, times, rows):
+        """Append a block of rows with their timestamps."""
+        n = len(times)
+        if n == 0:
+            return
+        if n > self.capacity:
+            times, rows, n = times[-self.capacity:], rows[-self.capacity:], self.capacity
+        with self.__lock:
+            start = self.written % self.capacity
+            first = min(n, self.capacity - start)
+            self.times[start:start + first] = times[:first]
+            self.rows[start:start + first] = rows[:first]
+            self.times[:n - first] = times[first:]
+            self.rows[:n - first] = rows[first:]
+            self.written += n
+
+    def latest(self, n=None):
+        """The most recent n rows (all of them by default), oldest first."""
+        with self.__lock:
+            size = len(self)
+            n = size if n is None else min(n, size)
+            idx = (np.arange(self.written - n, self.written) % self.capacity)
+            return Samples(self.times[idx], self.rows[idx])
+
+    def between(self, t_start, t_end):
+        """All rows with timestamps in [t_start, t_end), oldest first."""
+        samples = self.latest()
+        keep = (samples.times >= t_start) & (samples.times < t_end)
+        return Samples(samples.times[keep], samples.accel[keep])
+
+    def clear(self):
+        with self.__lock:
+            self.written = 0
+
+
+def decode_packets(packets):
+    """
+    Decode a batch of equally sized telemetry packets at once.
+
+    :param packets: A list of packets (bytes), all the same length
+    :return: (strut time of every sample in s, (n, 3) int16 samples)
+    """
+    size = len(packets[0])
+    n_samples = (size - HEADER.itemsize) // SAMPLE.itemsize
+    packet = np.dtype([('head', HEADER), ('accel', SAMPLE, (n_samples,))])
+    decoded = np.frombuffer(b''.join(packets), dtype=packet)
+    offsets = np.arange(n_samples) * 1e-6
+    times = (decoded['head']['t_ms'][:, None] * 1e-3 +
+             decoded['head']['dt_us'][:, None] * offsets[None, :]).ravel()
+    return times, decoded['accel'].reshape(-1, 3)
+
+
+class TelemetryStream(object):
+    """
+    The telemetry of one strut.
+
+    Packets are only stored by the notification callback. They are decoded
+    into the ring buffer in one batch the next time the stream is queried (or
+    flushed). Strut clock times are mapped to host time with the smallest
+    observed delay between a packet's strut time and its arrival, which
+    settles on the true offset as soon as one packet arrives promptly.
+    """
+
+    def __init__(self, motor, capacity=60000):
+        super(TelemetryStream, self).__init__()
+        self.btAddr = motor.btAddr
+        self.buffer = RingBuffer(capacity, 3, dtype=np.float32)
+        self.packets = 0
+        self.__motor = motor
+        self.__pending = []
+        self.__pending_lock = Lock()
+        self.__flush_lock = Lock()
+        self.__offset = None
+        self.__subscribed = False
+
+    def start(self):
+        """Subscribe to the strut's telemetry packets."""
+        if not self.__subscribed:
+            self.__motor.session.subscribe(TELEMETRY_HANDLE, self.__on_packet)
+            self.__subscribed = True
+
+    def __on_packet(self, payload):
+        with self.__pending_lock:
+            self.__pending.append((time(), bytes(bytearray(payload))))
+
+    def flush(self):
+        """Decode everything received so far into the ring buffer."""
+        with self.__flush_lock:
+            with self.__pending_lock:
+                pending, self.__pending = self.__pending, []
+            if pending:
+                self.__decode(pending)
+
+    def __decode(self, pending):
+        self.packets += len(pending)
+        by_size = {}
+        for arrival, packet in pending:
+            if len(packet) >= HEADER.itemsize + SAMPLE.itemsize:
+                by_size.setdefault(len(packet), []).append((arrival, packet))
+        if not by_size:
+            return
+        blocks = []
+        for group in by_size.values():
+            arrivals = np.array([arrival for arrival, packet in group])
+            times, accel = decode_packets([packet for arrival, packet in group])
+            first_times = times.reshape(len(group), -1)[:, 0]
+            offset = np.min(arrivals - first_times)
+            self.__offset = offset if self.__offset is None else min(self.__offset, offset)
+            blocks.append((times, accel))
+        times = np.concatenate([b[0] for b in blocks]) + self.__offset
+        accel = np.concatenate([b[1] for b in blocks]) / COUNTS_PER_G
+        order = np.argsort(times, kind='mergesort')
+        self.buffer.extend(times[order], accel[order])
+
+    def latest(self, n=None):
+        """The most recent n samples, in g with host timestamps."""
+        self.flush()
+        return self.buffer.latest(n)
+
+    def between(self, t_start, t_end):
+        """The samples taken between two host times, in g."""
+        self.flush()
+        return self.buffer.between(t_start, t_end)
+
+    def vibration(self, t_start, t_end):
+        """RMS of the acceleration about its mean over a time window, in g."""
+        samples = self.between(t_start, t_end)
+        if len(samples.times) == 0:
+            return 0.
+        dev = samples.accel - samples.accel.mean(axis=0)
+        return float(np.sqrt((dev ** 2).sum(axis=1).mean()))
+
+
+class TensTelemetry(object):
+    """The telemetry streams of every strut on a tensegrity."""
+
+    def __init__(self, motors, capacity=60000):
+        super(TensTelemetry, self).__init__()
+        self.streams = [TelemetryStream(motor, capacity) for motor in motors]
+
+    def __len__(self):
+        return len(self.streams)
+
+    def __getitem__(self, i):
+        return self.streams[i]
+
+    def start(self):
+        for stream in self.streams:
+            stream.start()
+
+    def vibration(self, t_start, t_end):
+        """Per-strut RMS vibration over a time window."""
+        return [stream.vibration(t_start, t_end) for stream in self.streams]
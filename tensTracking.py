@@ -3,16 +3,25 @@ import math
 from math import asin
 import cv2
 from threading import Thread
+from functools import partial
 import numpy as np
-from copy import copy
 from collections import namedtuple
+from time import time
+
+from debugImageSink import DebugImageSink, CostCounter, FrameCost
+from framePipeline import FrameRing
+from frameSource import open_source, CameraSource
+from kalmanTracker import PositionFilter
+from tensCalibration import CalibrationStore, Calibration, CalibrationCheck, check_calibration, floor_map, \
+    CALIBRATION_DIR
+from visionProcesses import SharedFrameRing, capture_frames, detect_positions, context
+from tensDetection import Point, WindowedSearch, BackgroundModel, blur_gray, detect_white, detect_subtraction, \
+    detect_white_pyramid, detect_subtraction_pyramid, detect_puffs, PuffClassifier, ROI_RADIUS
+TrackedPosition = namedtuple('TrackedPosition', ['position', 'seq', 'age'])
 
-Point = namedtuple('Point', ['x', 'y'])
-
-BLUR_SIZE = 7
 PUFF_BLUR_SIZE = 5
 
-PIX_PER_CM = 3.5
+PIX_PER_CM = 3.5  # scale of the floor when its calibration has no floor points
 
 WHITE = 1
 SUB = 2
@@ -23,45 +32,133 @@ PRESET_PUFFS = [(np.array([0, 120, 0], dtype=np.uint8), np.array([9, 255, 255],
                 (np.array([160, 120, 0], dtype=np.uint8), np.array([170, 255, 255], dtype=np.uint8)),
                 ]
 
+# Where a tracker looks until it is given its test area
 TEST_AREA = {'ul': (0, 0),
              'br': (640, 480)}
 
+ARENA_MARGIN = 20  # pixels from the edge of the test area that count as leaving it
+
 
 class TensTracker(object):
 
-    def __init__(self, camNum=None, display=True, method=SUB, preset=False, record=False):
+    def __init__(self, camNum=None, display=True, method=SUB, preset=False, record=False, debug=None,
+                 roi_radius=ROI_RADIUS, processes=False, source=None, test_area=None, calibration=CALIBRATION_DIR,
+                 metric=False, pyramid=False):
+        """
+        :param processes: Capture and find the tensegrity in worker processes
+                          instead of threads (debug images are not captured then)
+        :param source: A video file, directory of images or frameSource source to
+                       track instead of a camera, used without asking
+        :param test_area: ((x0, y0), (x1, y1)) corners of the test area, instead
+                          of selecting the boundary puffs
+        :param calibration: The directory (or CalibrationStore) of the camera's saved
+                            calibration, which is used for whatever parts of the setup
+                            it still matches, None to always set up by hand
+        :param metric: Report positions (tens_position, position_at) in cm on the floor
+                       instead of pixels in the test area. frame_center, tens_state
+                       and pixel_position stay in pixels
+        :param pyramid: Find the tensegrity coarse to fine, for WHITE and SUB
+        """
         # Stuff to get the camera running
-        self.__raw_frame = None
-        self.__draw_frame = None
-        self.__mask_frames = [None, None, None]
-        self.__find_camera(camNum)
-        self.__frame_updater = Thread(target=self.__update_frame, args=())
-        self.__frame_updater.daemon = True
-        self.__frame_updater.start()
-
-        self.test_area = {'ul': (0, 0),
-                          'br': (640, 480)}
-
+        self.__pos_seq = 0
+        self.__pos_time = None
+        self.skipped_frames = 0
+        self.cam_num = camNum
+        self.boundary_puffs = None
+        store = calibration
+        if calibration is not None and not isinstance(calibration, CalibrationStore):
+            store = CalibrationStore(calibration)
+        cal = None
+        check = CalibrationCheck(False, False)
+        if source is not None:
+            self.capture = open_source(source)
+            self.cam_num = source
+            store = None
+        else:
+            cal = store.load() if store is not None else None
+            if cal is not None and camNum in (None, cal.cam_num):
+                check = self.__open_calibrated(cal)
+            if not check.test_area:
+                self.__find_camera(camNum)
+        # Frames are decoded and drawn into preallocated buffers, cropped
+        # frames are views into them
+        shape = self.__capture_shape()
+        self.frame_shape = shape
+        self.processes = processes
+        self.__workers = []
+        self.__crop = None
+        # Replaced whole, never changed in place, so capture always crops a consistent area
+        self.test_area = dict(TEST_AREA)
+        self.position_latency = CostCounter()
+        if processes:
+            # The capture process opens the camera itself
+            self.__ctx = context()
+            self.capture.release()
+            self.__crop = self.__ctx.RawArray('i', self.test_area['ul'] + self.test_area['br'])
+            self.__raw_frames = SharedFrameRing(shape, ctx=self.__ctx)
+            self.__start_worker(capture_frames, self.cam_num, self.__raw_frames, self.__crop)
+        else:
+            self.__raw_frames = FrameRing(shape)
+            self.__frame_updater = Thread(target=self.__update_frame, args=())
+            self.__frame_updater.daemon = True
+            self.__frame_updater.start()
+        self.__draw_frames = FrameRing(shape)
 
-        while self.__raw_frame is None:
-            continue
+        self.__raw_frames.wait_next()
 
         self.no_tens_warned = False
 
-        if method == SUB:
+        self.baseImg = None
+        if method == SUB and check.base:
+            print("Using the calibrated base image")
+            self.baseImg = cal.base
+        elif method == SUB:
             self.get_base_img()
-            print("Base image obtained. Place tensegrity")
-            sleep(10)
+            # A recording starts with the empty arena, there is no one to place the tensegrity
+            if getattr(self.capture, 'live', True):
+                print("Base image obtained. Place tensegrity")
+                sleep(10)
+        base = self.baseImg
 
         if method == PUFFS:
             self.puffs = []
             self.tens_angle = 0.0
-            if not preset:
-                self.__get_puffs()
-            else:
+            if preset:
                 self.puffs = PRESET_PUFFS
+            elif check.test_area and cal.puffs:
+                self.puffs = cal.puffs
+            else:
+                self.__get_puffs()
+            self.puff_classifier = PuffClassifier(self.puffs)
 
-        self.get_test_area()
+        if test_area is not None:
+            self.set_test_area(*test_area)
+        elif check.test_area:
+            self.boundary_puffs = cal.boundary_puffs
+            self.set_test_area(*cal.test_area)
+        else:
+            self.get_test_area()
+
+        # Only a test area found from the boundary puffs can be checked next time
+        if store is not None and self.boundary_puffs is not None:
+            if base is None and check.test_area:
+                base = cal.base
+            puffs = self.puffs if method == PUFFS and not preset else (cal.puffs if check.test_area else None)
+            lens, floor_points = (cal.lens, cal.floor_points) if check.test_area else (None, None)
+            store.save(Calibration(self.cam_num, shape, (self.test_area['ul'], self.test_area['br']),
+                                   self.boundary_puffs, puffs, base, lens, floor_points))
+
+        # Only positions are mapped to the floor, never whole frames
+        self.metric = metric
+        self.floor_map = floor_map((shape[1], shape[0]), self.test_area['ul'], PIX_PER_CM,
+                                   cal if check.test_area else None)
+
+        # The base image only starts the background off, the model keeps it
+        # up to date as the lighting changes
+        self.background = None
+        if self.baseImg is not None:
+            self.background = BackgroundModel(self.baseImg)
+            self.baseImg = self.background.image
 
         if record:
             fourcc = cv2.cv.FOURCC(*'XVID')
@@ -71,8 +168,27 @@ class TensTracker(object):
         self.tensX = -1
         self.tensY = -1
         self.method = method
-
-        self.__pos_updater = Thread(target=self.__update_pos, args=())
+        self.pyramid = pyramid
+        self.arena_margin = ARENA_MARGIN
+        self.__exit_callbacks = []
+        self.__in_arena = True
+        self.debug = debug if debug is not None else DebugImageSink()
+        self.detect_cost = CostCounter()
+        self.debug_cost = CostCounter()
+        self.__debug_time = 0.
+        self.roi = WindowedSearch(roi_radius)
+        self.kalman = PositionFilter(point=Point)
+        self.__frame_time = None
+        self.__roi_stats = self.roi.stats
+
+        if processes:
+            self.__records = self.__ctx.Queue()
+            detect, aligned = self.__detector()
+            self.__start_worker(detect_positions, self.__raw_frames, self.__records, detect, aligned, roi_radius,
+                                self.background)
+            self.__pos_updater = Thread(target=self.__read_positions, args=())
+        else:
+            self.__pos_updater = Thread(target=self.__update_pos, args=())
         self.__pos_updater.daemon = True
         self.__pos_updater.start()
 
@@ -88,7 +204,7 @@ class TensTracker(object):
 
     @property
     def frame_center(self):
-        f_shape = self.get_frame().shape
+        f_shape = self.frame_shape
         y_center = int(f_shape[0]/2)
         x_center = int(f_shape[1]/2)
         return x_center, y_center
@@ -100,12 +216,13 @@ class TensTracker(object):
         This function DOES NOT GUARANTEE A RESULT. The function is made to be
         non-blocking, so it doesn't ensure it returns an image.
 
+        The image is a read-only view into the frame buffers, which the camera
+        overwrites a few frames later. Use lease_raw_frame to hold on to one.
+
         :return: A 3d numpy array with colors as BGR or None
         """
-        if self.__raw_frame != [] and self.__raw_frame is not None:
-            return np.copy(self.__raw_frame)
-        else:
-            return None
+        frame = self.__raw_frames.latest
+        return None if frame is None else frame.image
 
     def get_frame(self):
         """
@@ -114,40 +231,56 @@ class TensTracker(object):
         This function DOES NOT GUARANTEE A RESULT. The function is made to be
         non-blocking, so it doesn't ensure it returns an image.
 
+        The image is a read-only view, see get_raw_frame.
+
         :return: A 3d numpy array with colors as BGR
         """
-        if self.__draw_frame != [] and self.__draw_frame is not None:
-            return np.copy(self.__draw_frame)
-        else:
-            return None
+        frame = self.__draw_frames.latest
+        return None if frame is None else frame.image
+
+    def lease_raw_frame(self, after=0, timeout=None):
+        """
+        Wait for a raw frame newer than after and keep its buffer from being reused.
+
+        :return: A FrameLease to release (or use in a with block), or None on timeout
+        """
+        return self.__raw_frames.lease(after, timeout)
+
+    def lease_frame(self, after=0, timeout=None):
+        """Like lease_raw_frame, for the drawn frames."""
+        return self.__draw_frames.lease(after, timeout)
 
     def get_base_img(self):
-        img = self.get_raw_frame()
-        while img is None:
-            img = self.get_raw_frame()
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        preBlur = cv2.blur(gray, (BLUR_SIZE, BLUR_SIZE))
-        blur = cv2.medianBlur(preBlur, BLUR_SIZE)
-        self.baseImg = blur
+        with self.lease_raw_frame() as frame:
+            self.baseImg = blur_gray(frame.image)
 
     def get_test_area(self):
-        frame = self.get_raw_frame()
-        while frame is None:
-            frame = self.get_raw_frame()
+        # Copied, the puff selection below takes far longer than the ring lasts
+        frame = np.copy(self.__raw_frames.wait_next().image)
         print("Select the upper left boundary puffball")
         ul_puff_bounds = self.__get_puff_bounds()
 
         print("Select the bottom right boundary puffball")
         br_puff_bounds = self.__get_puff_bounds()
 
-        ul_puff_pos = self.__get_puff_center(frame, ul_puff_bounds)
-        br_puff_pos = self.__get_puff_center(frame, br_puff_bounds)
+        # Both boundary puffs are found in one pass over the frame
+        _, found = PuffClassifier([ul_puff_bounds, br_puff_bounds]).find(frame)
+        assert None not in found, "Couldn't find both boundary puffs"
+        ul_puff_pos, br_puff_pos = [tuple(center) for center, _ in found]
+        self.boundary_puffs = [ul_puff_bounds, br_puff_bounds]
+        self.set_test_area(ul_puff_pos, br_puff_pos)
 
-        TEST_AREA['ul'] = ul_puff_pos
-        TEST_AREA['br'] = br_puff_pos
+    def set_test_area(self, ul_puff_pos, br_puff_pos):
+        """Track only within the rectangle between the upper left and bottom right corners."""
+        ul_puff_pos, br_puff_pos = tuple(ul_puff_pos), tuple(br_puff_pos)
+        self.test_area = {'ul': ul_puff_pos, 'br': br_puff_pos}
+        if self.__crop is not None:
+            self.__crop[:] = list(ul_puff_pos) + list(br_puff_pos)
 
         wid = br_puff_pos[0] - ul_puff_pos[0]
         hgt = br_puff_pos[1] - ul_puff_pos[1]
+        # Positions are in the crop, so frame_center is too, before any cropped frame arrives
+        self.frame_shape = (hgt, wid) + tuple(self.frame_shape[2:])
 
         if self.baseImg is not None:
             self.baseImg = self.baseImg[ul_puff_pos[1]:br_puff_pos[1], ul_puff_pos[0]:br_puff_pos[0]]
@@ -156,26 +289,134 @@ class TensTracker(object):
 
     @property
     def tens_position(self):
+        """The tensegrity's position, in cm if metric, (-1, -1) until it has been found."""
+        if not self.metric or self.tensX < 0 or self.tensY < 0:
+            return Point(self.tensX, self.tensY)
+        return self.to_floor(self.tensX, self.tensY)
+
+    @property
+    def pixel_position(self):
+        """
+        The tensegrity's position in pixels of the test area, even if metric.
+
+        For comparing with frame_center and the other thresholds in pixels:
+        RECENTER_RADIUS, STILL_RADIUS and ARENA_MARGIN.
+        """
         return Point(self.tensX, self.tensY)
 
+    def to_floor(self, x, y):
+        """
+        The floor position of a point in the test area.
+
+        :return: A Point in cm, rounded to a tenth of a millimetre
+        """
+        ul = self.test_area['ul']
+        fx, fy = self.floor_map.to_floor(x + ul[0], y + ul[1])
+        return Point(round(fx, 2), round(fy, 2))
+
+    @property
+    def tracked_position(self):
+        """
+        The tensegrity's position with the frame it was found in.
+
+        :return: A TrackedPosition with the frame's sequence number and its
+                 age in seconds (None before the first frame is processed)
+
+        position_latency has the mean seconds from grabbing a frame to its
+        position being known, the least age a position can have.
+        """
+        age = None if self.__pos_time is None else time() - self.__pos_time
+        return TrackedPosition(self.tens_position, self.__pos_seq, age)
+
+    @property
+    def tens_state(self):
+        """
+        The filtered state after the newest frame.
+
+        :return: A KalmanState with the smoothed position, the velocity in
+                 pixels/s and their covariance, or None before the first fix.
+                 In pixels even if metric, see to_floor.
+        """
+        return self.kalman.state
+
+    def position_at(self, t):
+        """
+        The filtered position at time t (as from time.time()).
+
+        Falls back to the raw position before the tensegrity has been found.
+        :return: A Point, rounded to a tenth of a pixel, or in cm if metric,
+                 or None if t is older than the filter's history
+        """
+        pos = self.kalman.position_at(t)
+        if pos is None and self.kalman.state is None:
+            return self.tens_position
+        if pos is None:
+            return None
+        if self.metric:
+            return self.to_floor(pos.x, pos.y)
+        return Point(round(pos.x, 1), round(pos.y, 1))
+
+    @property
+    def frame_cost(self):
+        """Mean seconds per frame spent finding the tensegrity, and the part of it spent on debug images."""
+        return FrameCost(self.detect_cost.frames, self.detect_cost.mean, self.debug_cost.mean)
+
+    @property
+    def roi_stats(self):
+        """
+        How often the tensegrity was found in the window around its last position.
+
+        :return: A RoiStats, fallbacks counts the frames the window missed and
+                 the whole frame had to be scanned
+        """
+        return self.__roi_stats if self.processes else self.roi.stats
+
+    def enable_debug(self, rate=1., directory='.'):
+        """Capture the intermediate images of up to rate frames a second into directory."""
+        self.debug.directory = directory
+        self.debug.rate = rate
+
+    def on_arena_exit(self, callback):
+        """
+        Call callback(position) whenever the tensegrity leaves the test area.
+
+        The callback runs on the tracking thread, so it should hand any slow
+        work off to another thread. It fires once per exit and is armed
+        again when the tensegrity is back inside.
+        """
+        self.__exit_callbacks.append(callback)
+
+    def __check_arena(self, shape):
+        """Fire the exit callbacks if the tensegrity just reached the edge of the test area."""
+        if self.tensX < 0 or self.tensY < 0:
+            return
+        hgt, wid = shape[:2]
+        m = self.arena_margin
+        inside = m <= self.tensX < wid - m and m <= self.tensY < hgt - m
+        if self.__in_arena and not inside:
+            pos = self.tens_position
+            for callback in list(self.__exit_callbacks):
+                try:
+                    callback(pos)
+                except Exception as e:
+                    print("Arena exit callback failed: {}".format(e))
+        self.__in_arena = inside
+
     def display_frame(self, pos=False):
+        seq = 0
         while True:
-            img = self.get_frame()
-            if img is None:
-                continue
-            if pos:
-                print(self.tens_position)
-            cv2.imshow("Tracker View", img)
+            frame = self.lease_frame(seq)
+            if frame is None:
+                break
+            with frame:
+                seq = frame.seq
+                if pos:
+                    print(self.tens_position)
+                cv2.imshow("Tracker View", frame.image)
 
             # if self.record:
             #     self.vid_record.write(img)
 
-            # DEBUG MODE: DISPLAY MASK FRAME
-            # m_frame = cv2.bitwise_or(self.__mask_frames[0], self.__mask_frames[1])
-            # m_frame = cv2.bitwise_or(m_frame, self.__mask_frames[2])
-            # m_view = cv2.bitwise_and(img, img, mask=m_frame)
-            # cv2.imshow("Mask View", m_view)
-
             k = cv2.waitKey(1) & 0xFF
             if k == 27:
                 cv2.destroyAllWindows()
@@ -189,7 +430,7 @@ class TensTracker(object):
         max_cams = 4
         if camNum is not None:
             try:
-                self.capture = cv2.VideoCapture(camNum)
+                self.capture = CameraSource(camNum)
             except:
                 print("Camera {} is bad".format(camNum))
             if self.capture:
@@ -206,7 +447,7 @@ class TensTracker(object):
         for cam in range(max_cams):
             print("Testing camera {}".format(cam))
             try:
-                self.capture = cv2.VideoCapture(cam)
+                self.capture = CameraSource(cam)
             except:
                 print("Camera {} is bad".format(cam))
             if self.capture:
@@ -218,10 +459,43 @@ class TensTracker(object):
                     cv2.destroyAllWindows()
                 else:
                     print("Using camera {}".format(cam))
+                    self.cam_num = cam
                     cv2.destroyAllWindows()
                     break
         assert self.capture is not None, "Couldn't find camera"
 
+    def __open_calibrated(self, cal):
+        """
+        Open the calibrated camera without asking, if its frames still match the calibration.
+
+        :return: The CalibrationCheck of its first frame
+        """
+        self.capture = CameraSource(cal.cam_num)
+        frame = None
+        for _ in range(100):
+            ret, img = self.capture.read()
+            if ret:
+                frame = img
+                break
+            sleep(0.01)
+        check = check_calibration(cal, frame)
+        if check.test_area:
+            print("Using calibrated camera {}".format(cal.cam_num))
+            self.cam_num = cal.cam_num
+        else:
+            print("Camera {} doesn't match its calibration, set it up again".format(cal.cam_num))
+            self.capture.release()
+        return check
+
+    def __capture_shape(self, tries=100):
+        """Read frames until one arrives, to size the frame buffers."""
+        for _ in range(tries):
+            ret, img = self.capture.read()
+            if ret:
+                return img.shape
+            sleep(0.01)
+        assert False, "Camera returned no frames"
+
     def __update_frame(self):
         """
         Update the current frame instance variable by retrieving the next frame
@@ -230,53 +504,161 @@ class TensTracker(object):
         Meant to run as a separate thread.
         """
         while True:
-            ret, img = self.capture.read()
-            xmax, ymax = TEST_AREA['br']
-            xmin, ymin = TEST_AREA['ul']
-            img = img[ymin:ymax, xmin:xmax]
-            self.__raw_frame = img
-            # print("__update_frame():", TEST_AREA)
-            # sleep(1)
+            claimed = self.__raw_frames.claim()
+            if claimed is None:
+                break
+            index, buf = claimed
+            ret, img = self.capture.read(image=buf)
+            if not ret or img.shape != buf.shape:
+                sleep(0.01)
+                continue
+            if img is not buf:
+                np.copyto(buf, img)
+            stamp = getattr(self.capture, 'grab_time', None) or time()
+            area = self.test_area
+            xmax, ymax = area['br']
+            xmin, ymin = area['ul']
+            img = buf[ymin:ymax, xmin:xmax]
+            self.frame_shape = img.shape
+            self.__raw_frames.publish_slot(index, img, stamp)
 
     def __update_pos(self):
         """
         Update the current tensegrity location and drawn frame.
 
+        Handles each new frame once, sleeping until the next one arrives.
+
         Meant to run as a separate thread.
         """
+        seq = 0
         while True:
+            frame = self.lease_raw_frame(seq)
+            if frame is None:
+                break
+            claimed = self.__draw_frames.claim()
+            if claimed is None:
+                frame.release()
+                break
+            if seq:
+                self.skipped_frames += frame.seq - seq - 1
+            seq = frame.seq
+            index, buf = claimed
+            t0 = time()
+            self.__debug_time = 0.
+            self.__frame_time = frame.time
+            with frame:
+                shape = frame.image.shape
+                img = buf[:shape[0], :shape[1]]
+                np.copyto(img, frame.image)
             if self.method == WHITE:
-                self.__draw_frame = self.__find_tens_white(copy(self.__raw_frame))
+                drawn = self.__find_tens_white(img)
             elif self.method == SUB:
-                self.__draw_frame = self.__find_tens_subtraction(copy(self.__raw_frame))
+                drawn = self.__find_tens_subtraction(img)
+            else:
+                drawn = self.__find_tens_puff(img)
+            self.__pos_seq, self.__pos_time = frame.seq, frame.time
+            self.position_latency.add(time() - frame.time)
+            self.__draw_frames.publish_slot(index, drawn, frame.time, frame.seq)
+            self.detect_cost.add(time() - t0)
+            self.debug_cost.add(self.__debug_time)
+            self.__check_arena(shape)
+
+    def __start_worker(self, target, *args):
+        worker = self.__ctx.Process(target=target, args=args)
+        worker.daemon = True
+        worker.start()
+        self.__workers.append(worker)
+
+    def __detector(self):
+        """
+        The detector for this tracker's method, and the images it needs cropped along with each frame.
+
+        The background subtraction needs the background too, which the detection process keeps up to date itself.
+        """
+        if self.method == WHITE:
+            return detect_white_pyramid if self.pyramid else detect_white, []
+        elif self.method == SUB:
+            return detect_subtraction_pyramid if self.pyramid else detect_subtraction, []
+        return partial(detect_puffs, classifier=self.puff_classifier), []
+
+    def __read_positions(self):
+        """
+        Update the tensegrity location from the detection process's records.
+
+        Draws each position onto the newest frame for display.
+
+        Meant to run as a separate thread.
+        """
+        seq = 0
+        while True:
+            rec = self.__records.get()
+            if rec is None:
+                break
+            if seq:
+                self.skipped_frames += rec.seq - seq - 1
+            seq = rec.seq
+            self.__frame_time = rec.time
+            if rec.center is None:
+                self.__lost()
             else:
-                self.__draw_frame = self.__find_tens_puff(copy(self.__raw_frame))
+                self.__found(rec.center)
+            self.__pos_seq, self.__pos_time = rec.seq, rec.time
+            self.position_latency.add(time() - rec.time)
+            self.__roi_stats = rec.roi
+            self.detect_cost.add(rec.cost)
+            self.frame_shape = rec.shape
+            self.__draw_position(rec)
+            self.__check_arena(rec.shape)
+
+    def __draw_position(self, rec):
+        """Publish the newest raw frame with a position record drawn on it."""
+        frame = self.__raw_frames.lease_latest()
+        if frame is None:
+            return
+        claimed = self.__draw_frames.claim()
+        if claimed is None:
+            frame.release()
+            return
+        index, buf = claimed
+        with frame:
+            shape = frame.image.shape
+            img = buf[:shape[0], :shape[1]]
+            np.copyto(img, frame.image)
+        if rec.center is not None:
+            x, y, w, h = rec.bounds
+            cv2.rectangle(img, (x, y), (x + w, y + h), (0, 0xff, 0), 2)
+            cv2.circle(img, rec.center, 3, (0, 0, 0xff), -1)
+        self.__draw_frames.publish_slot(index, img, frame.time, frame.seq)
+
+    def __debug_images(self, frame_num, images):
+        """Hand a sampled frame's images to the debug sink, timing the hand-off."""
+        if frame_num is not None:
+            t0 = time()
+            self.debug.submit(frame_num, images)
+            self.__debug_time += time() - t0
+
+    def __found(self, center):
+        self.tensX, self.tensY = center
+        self.no_tens_warned = False
+        self.kalman.update(self.__frame_time, center)
+
+    def __lost(self):
+        self.kalman.miss(self.__frame_time)
+        if not self.no_tens_warned:
+            print("WARNING: No Tensegrity found!")
+            self.no_tens_warned = True
 
     def __find_tens_white(self, img):
         """
         Takes an image, finds the tensegrity, and returns a painted image.
         """
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        blur = cv2.blur(gray, (64, 64))
-        _, thresh = cv2.threshold(blur, 100, 255, cv2.THRESH_BINARY_INV)
-        contours, _ = cv2.findContours(copy(thresh), cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-        try:
-            mmnts = cv2.moments(contours[0])
-            cx = int(mmnts['m10']/mmnts['m00'])
-            cy = int(mmnts['m01']/mmnts['m00'])
-            cv2.drawContours(img, contours, 0, (0, 0xff, 0), 3)
-            cv2.circle(img, (cx, cy), 3, (0, 0, 0xff), -1)
-            # print(cx, cy)
-            self.tensX = cx
-            self.tensY = cy
-            self.no_tens_warned = False
-        except ZeroDivisionError:
-            pass
-        except IndexError:
-            if not self.no_tens_warned:
-                print("WARNING: No Tensegrity found!")
-                self.no_tens_warned = True
-                return img
+        found = self.roi.search(detect_white_pyramid if self.pyramid else detect_white, img)
+        if found is None:
+            self.__lost()
+            return img
+        cv2.drawContours(img, found.contours, found.best, (0, 0xff, 0), 3)
+        cv2.circle(img, found.center, 3, (0, 0, 0xff), -1)
+        self.__found(found.center)
         return img
 
     def __find_tens_subtraction(self, img):
@@ -287,58 +669,50 @@ class TensTracker(object):
             # print("Size mismatch: ", img.shape, self.baseImg.shape)
             return img
 
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        preBlur = cv2.blur(gray, (BLUR_SIZE, BLUR_SIZE))
-        blur = cv2.medianBlur(preBlur, BLUR_SIZE)
-
-        subImg = self.baseImg - blur
-        _, subThreshA = cv2.threshold(subImg, 200, 0, cv2.THRESH_TOZERO_INV)
-        _, subThresh = cv2.threshold(subThreshA, 25, 255, cv2.THRESH_BINARY)
-
-        cv2.imwrite('base_img.png', self.baseImg)
-        cv2.imwrite('gray_raw.png', gray)
-        cv2.imwrite('sub_raw.png', subImg)
-        cv2.imwrite('sub_threshA.png', subThreshA)
-        cv2.imwrite('sub_thresh.png', subThresh)
-
-        contours, _ = cv2.findContours(copy(subThresh), cv2.RETR_TREE,cv2.CHAIN_APPROX_SIMPLE)
-        biggest_cont = list(sorted(contours, key=lambda x: x.size))[-1]
-        try:
-            mmnts = cv2.moments(biggest_cont)
-            cx = int(mmnts['m10']/mmnts['m00'])
-            cy = int(mmnts['m01']/mmnts['m00'])
-            cv2.drawContours(img, contours, -1, (0, 0xff, 0), 3)
-            cv2.circle(img, (cx, cy), 3, (0, 0, 0xff), -1)
-            # print(cx, cy)
-            self.tensX = cx
-            self.tensY = cy
-            self.no_tens_warned = False
-        except ZeroDivisionError:
-            pass
-        except IndexError:
-            if not self.no_tens_warned:
-                print("WARNING: No Tensegrity found!")
-                self.no_tens_warned = True
-                return img
+        debug_frame = self.debug.sample()
+        keep = None if debug_frame is None else {}
+
+        subtract = detect_subtraction_pyramid if self.pyramid else detect_subtraction
+
+        def detect(frame, base, offset):
+            return subtract(frame, base, offset, keep)
+
+        found = self.roi.search(detect, img, self.baseImg)
+        if keep:
+            self.__debug_images(debug_frame, keep)
+        if found is None:
+            self.__lost()
+            return img
+        # Before drawing, the drawing would end up in the background
+        self.background.update(img, found.bounds)
+        cv2.drawContours(img, found.contours, -1, (0, 0xff, 0), 3)
+        cv2.circle(img, found.center, 3, (0, 0, 0xff), -1)
+        self.__found(found.center)
 
         # Draw circle of radius 150 (centering boundary
         cv2.circle(img, (self.frame_center[0], self.frame_center[1]), 115, (0xff, 0, 0), 2)
-        cv2.imwrite('final_view.png', img)
+        self.__debug_images(debug_frame, {'final_view.png': img})
 
         return img
 
     def __find_tens_puff(self, img):
         if img is None:
             raise ValueError("Blob tracking error: img is None")
-        try:
-            puff_centers = self.__get_puff_centers(img)
-        except ZeroDivisionError as e:
-            print("Blob tracking error: Moment m00 is 0")
+
+        debug_frame = self.debug.sample()
+        keep = None if debug_frame is None else {}
+
+        def detect(frame, offset):
+            return detect_puffs(frame, self.puff_classifier, offset, keep)
+
+        found = self.roi.search(detect, img)
+        if keep:
+            self.__debug_images(debug_frame, keep)
+        if found is None:
+            self.__lost()
             return img
-        tens_center = self.__get_tens_center(puff_centers)
-        self.tensX = tens_center.x
-        self.tensY = tens_center.y
-        self.no_tens_warned = False
+        tens_center, puff_centers = found.center, found.points
+        self.__found(tens_center)
         # self.tens_angle = self.__get_tens_angle(Point(x=self.tensX, y=self.tensY), puff_centers[0])
 
         up_left = (tens_center.x - 15, tens_center.y - 15)
@@ -374,57 +748,6 @@ class TensTracker(object):
         angle = asin(opp_length / float(hypo_length)) * (180.0 / math.pi)
         return angle
 
-    def __get_tens_center(self, puff_centers):
-        x_vals = [center.x for center in puff_centers]
-        y_vals = [center.y for center in puff_centers]
-        cx = sum(x_vals)/3
-        cy = sum(y_vals)/3
-        return Point(x=cx, y=cy)
-
-    def __get_puff_centers(self, frame):
-        """
-        Find the centers of the puffs by using algorithms
-        :return: a list of (x,y) tuples for each puff
-        """
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        puff_centers = []
-        for puff in self.puffs:
-            puff_low = puff[0]  # lower bound on color
-            puff_high = puff[1]  # upper bound on color
-
-            frame = cv2.medianBlur(frame, 3)
-            mask = cv2.inRange(frame, puff_low, puff_high)
-            self.__mask_frames[len(puff_centers)] = mask
-
-            conts, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            max_cont = sorted(conts, key=lambda x: x.size)[-1]
-
-            # get the moments and find the center
-            mmnts = cv2.moments(max_cont)
-            cx = int(mmnts['m10'] / mmnts['m00'])
-            cy = int(mmnts['m01'] / mmnts['m00'])
-
-            puff_centers.append(Point(x=cx, y=cy))
-
-        return puff_centers
-
-    def __get_puff_center(self, frame, puff_bounds):
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-        puff_low = puff_bounds[0]  # lower bound on color
-        puff_high = puff_bounds[1]  # upper bound on color
-
-        frame = cv2.medianBlur(frame, 3)
-        mask = cv2.inRange(frame, puff_low, puff_high)
-        conts, _ = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        max_cont = sorted(conts, key=lambda x: x.size)[-1]
-
-        # get the moments and find the center
-        mmnts = cv2.moments(max_cont)
-        cx = int(mmnts['m10'] / mmnts['m00'])
-        cy = int(mmnts['m01'] / mmnts['m00'])
-
-        return (cx, cy)
-
     def __get_puffs(self):
         """
         For each puff to be tracked, allow the user to specify the mask
@@ -495,6 +818,12 @@ class TensTracker(object):
         return puff_low_limit, puff_hi_limit
 
     def shutdown(self):
+        self.__raw_frames.close()
+        self.__draw_frames.close()
+        for worker in self.__workers:
+            worker.join(1.0)
+            if worker.is_alive():
+                worker.terminate()
         cv2.destroyAllWindows()
         self.capture.release()
 
@@ -510,5 +839,5 @@ if __name__ == '__main__':
         tracker = TensTracker(display=True, method=PUFFS)
 
     while True:
-        pass
+        sleep(1)
     # tracker.shutdown()
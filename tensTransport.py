@@ -0,0 +1,370 @@
+#!/usr/bin/python
+"""
+Transports for talking to the tensegrity struts.
+
+StrutTransport is the interface the motor controllers talk to. Rather than
+spawning a fresh gatttool process for every read and write (each of which
+connects, does one operation and disconnects), a GatttoolSession keeps one
+interactive gatttool process connected to its strut and sends every request
+over that link. A SessionPool hands out exactly one transport per strut
+address so all controllers for a strut share the same connection. The
+emulated struts in strutEmulator implement the same interface.
+"""
+
+import os
+import pty
+import re
+from collections import deque
+from subprocess import Popen, check_output, CalledProcessError
+from threading import Thread, Lock, RLock, Condition
+from time import time
+
+CONNECT_TIMEOUT = 10.0  # seconds to wait for 'Connection successful'
+REQUEST_TIMEOUT = 5.0  # seconds to wait for a read/write response
+
+ANSI_ESCAPE = re.compile(r'\x1b\[[0-9;?]*[A-Za-z]')
+READ_RESPONSE = re.compile(r'Characteristic value/descriptor:\s*((?:[0-9a-fA-F]{2}\s*)*)')
+WRITE_RESPONSE = 'Characteristic value was written successfully'
+NOTIFICATION = re.compile(r'(?:Notification|Indication)\s+handle\s*=\s*(0x[0-9a-fA-F]+)\s+value:\s*((?:[0-9a-fA-F]{2}\s*)*)')
+
+ENABLE_NOTIFY = '0100'  # client characteristic configuration values
+ENABLE_INDICATE = '0200'
+
+
+class StrutTransportError(Exception):
+    """Raised when a strut cannot be reached or does not answer in time."""
+    pass
+
+
+def parse_hex_bytes(text):
+    """Turn a gatttool byte dump such as '00 ff 1e' into a list of ints."""
+    return [int(o, 16) for o in text.split(' ') if o != '']
+
+
+class StrutTransport(object):
+    """
+    The link to a single strut.
+
+    Handles are given gatttool style ('0x11') and data goes in and comes out
+    as lists of byte values. Subclasses provide the actual link by
+    implementing is_connected, close and the underscore hooks below. This
+    class supplies the policy every link shares. Requests are serialized, a
+    request that fails is retried once over a fresh connection, and
+    subscriptions are turned back on after every reconnect.
+    """
+
+    def __init__(self, btAddr):
+        super(StrutTransport, self).__init__()
+        self.btAddr = btAddr
+        self.connects = 0
+        self._lock = RLock()  # one request in flight at a time
+        self._subs_lock = Lock()  # guards the subscriber lists
+        self._subscribers = {}  # value handle -> callbacks
+        self._indicate = {}  # value handle -> indications rather than notifications
+
+    @property
+    def is_connected(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def _open(self, timeout):
+        """Establish the link, raising StrutTransportError on failure."""
+        raise NotImplementedError
+
+    def _drop(self):
+        """Forget the current link so the next request reconnects."""
+        raise NotImplementedError
+
+    def _write_once(self, handle, data, timeout):
+        raise NotImplementedError
+
+    def _read_once(self, handle, timeout):
+        raise NotImplementedError
+
+    def _enable(self, handle, indicate):
+        """Turn on notifications (or indications) for a value handle."""
+        raise NotImplementedError
+
+    def rssi(self):
+        """The link's signal strength in dBm, or None if it cannot be measured."""
+        return None
+
+    def connect(self, timeout=CONNECT_TIMEOUT):
+        """Connect to the strut if the link is not already up."""
+        with self._lock:
+            if self.is_connected:
+                return
+            self._open(timeout)
+            self.connects += 1
+            # Subscriptions do not survive a reconnect, so turn them back on
+            for handle, indicate in list(self._indicate.items()):
+                self._enable(handle, indicate)
+
+    def write(self, handle, data, timeout=REQUEST_TIMEOUT, deadline=None):
+        """
+        Write a list of byte values to a characteristic handle.
+
+        :param deadline: A time() by which the write, with any reconnect and retry, gives up
+        """
+        self.__retry('write {}'.format(handle), deadline, lambda left: self._write_once(handle, data, left), timeout)
+
+    def read(self, handle, timeout=REQUEST_TIMEOUT, deadline=None):
+        """Read a characteristic handle and return its bytes as a list of ints, see write for deadline."""
+        return self.__retry('read {}'.format(handle), deadline, lambda left: self._read_once(handle, left), timeout)
+
+    def subscribe(self, handle, callback, indicate=False):
+        """
+        Have the strut push a characteristic's value whenever it changes.
+
+        callback is called with the pushed bytes as a list of ints, from
+        whatever thread the link delivers on, so it should be quick.
+        Subscribing a callback again doesn't add it twice.
+        """
+        handle = int(handle, 16)
+        with self._subs_lock:
+            callbacks = self._subscribers.setdefault(handle, [])
+            if callback not in callbacks:
+                callbacks.append(callback)
+        with self._lock:
+            self._indicate[handle] = indicate
+            if self.is_connected:
+                self._enable(handle, indicate)
+            else:
+                self.connect()
+
+    def _dispatch(self, handle, value):
+        """Hand a pushed value to the callbacks subscribed to its handle."""
+        with self._subs_lock:
+            callbacks = list(self._subscribers.get(handle, []))
+        for callback in callbacks:
+            try:
+                callback(value)
+            except Exception as e:
+                print("Notification callback for {} failed: {}".format(self.btAddr, e))
+
+    def __retry(self, what, deadline, request, timeout):
+        if not self._lock.acquire(timeout=-1 if deadline is None else max(deadline - time(), 0)):
+            raise StrutTransportError("{} on {} failed: another request held the link past the deadline".format(
+                what, self.btAddr))
+        try:
+            for attempt in range(2):
+                left = None if deadline is None else deadline - time()
+                if left is not None and left <= 0:
+                    raise StrutTransportError("{} on {} failed: deadline passed".format(what, self.btAddr))
+                try:
+                    self.connect(CONNECT_TIMEOUT if left is None else min(CONNECT_TIMEOUT, left))
+                    left = None if deadline is None else max(deadline - time(), 0.01)
+                    return request(timeout if left is None else min(timeout, left))
+                except (StrutTransportError, OSError) as e:
+                    self._drop()
+                    if attempt == 1:
+                        raise StrutTransportError("{} on {} failed: {}".format(what, self.btAddr, e))
+        finally:
+            self._lock.release()
+
+
+class GatttoolSession(StrutTransport):
+    """
+    A single long-lived gatttool connection to one strut.
+
+    The gatttool process runs in interactive mode on a pseudo terminal (it only
+    flushes its output line by line when attached to a tty). A reader thread
+    parses everything gatttool prints and dispatches notifications and
+    indications as they arrive.
+    """
+
+    def __init__(self, btAddr, addrType='random'):
+        super(GatttoolSession, self).__init__(btAddr)
+        self.addrType = addrType
+        self.__proc = None
+        self.__fd = None
+        self.__connected = False
+        self.__responses = deque()
+        self.__cond = Condition()  # guards connection state and responses
+
+    @property
+    def is_connected(self):
+        return self.__connected and self.__proc is not None and self.__proc.poll() is None
+
+    def close(self):
+        """Disconnect and stop the gatttool process."""
+        with self._lock:
+            if self.__proc is not None and self.__proc.poll() is None:
+                try:
+                    self.__send('disconnect')
+                    self.__send('exit')
+                except OSError:
+                    pass
+                self.__proc.terminate()
+                self.__proc.wait()
+            self.__proc = None
+            if self.__fd is not None:
+                os.close(self.__fd)
+                self.__fd = None
+            self._drop()
+
+    def rssi(self):
+        """Ask the controller for the RSSI of the open connection via hcitool."""
+        try:
+            output = check_output(['hcitool', 'rssi', self.btAddr]).decode('utf-8', 'replace')
+        except (CalledProcessError, OSError):
+            return None
+        match = re.search(r'RSSI return value:\s*(-?\d+)', output)
+        return int(match.group(1)) if match else None
+
+    def _open(self, timeout):
+        if self.__proc is None or self.__proc.poll() is not None:
+            self.__spawn()
+        with self.__cond:
+            self.__connected = False
+            self.__responses.clear()
+        self.__send('connect')
+        deadline = time() + timeout
+        with self.__cond:
+            while not self.__connected:
+                if self.__responses and self.__responses[0][0] == 'error':
+                    raise StrutTransportError("Connect to {} failed: {}".format(
+                        self.btAddr, self.__responses[0][1]))
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise StrutTransportError("Connect to {} timed out".format(self.btAddr))
+                self.__cond.wait(remaining)
+
+    def _drop(self):
+        with self.__cond:
+            self.__connected = False
+            self.__cond.notify_all()
+
+    def _write_once(self, handle, data, timeout):
+        self.__command('char-write-req {} {}'.format(handle, ''.join(['{:02x}'.format(b) for b in data])),
+                       'write', timeout)
+
+    def _read_once(self, handle, timeout):
+        return self.__command('char-read-hnd {}'.format(handle), 'read', timeout)
+
+    def _enable(self, handle, indicate):
+        # The client configuration descriptor sits right after the value
+        # handle on the RFDuino
+        self.__command('char-write-req {} {}'.format(hex(handle + 1), ENABLE_INDICATE if indicate else ENABLE_NOTIFY),
+                       'write', REQUEST_TIMEOUT)
+
+    def __command(self, command, kind, timeout):
+        with self.__cond:
+            self.__responses.clear()
+        self.__send(command)
+        return self.__wait_response(kind, timeout)
+
+    def __wait_response(self, kind, timeout):
+        deadline = time() + timeout
+        with self.__cond:
+            while True:
+                while self.__responses:
+                    resp_kind, payload = self.__responses.popleft()
+                    if resp_kind == 'error':
+                        raise StrutTransportError(payload)
+                    if resp_kind == kind:
+                        return payload
+                if not self.__connected:
+                    raise StrutTransportError("Disconnected from {}".format(self.btAddr))
+                remaining = deadline - time()
+                if remaining <= 0:
+                    raise StrutTransportError("No response from {}".format(self.btAddr))
+                self.__cond.wait(remaining)
+
+    def __spawn(self):
+        master, slave = pty.openpty()
+        self.__proc = Popen(['gatttool', '-b', self.btAddr, '-t', self.addrType, '-I'],
+                            stdin=slave, stdout=slave, stderr=slave, close_fds=True)
+        os.close(slave)
+        if self.__fd is not None:
+            os.close(self.__fd)
+        self.__fd = master
+        reader = Thread(target=self.__read_output, args=(master,))
+        reader.daemon = True
+        reader.start()
+
+    def __send(self, command):
+        os.write(self.__fd, (command + '\n').encode('ascii'))
+
+    def __read_output(self, fd):
+        """
+        Parse gatttool's output into responses.
+
+        Meant to run as a separate thread.
+        """
+        buf = ''
+        while True:
+            try:
+                chunk = os.read(fd, 1024)
+            except OSError:
+                break
+            if not chunk:
+                break
+            buf += chunk.decode('utf-8', 'replace')
+            lines = re.split(r'[\r\n]', buf)
+            buf = lines.pop()
+            for line in lines:
+                self.__handle_line(ANSI_ESCAPE.sub('', line))
+        self._drop()
+
+    def __handle_line(self, line):
+        notify_match = NOTIFICATION.search(line)
+        if notify_match:
+            self._dispatch(int(notify_match.group(1), 16), parse_hex_bytes(notify_match.group(2)))
+            return
+        read_match = READ_RESPONSE.search(line)
+        with self.__cond:
+            if 'Connection successful' in line:
+                self.__connected = True
+            elif read_match:
+                self.__responses.append(('read', parse_hex_bytes(read_match.group(1))))
+            elif WRITE_RESPONSE in line:
+                self.__responses.append(('write', None))
+            elif 'Disconnected' in line or 'connect error' in line.lower():
+                self.__connected = False
+                self.__responses.append(('error', line.strip()))
+            elif line.strip().startswith('Error') or 'Command Failed' in line:
+                self.__responses.append(('error', line.strip()))
+            else:
+                return
+            self.__cond.notify_all()
+
+
+class SessionPool(object):
+    """Keeps one live transport per strut address."""
+
+    def __init__(self, session_factory=GatttoolSession):
+        super(SessionPool, self).__init__()
+        self.session_factory = session_factory
+        self.__sessions = {}
+        self.__lock = RLock()
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def __contains__(self, btAddr):
+        return btAddr in self.__sessions
+
+    def get(self, btAddr):
+        """Return the session for an address, creating it on first use."""
+        with self.__lock:
+            if btAddr not in self.__sessions:
+                self.__sessions[btAddr] = self.session_factory(btAddr)
+            return self.__sessions[btAddr]
+
+    def close(self, btAddr):
+        with self.__lock:
+            session = self.__sessions.pop(btAddr, None)
+        if session is not None:
+            session.close()
+
+    def close_all(self):
+        with self.__lock:
+            addrs = list(self.__sessions)
+        for btAddr in addrs:
+            self.close(btAddr)
+
+
+DEFAULT_POOL = SessionPool()
@@ -35,6 +35,16 @@ class TensGUI(object):
 
         ## STRUT LIST
         self.strutListFrame = tk.Frame(self.f, relief=tk.RAISED)
+
+        ## STOP BUTTON
+        self.stopButton = tk.Button(self.f, text="STOP", bg="red", fg="white",
+                                    font=("Helvetica", 20), command=self.__stop)
+        self.stopButton.grid(row=2, column=0, columnspan=2, sticky=tk.N+tk.E+tk.S+tk.W)
+        self.f._root().bind('<Escape>', lambda event: self.__stop())
+
+    def __stop(self):
+        """Stop every motor without blocking the UI."""
+        self.tensController.trigger_stop("UI")
         
 
 
@@ -10,6 +10,12 @@ import pkg_resources
 import qtm
 import math
 import numpy as np
+from time import time
+
+from kalmanTracker import PositionFilter
+
+QTM_MEASUREMENT_NOISE = 1.0  # mm
+QTM_ACCEL_NOISE = 300.0  # mm/s^2
 
 class QtmTracker():
 
@@ -18,6 +24,8 @@ class QtmTracker():
         self.connection = None
         self.xml_string = None
         self.eulers = None
+        self.position = None
+        self.kalman = PositionFilter(QTM_MEASUREMENT_NOISE, QTM_ACCEL_NOISE)
         self.ip = ip
 
         self.loop.run_until_complete(self.__connect_to_qtm(self.ip))
@@ -52,6 +60,14 @@ class QtmTracker():
         return self.eulers
         # return self.loop.run_until_complete(self.live_stream_pos())
 
+    @property
+    def tens_state(self):
+        """The filtered state of the tracked body after the newest packet, positions in mm."""
+        return self.kalman.state
+
+    def position_at(self, t):
+        """The filtered (x, y, z) of the tracked body at time t, or None before the first packet."""
+        return self.kalman.position_at(t)
 
     def __on_packet(self, packet):
         info, bodies = packet.get_6d()
@@ -60,6 +76,12 @@ class QtmTracker():
 
         for index,(position, rotation) in enumerate(bodies):
             if index == 5:
+                self.position = (position.x, position.y, position.z)
+                # QTM reports NaN while the body is out of view
+                if any(math.isnan(v) for v in self.position):
+                    self.kalman.miss(time())
+                else:
+                    self.kalman.update(time(), self.position)
                 rotationArray = np.array(rotation.matrix)
                 rotationArray.resize((3,3))
                 self.eulers = self.__rotationMatrixToEulerAngles(rotationArray)
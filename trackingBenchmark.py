@@ -0,0 +1,385 @@
+#!/usr/bin/python
+"""
+Speed and accuracy of the tensegrity tracking.
+
+benchmark_stages runs each stage of the tracking by hand over every frame
+of a source: reading the frame, detecting the tensegrity and filtering its
+position. It times each stage and, where the true position is known,
+measures how far the detected and filtered centers are from it.
+benchmark_tracker instead runs a whole TensTracker on a source for a while
+and reports the rate it kept up and how old its positions were.
+compare_pyramid checks the coarse to fine detectors against the full
+resolution ones, frame by frame.
+
+With no recording given, a SyntheticArena draws the frames, so the true
+position is always known. Run from the command line to print a table for
+every method:
+
+    python trackingBenchmark.py [source] [--truth positions.csv] [--tracker | --compare] [--pyramid]
+"""
+
+import argparse
+import csv
+import math
+from collections import namedtuple
+from time import sleep, time
+
+import cv2
+import numpy as np
+
+from frameSource import FrameSource, open_source
+from kalmanTracker import PositionFilter
+from tensDetection import Point, WindowedSearch, BackgroundModel, blur_gray, detect_white, detect_subtraction, \
+    detect_white_pyramid, detect_subtraction_pyramid, detect_puffs, PuffClassifier, ROI_RADIUS
+from tensTracking import TensTracker, WHITE, SUB, PUFFS, PRESET_PUFFS
+
+METHODS = {'WHITE': WHITE, 'SUB': SUB, 'PUFFS': PUFFS}
+PYRAMID_METHODS = [WHITE, SUB]  # the methods with a coarse to fine detector
+FRAME_RATE = 30.  # frames a second a recording is taken to be at, for the filter's timestamps
+SYNTHETIC_FRAMES = 300
+SYNTHETIC_LAP = 900  # frames a synthetic robot takes to go around its figure eight, 30 s as fast as VVVALTR
+
+# frames benchmarked, frames per second, mean seconds spent reading, detecting
+# and filtering a frame, the fraction of frames the tensegrity was found in,
+# and the mean and largest distance in pixels of the detected and the
+# filtered centers from the true one (None without a true position)
+StageResult = namedtuple('StageResult', ['method', 'frames', 'fps', 'read', 'detect', 'filter', 'found',
+                                         'error', 'max_error', 'filtered_error'])
+
+# positions per second, frames the tracker skipped, mean seconds spent
+# detecting per frame, the mean seconds from grabbing a frame to its position
+# and the mean age of the positions when read, in seconds
+TrackerResult = namedtuple('TrackerResult', ['method', 'positions', 'fps', 'skipped', 'detect', 'latency', 'age'])
+
+# frames compared, mean seconds detecting at full resolution and coarse to
+# fine, the fraction of frames both found the same center in (or neither
+# found one) and the largest distance between their centers in pixels
+PyramidResult = namedtuple('PyramidResult', ['method', 'frames', 'full', 'pyramid', 'same', 'max_diff'])
+
+
+class SyntheticArena(FrameSource):
+    """
+    Frames of a tensegrity going around a figure eight in a textured arena, with known positions.
+
+    The robot is drawn to suit method: a dark disk for WHITE and SUB, and a
+    dark disk with the PRESET_PUFFS colors around its edge for PUFFS. The
+    first empty frames are of the empty arena, as subtraction tracking
+    expects, a tracker needs more of them than its base image is late.
+    """
+
+    def __init__(self, method, frames=SYNTHETIC_FRAMES, shape=(480, 640), radius=35, noise=3., seed=0, empty=1,
+                 lap=SYNTHETIC_LAP, fps=None, loop=False):
+        super(SyntheticArena, self).__init__(fps, loop)
+        self.method = method
+        self.frames = frames
+        self.lap = lap
+        self.empty = empty
+        self.shape = shape
+        self.radius = radius
+        rng = np.random.RandomState(seed)
+        hgt, wid = shape
+        # A smooth, uneven floor, lighter than the robot everywhere
+        texture = cv2.resize(rng.uniform(170, 235, (hgt // 40, wid // 40)), (wid, hgt), interpolation=cv2.INTER_CUBIC)
+        self.floor = cv2.cvtColor(np.clip(texture, 0, 255).astype(np.uint8), cv2.COLOR_GRAY2BGR)
+        self.__noise = [rng.normal(0, noise, self.floor.shape).astype(np.int16) for i in range(4)]
+        self.__pos = 0
+
+    @property
+    def frame_count(self):
+        return self.frames
+
+    def truth(self, index):
+        """The true center of the tensegrity in frame index (counted from 0), or None if it isn't there."""
+        if index < self.empty or index >= self.frames:
+            return None
+        hgt, wid = self.shape
+        phase = 2 * math.pi * index / self.lap
+        return Point(wid / 2. + 0.3 * wid * math.sin(phase), hgt / 2. + 0.3 * hgt * math.sin(2 * phase))
+
+    def _next(self, image):
+        if self.__pos >= self.frames:
+            return None
+        img = image if image is not None and image.shape == self.floor.shape else np.empty_like(self.floor)
+        np.copyto(img, self.floor)
+        center = self.truth(self.__pos)
+        if center is not None:
+            self.__draw_robot(img, center, 2 * math.pi * self.__pos / 90.)
+        noisy = cv2.add(img, self.__noise[self.__pos % len(self.__noise)], dtype=cv2.CV_8U)
+        np.copyto(img, noisy)
+        self.__pos += 1
+        return img
+
+    def _rewind(self):
+        self.__pos = 0
+
+    def __draw_robot(self, img, center, angle):
+        # Drawn with 4 fractional bits, so the true center isn't rounded
+        scale = 16
+        cv2.circle(img, self.__fixed(center, scale), self.radius * scale, (40, 40, 40), -1, cv2.LINE_AA, 4)
+        if self.method != PUFFS:
+            return
+        for i, (low, high) in enumerate(PRESET_PUFFS):
+            hsv = np.uint8([[(low.astype(int) + high.astype(int)) // 2]])
+            hsv[0, 0, 1:] = 220
+            color = [int(c) for c in cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)[0, 0]]
+            a = angle + 2 * math.pi * i / len(PRESET_PUFFS)
+            puff = Point(center.x + (self.radius - 10) * math.cos(a), center.y + (self.radius - 10) * math.sin(a))
+            cv2.circle(img, self.__fixed(puff, scale), 9 * scale, color, -1, cv2.LINE_AA, 4)
+
+    @staticmethod
+    def __fixed(point, scale):
+        return int(round(point.x * scale)), int(round(point.y * scale))
+
+
+def load_truth(path):
+    """
+    True positions from a CSV file with frame, x and y columns (frames counted from 0).
+
+    :return: A function of the frame index giving its Point, or None
+    """
+    with open(path) as truth_file:
+        positions = dict([(int(row['frame']), Point(float(row['x']), float(row['y'])))
+                          for row in csv.DictReader(truth_file)])
+    return positions.get
+
+
+def benchmark_stages(source, method, truth=None, frames=None, roi_radius=ROI_RADIUS, pyramid=False):
+    """
+    Time reading, detecting and filtering every frame of source, one after another.
+
+    For SUB the first frame is taken as the empty arena, as the tracker does.
+    :param source: A frameSource source, or anything open_source takes
+    :param truth: A function of a frame's index giving the true center, or None
+    :param frames: Frames to benchmark at most, None for all of them
+    :param roi_radius: Radius of the search window, None to search whole frames
+    :param pyramid: Detect coarse to fine, for WHITE and SUB
+    :return: A StageResult
+    """
+    source = open_source(source)
+    if truth is None:
+        truth = getattr(source, 'truth', None)
+    roi = WindowedSearch(roi_radius)
+    kalman = PositionFilter(point=Point)
+    background = None
+    detect = detector_of(method, pyramid)
+    read_time = detect_time = filter_time = 0.
+    errors, filtered_errors = [], []
+    found_count = count = 0
+    buf = None
+    index = 0
+    begin = time()
+    while frames is None or count < frames:
+        t0 = time()
+        ret, img = source.read(buf)
+        if not ret:
+            break
+        buf = img
+        t1 = time()
+        if method == SUB and background is None:
+            background = BackgroundModel(blur_gray(img))
+            index += 1
+            continue
+        aligned = [background.image] if background is not None else []
+        found = roi.search(detect, img, *aligned)
+        if found is not None and background is not None:
+            background.update(img, found.bounds)
+        t2 = time()
+        stamp = index / FRAME_RATE
+        state = kalman.miss(stamp) if found is None else kalman.update(stamp, found.center)
+        t3 = time()
+        read_time += t1 - t0
+        detect_time += t2 - t1
+        filter_time += t3 - t2
+        count += 1
+        expected = truth(index) if truth is not None else None
+        if found is not None:
+            found_count += 1
+            if expected is not None:
+                errors.append(math.hypot(found.center.x - expected.x, found.center.y - expected.y))
+        if state is not None and expected is not None:
+            filtered_errors.append(math.hypot(state.position.x - expected.x, state.position.y - expected.y))
+        index += 1
+    elapsed = time() - begin
+    source.release()
+    assert count, "No frames to benchmark"
+    return StageResult(method, count, count / elapsed, read_time / count, detect_time / count,
+                       filter_time / count, found_count / float(count),
+                       sum(errors) / len(errors) if errors else None, max(errors) if errors else None,
+                       sum(filtered_errors) / len(filtered_errors) if filtered_errors else None)
+
+
+def compare_pyramid(source, method, frames=None):
+    """
+    Detect the tensegrity in whole frames both at full resolution and coarse to fine.
+
+    For SUB the first frame is taken as the empty arena. Only WHITE and SUB
+    have coarse to fine detectors.
+    :return: A PyramidResult
+    """
+    assert method in PYRAMID_METHODS, "Only WHITE and SUB detect coarse to fine"
+    source = open_source(source)
+    full_detect, pyramid_detect = detector_of(method, False), detector_of(method, True)
+    base = None
+    full_time = pyramid_time = 0.
+    same = count = 0
+    max_diff = 0.
+    while frames is None or count < frames:
+        ret, img = source.read()
+        if not ret:
+            break
+        if method == SUB and base is None:
+            base = blur_gray(img)
+            continue
+        aligned = [] if base is None else [base]
+        t0 = time()
+        full = full_detect(img, *aligned, offset=(0, 0))
+        t1 = time()
+        coarse = pyramid_detect(img, *aligned, offset=(0, 0))
+        t2 = time()
+        full_time += t1 - t0
+        pyramid_time += t2 - t1
+        count += 1
+        if full is None or coarse is None:
+            same += full is None and coarse is None
+            continue
+        same += full.center == coarse.center
+        max_diff = max(max_diff, math.hypot(full.center.x - coarse.center.x, full.center.y - coarse.center.y))
+    source.release()
+    assert count, "No frames to compare"
+    return PyramidResult(method, count, full_time / count, pyramid_time / count, same / float(count), max_diff)
+
+
+def check_touching_puffs():
+    """
+    Find two puffs of different colors whose blobs touch, as each others' neighbors on a tensegrity can.
+
+    :return: Whether each puff came out as its own blob, with its own center and bounds
+    """
+    hsv = np.full((100, 140, 3), (0, 0, 200), np.uint8)
+    hsv[20:60, 20:60] = (5, 220, 220)  # PRESET_PUFFS[0]
+    hsv[20:60, 60:100] = (105, 220, 220)  # PRESET_PUFFS[1]
+    img = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+    _, found = PuffClassifier(PRESET_PUFFS).find(img)
+    expected = [(Point(39, 39), (20, 20, 40, 40)), (Point(79, 39), (60, 20, 40, 40)), None]
+    if found != expected:
+        print("Touching puffs found as {}, expected {}".format(found, expected))
+        return False
+    return True
+
+
+def detector_of(method, pyramid):
+    """The detector of method, called as detect(img, *aligned, offset=offset)."""
+    if method == PUFFS:
+        classifier = PuffClassifier(PRESET_PUFFS)
+
+        def detect(img, offset):
+            return detect_puffs(img, classifier, offset)
+
+        return detect
+    if method == SUB:
+        return detect_subtraction_pyramid if pyramid else detect_subtraction
+    return detect_white_pyramid if pyramid else detect_white
+
+
+def benchmark_tracker(source, method, seconds=5., processes=False, test_area=None, pyramid=False):
+    """
+    Run a TensTracker on source for a while.
+
+    :param source: Anything TensTracker takes as a source, played at the rate it sets
+    :param test_area: ((x0, y0), (x1, y1)) to track in, the whole frame if None
+    :return: A TrackerResult
+    """
+    source = open_source(source)
+    if test_area is None:
+        test_area = ((0, 0), (int(source.get(cv2.CAP_PROP_FRAME_WIDTH)), int(source.get(cv2.CAP_PROP_FRAME_HEIGHT))))
+        assert test_area[1] > (0, 0), "Give the test area of a source that doesn't know its frame size"
+    tracker = TensTracker(display=False, method=method, preset=True, processes=processes, source=source,
+                          test_area=test_area, pyramid=pyramid)
+    tracker.detect_cost.reset()
+    tracker.position_latency.reset()
+    skipped = tracker.skipped_frames
+    ages = []
+    begin = time()
+    while time() - begin < seconds:
+        sleep(0.1)
+        tracked = tracker.tracked_position
+        if tracked.age is not None:
+            ages.append(tracked.age)
+    elapsed = time() - begin
+    positions = tracker.detect_cost.frames
+    detect = tracker.detect_cost.mean
+    latency = tracker.position_latency.mean
+    skipped = tracker.skipped_frames - skipped
+    tracker.shutdown()
+    return TrackerResult(method, positions, positions / elapsed, skipped, detect, latency,
+                         sum(ages) / len(ages) if ages else None)
+
+
+def format_ms(seconds):
+    return '-' if seconds is None else '{:.2f}'.format(seconds * 1000)
+
+
+def format_px(pixels):
+    return '-' if pixels is None else '{:.2f}'.format(pixels)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the tensegrity tracking methods")
+    parser.add_argument('source', nargs='?', help="video file or directory of images, a synthetic arena if left out")
+    parser.add_argument('--truth', help="CSV file of true positions, with frame, x and y columns")
+    parser.add_argument('--methods', nargs='+', choices=sorted(METHODS), default=['WHITE', 'SUB', 'PUFFS'],
+                        help="methods to benchmark, PUFFS has no coarse to fine detector to compare")
+    parser.add_argument('--frames', type=int, help="frames to benchmark at most")
+    parser.add_argument('--tracker', action='store_true', help="run whole trackers instead of the stages")
+    parser.add_argument('--seconds', type=float, default=5., help="seconds to run each tracker for")
+    parser.add_argument('--processes', action='store_true', help="run the trackers' capture and detection in processes")
+    parser.add_argument('--pyramid', action='store_true', help="detect coarse to fine")
+    parser.add_argument('--whole', action='store_true', help="search whole frames instead of a window")
+    parser.add_argument('--compare', action='store_true', help="compare coarse to fine with full resolution detection")
+    parser.add_argument('--check', action='store_true', help="check puffs that touch are told apart, then exit")
+    args = parser.parse_args()
+
+    if args.check:
+        ok = check_touching_puffs()
+        print("Touching puffs: {}".format('ok' if ok else 'FAILED'))
+        raise SystemExit(0 if ok else 1)
+
+    truth = load_truth(args.truth) if args.truth else None
+    if args.compare:
+        print("{:<6} {:>6} {:>8} {:>11} {:>8} {:>6} {:>8}".format('method', 'frames', 'full ms', 'pyramid ms',
+                                                                'speedup', 'same', 'max px'))
+    elif args.tracker:
+        print("{:<6} {:>9} {:>7} {:>7} {:>10} {:>11} {:>7}".format('method', 'positions', 'fps', 'skipped',
+                                                                   'detect ms', 'latency ms', 'age ms'))
+    else:
+        print("{:<6} {:>6} {:>7} {:>8} {:>10} {:>10} {:>6} {:>9} {:>9} {:>12}".format(
+            'method', 'frames', 'fps', 'read ms', 'detect ms', 'filter ms', 'found', 'error px', 'max px',
+            'filtered px'))
+    for name in args.methods:
+        method = METHODS[name]
+        if args.compare and method not in PYRAMID_METHODS:
+            print("{:<6} has no coarse to fine detector to compare".format(name))
+            continue
+        if args.source is not None:
+            source = args.source
+        elif args.tracker:
+            source = SyntheticArena(method, frames=int(FRAME_RATE * (args.seconds + 30)), empty=int(FRAME_RATE),
+                                    fps=FRAME_RATE)
+        else:
+            source = SyntheticArena(method)
+        if args.compare:
+            res = compare_pyramid(source, method, args.frames)
+            print("{:<6} {:>6} {:>8} {:>11} {:>8.1f} {:>6.0%} {:>8}".format(
+                name, res.frames, format_ms(res.full), format_ms(res.pyramid), res.full / res.pyramid, res.same,
+                format_px(res.max_diff)))
+        elif args.tracker:
+            res = benchmark_tracker(source, method, args.seconds, args.processes, pyramid=args.pyramid)
+            print("{:<6} {:>9} {:>7.1f} {:>7} {:>10} {:>11} {:>7}".format(
+                name, res.positions, res.fps, res.skipped, format_ms(res.detect), format_ms(res.latency),
+                format_ms(res.age)))
+        else:
+            res = benchmark_stages(source, method, truth, args.frames, None if args.whole else ROI_RADIUS,
+                                   args.pyramid)
+            print("{:<6} {:>6} {:>7.1f} {:>8} {:>10} {:>10} {:>6.0%} {:>9} {:>9} {:>12}".format(
+                name, res.frames, res.fps, format_ms(res.read), format_ms(res.detect), format_ms(res.filter), res.found,
+                format_px(res.error), format_px(res.max_error), format_px(res.filtered_error)))
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+"""
+Overlaps the parts of a learning trial that do not need the robot.
+
+After a trial's motors stop, the learners used to write the result, wait for
+the robot to be recentered and let it rest before returning the distance, so
+the optimizer could only start on its next candidate once all of that was
+over. A TrialPipeline takes the result as soon as the distance is known and
+does the persistence, recentering wait and rest on a background thread while
+the optimizer works out the next candidate. The next trial then only waits
+for whatever is left of that.
+"""
+
+from collections import namedtuple
+from math import sqrt
+from queue import Queue
+from threading import Thread, Event
+from time import sleep, time
+
+RECENTER_RADIUS = 120  # pixels from the frame center that count as centered
+REST_TIME = 2.0  # longest the tensegrity rests between trials
+RECENTER_POLL = 0.5  # seconds between position checks while recentering
+RECENTER_NAG = 2.5  # seconds between reminders to center the tensegrity
+
+TrialTiming = namedtuple('TrialTiming', ['iter_num', 'run', 'save', 'recenter', 'rest', 'think', 'waited'])
+
+
+def dist_to_center(tracker, pos=None):
+    """
+    Distance in pixels from the tensegrity to the middle of the frame.
+
+    Uses the tracker's pixel_position, as frame_center is in pixels even
+    for a metric tracker. pos, if given, has to be in pixels too.
+    """
+    pos = tracker.pixel_position if pos is None else pos
+    f_center_x, f_center_y = tracker.frame_center
+    return sqrt((pos.x - f_center_x) ** 2 + (pos.y - f_center_y) ** 2)
+
+
+def wait_for_recenter(tracker, radius=RECENTER_RADIUS, poll_interval=RECENTER_POLL, nag_interval=RECENTER_NAG):
+    """
+    Block until the tensegrity is back within radius pixels of the frame center.
+
+    The position is checked every poll_interval seconds so the wait ends
+    promptly, but the reminder is only printed every nag_interval seconds.
+    :return: The seconds spent waiting
+    """
+    start = time()
+    last_nag = None
+    dist = dist_to_center(tracker)
+    while dist > radius:
+        if last_nag is None or time() - last_nag >= nag_interval:
+            print("Center tensegrity, dist to center is ", dist)
+            last_nag = time()
+        sleep(poll_interval)
+        dist = dist_to_center(tracker)
+    return time() - start
+
+
+class TrialPipeline(object):
+    """
+    Runs the tail of each trial (save, recenter, rest) in the background.
+
+    A learner calls wait_until_ready() before it records a trial's start
+    position and finish_trial() once the distance is known. Timings for each
+    phase are printed per trial. The think phase is the time the optimizer
+    spent between trials, and waited is how long the next trial still had to
+    wait for the arena.
+
+    With a MotionTimer the rest ends as soon as the tensegrity is still,
+    otherwise it always lasts rest_time seconds.
+    """
+
+    def __init__(self, tracker, recenter_radius=RECENTER_RADIUS, rest_time=REST_TIME, verbose=True, timer=None):
+        super(TrialPipeline, self).__init__()
+        self.tracker = tracker
+        self.timer = timer
+        self.recenter_radius = recenter_radius
+        self.rest_time = rest_time
+        self.verbose = verbose
+        self.timings = []
+        self.__ready = Event()
+        self.__ready.set()
+        self.__jobs = Queue()
+        self.__run_start = None
+        self.__finished = None
+        self.__think = None
+        self.__waited = None
+        self.__worker = Thread(target=self.__work, args=())
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def wait_until_ready(self):
+        """
+        Block until the previous trial's tail is done and the arena is ready.
+
+        :return: The seconds spent waiting
+        """
+        now = time()
+        self.__think = None if self.__finished is None else now - self.__finished
+        self.__ready.wait()
+        self.__run_start = time()
+        self.__waited = self.__run_start - now
+        return self.__waited
+
+    def finish_trial(self, iter_num, save, result, recenter=True, rest_time=None):
+        """
+        Hand a finished trial's tail to the background thread and return at once.
+
+        :param save: Called with result to persist it
+        :param recenter: Whether to wait for the tensegrity to be recentered
+        :param rest_time: Seconds to rest afterwards (rest_time of the pipeline by default)
+        """
+        self.__finished = time()
+        run = None if self.__run_start is None else self.__finished - self.__run_start
+        rest_time = self.rest_time if rest_time is None else rest_time
+        self.__ready.clear()
+        self.__jobs.put((iter_num, save, result, recenter, rest_time, run, self.__think, self.__waited))
+
+    def drain(self):
+        """Wait for the last trial's tail, then print the total time the overlap saved."""
+        self.__jobs.join()
+        self.__ready.wait()
+        if self.verbose and self.timings:
+            print("Pipelining saved {:.1f} s over {} trials".format(self.overlap_saved(), len(self.timings)))
+
+    def overlap_saved(self):
+        """Seconds of trial tails that ran while the optimizer was busy instead of in series."""
+        saved = 0.
+        for i, t in enumerate(self.timings[:-1]):
+            waited = self.timings[i + 1].waited or 0.
+            saved += t.save + t.recenter + t.rest - waited
+        return saved
+
+    def __work(self):
+        """
+        Run trial tails in order.
+
+        Meant to run as a separate thread.
+        """
+        while True:
+            iter_num, save, result, recenter, rest_time, run, think, waited = self.__jobs.get()
+            t0 = time()
+            try:
+                save(result)
+            except Exception as e:
+                print("Saving trial {} failed: {}".format(iter_num, e))
+            t1 = time()
+            if recenter:
+                wait_for_recenter(self.tracker, self.recenter_radius)
+            t2 = time()
+            if self.timer is not None:
+                self.timer.wait(rest_time)
+            else:
+                sleep(rest_time)
+            t3 = time()
+            timing = TrialTiming(iter_num, run, t1 - t0, t2 - t1, t3 - t2, think, waited)
+            self.timings.append(timing)
+            if self.verbose:
+                print(format_timing(timing))
+            self.__ready.set()
+            self.__jobs.task_done()
+
+
+def format_timing(timing):
+    """One line with the phase timings of a trial."""
+    def sec(t):
+        return '-' if t is None else "{:.2f} s".format(t)
+
+    return "Trial {} phases: run {}, save {}, recenter {}, rest {} (previous think {}, waited {})".format(
+        timing.iter_num, sec(timing.run), sec(timing.save), sec(timing.recenter), sec(timing.rest),
+        sec(timing.think), sec(timing.waited))
@@ -0,0 +1,261 @@
+#!/usr/bin/python
+"""
+Capture and detection in worker processes.
+
+Run as threads, capture and detection share the GIL with each other and with
+the learning code in the same process. With processes=True a TensTracker
+starts one process that decodes camera frames into a SharedFrameRing and one
+that finds the tensegrity in them, and only a small PositionRecord per frame
+comes back to the tracker's process.
+
+A SharedFrameRing has the same interface as framePipeline.FrameRing, but its
+buffers and bookkeeping are in shared memory so the processes exchange
+frames without pickling or copying them.
+"""
+
+from collections import namedtuple
+from multiprocessing import get_context
+from time import sleep, time
+
+import numpy as np
+
+from framePipeline import Frame, FrameLease
+from frameSource import open_source
+from tensDetection import WindowedSearch
+
+SHARED_RING_SIZE = 6  # buffers per shared ring, room for the camera, the newest frame and three leases
+
+# seq and time of the frame, the tensegrity's center (None if not found), the
+# bounds of the detection, the shape of the frame, seconds spent detecting
+# and the detection process's RoiStats
+PositionRecord = namedtuple('PositionRecord', ['seq', 'time', 'center', 'bounds', 'shape', 'cost', 'roi'])
+
+
+def context():
+    """
+    The multiprocessing context the workers run in.
+
+    Spawned rather than forked, a fork of a process with OpenCV and camera
+    threads running can deadlock.
+    """
+    return get_context('spawn')
+
+
+class SharedFrameRing(object):
+    """
+    A FrameRing whose buffers processes share.
+
+    Published images are views of part of a buffer. Only the rectangle
+    the view covers is shared, so consumers in other processes rebuild the
+    same view. Only one process may produce frames.
+    """
+
+    def __init__(self, shape, size=SHARED_RING_SIZE, ctx=None):
+        super(SharedFrameRing, self).__init__()
+        assert size >= 2, "A ring needs at least 2 buffers"
+        ctx = context() if ctx is None else ctx
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(np.uint8)
+        self.size = size
+        self.claim_waits = 0
+        self.__nbytes = int(np.prod(self.shape))
+        self.__pixels = ctx.RawArray('B', self.__nbytes * size)
+        self.__seqs = ctx.RawArray('q', size)
+        self.__times = ctx.RawArray('d', size)
+        self.__crops = ctx.RawArray('i', 4 * size)
+        self.__leases = ctx.RawArray('i', size)
+        self.__state = ctx.RawArray('q', [-1, 0, 0])  # newest buffer, newest seq, closed
+        self.__cond = ctx.Condition()
+        self.__buffers = None
+        self.__next = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_SharedFrameRing__buffers'] = None
+        return state
+
+    @property
+    def seq(self):
+        return self.__state[1]
+
+    @property
+    def latest(self):
+        """The newest Frame, or None before the first one. Never blocks."""
+        with self.__cond:
+            return None if self.__state[0] < 0 else self.__frame(self.__state[0])
+
+    def wait_next(self, after=0, timeout=None):
+        """
+        Block until there is a frame with a sequence number above after.
+
+        :return: The newest Frame, or None on timeout or once the ring is closed
+        """
+        with self.__cond:
+            if not self.__cond.wait_for(lambda: self.__state[2] or (self.__state[0] >= 0 and
+                                                                  self.__state[1] > after), timeout):
+                return None
+            return None if self.__state[2] else self.__frame(self.__state[0])
+
+    def claim(self, timeout=None):
+        """
+        Hand the producer a buffer that is neither leased nor the newest frame.
+
+        :return: (index, writable buffer), or None on timeout or once the ring is closed
+        """
+        with self.__cond:
+            free = self.__free()
+            if free is None:
+                self.claim_waits += 1
+                self.__cond.wait_for(lambda: self.__state[2] or self.__free() is not None, timeout)
+                free = self.__free()
+            if self.__state[2] or free is None:
+                return None
+            self.__next = free
+            return free, self.__buffer(free)
+
+    def publish_slot(self, index, image=None, stamp=None, seq=None):
+        """
+        Publish a claimed buffer, or the view image of part of it, as the newest frame.
+
+        :return: The frame's sequence number
+        """
+        x0, y0, x1, y1 = self.__crop_of(index, image)
+        with self.__cond:
+            seq = self.__state[1] + 1 if seq is None else seq
+            self.__seqs[index] = seq
+            self.__times[index] = time() if stamp is None else stamp
+            self.__crops[4 * index:4 * index + 4] = [x0, y0, x1, y1]
+            self.__state[0] = index
+            self.__state[1] = seq
+            self.__next = (index + 1) % self.size
+            self.__cond.notify_all()
+            return seq
+
+    def lease(self, after=0, timeout=None):
+        """
+        Block like wait_next, then hold the frame's buffer until released.
+
+        :return: A FrameLease, or None on timeout or once the ring is closed
+        """
+        with self.__cond:
+            frame = self.wait_next(after, timeout)
+            if frame is None:
+                return None
+            index = self.__state[0]
+            self.__leases[index] += 1
+            return FrameLease(self, index, frame)
+
+    def lease_latest(self):
+        """Lease the newest frame without blocking, or return None before the first one."""
+        with self.__cond:
+            index = self.__state[0]
+            if index < 0 or self.__state[2]:
+                return None
+            self.__leases[index] += 1
+            return FrameLease(self, index, self.__frame(index))
+
+    def release(self, index):
+        with self.__cond:
+            self.__leases[index] -= 1
+            self.__cond.notify_all()
+
+    def close(self):
+        """Wake every consumer and the producer for good."""
+        with self.__cond:
+            self.__state[2] = 1
+            self.__cond.notify_all()
+
+    def __buffer(self, index):
+        """The buffer at index, mapped into this process."""
+        if self.__buffers is None:
+            self.__buffers = [np.frombuffer(self.__pixels, self.dtype, self.__nbytes,
+                                            i * self.__nbytes).reshape(self.shape) for i in range(self.size)]
+        return self.__buffers[index]
+
+    def __frame(self, index):
+        x0, y0, x1, y1 = self.__crops[4 * index:4 * index + 4]
+        image = self.__buffer(index)[y0:y1, x0:x1]
+        image.flags.writeable = False
+        return Frame(self.__seqs[index], self.__times[index], image)
+
+    def __crop_of(self, index, image):
+        """The (x0, y0, x1, y1) rectangle of buffer index that the view image covers."""
+        buf = self.__buffer(index)
+        if image is None:
+            return 0, 0, buf.shape[1], buf.shape[0]
+        offset = image.__array_interface__['data'][0] - buf.__array_interface__['data'][0]
+        assert 0 <= offset < buf.nbytes, "Published image is not in the claimed buffer"
+        y0, rest = divmod(offset, buf.strides[0])
+        x0 = rest // buf.strides[1]
+        return x0, y0, x0 + image.shape[1], y0 + image.shape[0]
+
+    def __free(self):
+        """The first buffer from the producer's position on that can be written, or None."""
+        for i in range(self.size):
+            index = (self.__next + i) % self.size
+            if index != self.__state[0] and not self.__leases[index]:
+                return index
+        return None
+
+
+def capture_frames(source, ring, crop):
+    """
+    Decode frames from a camera, or any other frameSource source, into ring.
+
+    :param crop: A shared (x0, y0, x1, y1) array with the part of the frame to publish
+
+    Meant to run as a separate process.
+    """
+    capture = open_source(source)
+    while True:
+        claimed = ring.claim()
+        if claimed is None:
+            break
+        index, buf = claimed
+        ret, img = capture.read(image=buf)
+        if not ret or img.shape != buf.shape:
+            sleep(0.01)
+            continue
+        if img is not buf:
+            np.copyto(buf, img)
+        stamp = capture.grab_time or time()
+        xmin, ymin, xmax, ymax = crop[:]
+        ring.publish_slot(index, buf[ymin:ymax, xmin:xmax], stamp)
+    capture.release()
+
+
+def detect_positions(ring, records, detect, aligned, roi_radius, background=None):
+    """
+    Find the tensegrity in each new frame of ring and put a PositionRecord on records.
+
+    :param detect: A detector from tensDetection, with any settings bound
+    :param aligned: Images the detector needs cropped along with the frame
+    :param background: A BackgroundModel to keep up to date from the frames, its
+                       image is passed to the detector after the aligned images
+
+    Meant to run as a separate process.
+    """
+    if background is not None:
+        aligned = list(aligned) + [background.image]
+    roi = WindowedSearch(roi_radius)
+    seq = 0
+    while True:
+        frame = ring.lease(seq)
+        if frame is None:
+            break
+        t0 = time()
+        with frame:
+            seq = frame.seq
+            img = frame.image
+            if all([a.shape[:2] == img.shape[:2] for a in aligned]):
+                found = roi.search(detect, img, *aligned)
+            else:
+                found = None
+            if found is not None and background is not None:
+                background.update(img, found.bounds)
+        cost = time() - t0
+        if found is None:
+            records.put(PositionRecord(seq, frame.time, None, None, img.shape, cost, roi.stats))
+        else:
+            records.put(PositionRecord(seq, frame.time, found.center, found.bounds, img.shape, cost, roi.stats))
+    records.put(None)